@@ -3,6 +3,27 @@
 # - Base version, working as expected
 # 2. Version 1.1 (2023/03/19):
 # - Everytime **Financial Report Links** code runs, it won't overwrite any previous data, instead it will append new data for the previous scraped data.
+# 3. Version 1.2 (2026/10/18):
+# - Selenium only passes the cloudfare check once, JSON endpoints are fetched with a keep-alive HTTP session (browser is the fallback when a challenge shows up again).
+# - Stock details are scraped by async workers sharing one fetch engine, request pace is set by a per-host rate limit instead of fixed sleeps.
+# - Static stock chunks replaced by a shared priority work queue of (stock, endpoint) units, worker count can be changed during the run.
+# - Stored trading dates and financial report keys are preloaded with one grouped query each, instead of SQL probes per stock.
+# - Exports are merged on natural keys through COPY + INSERT ... ON CONFLICT with one pooled engine, instead of to_sql replace/append.
+# - Scraped units stream through a bounded queue to a writer stage that flushes batches to the DB while scraping continues.
+# - Chrome drivers are leased from a shared browser pool (health checks, recycling, profile cleanup) instead of being started by the script.
+# - Completed units are recorded in a run ledger, a crashed run can be continued with --resume.
+# - Fetches use a bounded retry policy (exponential backoff + jitter) with a circuit breaker per endpoint, failed units go to a dead-letter table and are retried first on the next run.
+# - Script body moved into functions with a main(), so run_all.py can run the stock summary and details as jobs.
+# - Dates are parsed through the shared memoized date parser (bei_ksei/dates.py) instead of pd.to_datetime guessing the format per batch.
+# - Responses are kept in an on-disk cache (TTL per endpoint, LRU size cap). Profiles and report listings the DB already has are not built or written again, RESPONSE_CACHE_OFFLINE=1 replays a run from the cache only.
+# - Today's trading info comes from the bulk stock summary for stocks complete up to the previous trading day, GetTradingInfoSS is only called for gaps.
+# - Trading sessions are inferred from the stored history: gaps request exactly the missing sessions (was calendar days from an import-time today), up-to-date stocks are not requested, suspended stocks are not polled until they trade again.
+# - Full trading history is fetched as start/length pages, concurrently and checkpointed per page, instead of one length=10000 request. --backfill runs it on its own for stocks without history.
+# - Batches go to every configured sink (SINKS=postgres,parquet): trading info can also be kept as local Parquet partitioned by stock and year.
+# - Dropped columns, renames and dtypes (category codes, float32 prices, Int64 volumes, datetime64 dates) come from the table schemas (bei_ksei/schemas.py) and are applied to every unit as it arrives, new tables get matching SQL column types and indexes.
+# - Financial report links come from one market-wide listing per (year, period), paged concurrently and fanned out to stocks locally, instead of 8 requests per stock. Per stock requests are kept as the fallback (FINANCIAL_REPORT_LISTING=per_stock, or a listing that keeps failing).
+# - Distributed mode: --coordinator seeds the run's units into a DB task table, any number of --worker processes claim them (FOR UPDATE SKIP LOCKED, leases renewed by heartbeats, units of a dead worker are claimed again) and write their own batches.
+# - Requests, latency, retries, bytes, Chrome page loads, JSON parsing and DB writes are recorded per endpoint (bei_ksei/metrics.py), written as a Prometheus textfile and a JSON run summary. Completed units are counted under a lock (was an unguarded completion_count).
 
 # <strong>Features:</strong>
 # - Scrape IDX individual stock summary and details
@@ -11,45 +32,41 @@
 # 
 # Plan: Data is scraped <strong>every weekday on 6PM GMT+7</strong>, few hours after the market has closed for the day. So the data you see before 6PM is previous trading day data.
 
-import json
-from json.decoder import JSONDecodeError
 import pandas as pd
-import numpy as np
-import time
 from datetime import datetime
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-import threading
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from tqdm import tqdm
-import gc
+import asyncio
 
+import argparse
+from collections import Counter
 import os
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.pool import QueuePool
 
-# # Chrome Selenium Starter
+from bei_ksei.idx_session import IDXSession
+from bei_ksei.backfill_pages import BackfillPages, BACKFILL_DONE, PAGE_ENDPOINT, is_page_endpoint, page_start
+from bei_ksei.browser_pool import close_browser_pool
+from bei_ksei.dates import parse_dates
+from bei_ksei.db_sink import get_engine, migrate_natural_keys
+from bei_ksei.dead_letters import DeadLetters
+from bei_ksei.fetch_engine import FetchEngine, DEFAULT_CONCURRENCY
+from bei_ksei.metrics import metrics, write_run_report
+from bei_ksei.pipeline import BatchWriter
+from bei_ksei.response_cache import get_response_cache
+from bei_ksei.retry_policy import RetryExhausted
+from bei_ksei.run_ledger import RunLedger
+from bei_ksei.task_queue import TaskQueue, POLL_SECONDS as TASK_POLL_SECONDS, keep_leases, run_worker
+from bei_ksei.schemas import apply_schema
+from bei_ksei.sinks import write_to_sinks
+from bei_ksei.trading_calendar import load_trading_calendar
+from bei_ksei.watermarks import load_watermarks
+from bei_ksei.work_queue import (
+    WorkQueue, PRIORITY_DEAD_LETTER, PRIORITY_TRADING_TODAY, PRIORITY_PROFILE, PRIORITY_FINANCIAL_REPORT, PRIORITY_BACKFILL
+)
+
+# # IDX Session
 # 
 # Why Selenium? Because I need it to bypass cloudfare restriction
-
-# Initialize the Chrome driver
-
-def driver_setup():
-    options = Options()
-    options.add_argument("--headless=new")
-    options.add_argument("--no-sandbox")
-    driver = webdriver.Chrome(options=options)
-
-    return driver
-
-print("Initialize Driver for Summary")
-driver = driver_setup()
+# 
+# The browser only passes the cloudfare check once, the JSON endpoints are then fetched with a keep-alive HTTP session (created in main)
 
 # # Scrape Summary URL
 
@@ -62,269 +79,583 @@ urls = {
 }
 
 # ## BEI Stock Summary
-print("Start Scrape Stock Summary")
-while True:
-    try:
-        driver.get(urls['BEIStockSummary'])
-        WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-        BEIStockSummaryContent = driver.find_element(By.TAG_NAME, value='body').text
-        BEIStockSummaryDF = pd.DataFrame(json.loads(BEIStockSummaryContent)['data']).drop(columns=['No'])
-        BEIStockSummaryDF
-        break
-    except JSONDecodeError as e:
-        time.sleep(1.5)
-#             print(stock, 'Company Profiles JSON is not available!', 'Retrying!')
-
-# ## Close and Quit Driver
-driver.close()
-driver.quit()
-print("End Scrape Stock Summary")
+
+def scrape_stock_summary(idx_session):
+    print("Start Scrape Stock Summary")
+    BEIStockSummaryDF = pd.DataFrame(idx_session.get_json(urls['BEIStockSummary'])['data']).drop(columns=['No'])
+    print("End Scrape Stock Summary")
+
+    return BEIStockSummaryDF
+
 # # Scrape Stock Details URL
 
 # ## Company Profiles
 
-def get_company_profiles(driver, stock):
+# Profiles and report listings go through the response cache, a response the DB already has gives no rows
+
+async def get_company_profiles(fetcher, stock, responses):
     company_profiles_url = 'https://www.idx.co.id/primary/ListedCompany/GetCompanyProfilesDetail?KodeEmiten=' + stock
-    while True:
-        try:
-            driver.get(company_profiles_url)
-            WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-            CompanyProfilesContent = driver.find_element(By.TAG_NAME, value='body').text
-            CompanyProfilesRow = pd.DataFrame(json.loads(CompanyProfilesContent)['Profiles'])
-            CompanyProfilesRow.insert(0, 'StockCode', stock)
-            
-            break
-        except JSONDecodeError as e:
-            time.sleep(1.5)
-#             print(stock, 'Company Profiles JSON is not available!', 'Retrying!')
+    CompanyProfilesContent = await fetcher.get_json_changed(company_profiles_url, responses)
+    if CompanyProfilesContent is None:
+        return pd.DataFrame()
+    CompanyProfilesRow = pd.DataFrame(CompanyProfilesContent['Profiles'])
+    CompanyProfilesRow.insert(0, 'StockCode', stock)
     
-    time.sleep(0.75)    
-    
-    return CompanyProfilesRow
+    return apply_schema('IDXCompanyProfiles', CompanyProfilesRow)
 
 # ## Trading Info
-today = datetime.today()
-def get_trading_info(driver, engine, stock):
-    global today
-    query = '''
-        SELECT \"IDXTradingInfo\".\"StockCode\", \"IDXTradingInfo\".\"Date\" FROM \"IDXTradingInfo\" 
-        WHERE
-            \"IDXTradingInfo\".\"StockCode\" = \'{}\' 
-    '''.format(stock)
+# 
+# length is the number of trading sessions the stock misses (see bei_ksei/trading_calendar.py)
+
+async def get_trading_info(fetcher, stock, length):
+    trading_info_url = 'https://www.idx.co.id/primary/ListedCompany/GetTradingInfoSS?code={}&start=0&length={}'.format(stock, length)
+    TradingInfoRows = pd.DataFrame((await fetcher.get_json(trading_info_url))['replies'])
     
-    with engine.connect() as conn:
-        df = pd.read_sql(query, con=conn)
+    return apply_schema('IDXTradingInfo', TradingInfoRows)
 
-    if len(df) > 0:
-        max_date = df['Date'].max()
-        difference = (today - max_date).days + 1
+# ## Trading Info History Pages
+# 
+# Full history of a stock without stored history, one start/length page per unit (see bei_ksei/backfill_pages.py)
 
-        trading_info_url = 'https://www.idx.co.id/primary/ListedCompany/GetTradingInfoSS?code={}&start=0&length={}'.format(stock, difference)
-    else:
-        trading_info_url = 'https://www.idx.co.id/primary/ListedCompany/GetTradingInfoSS?code={}&start=0&length=10000'.format(stock)
+async def get_trading_info_page(fetcher, stock, start, length):
+    trading_info_url = 'https://www.idx.co.id/primary/ListedCompany/GetTradingInfoSS?code={}&start={}&length={}'.format(stock, start, length)
+    TradingInfoContent = await fetcher.get_json(trading_info_url)
+
+    return apply_schema('IDXTradingInfo', pd.DataFrame(TradingInfoContent['replies'])), TradingInfoContent.get('recordsTotal')
+
+async def load_trading_info_page(work_queue, fetcher, backfill_pages, stock, start):
+    if backfill_pages.is_past_end(stock, start):
+        # Queued ahead, but the history already ended
+        return pd.DataFrame()
+
+    TradingInfoRows, total = await get_trading_info_page(fetcher, stock, start, backfill_pages.page_size)
+    backfill_pages.page_loaded(work_queue, stock, start, len(TradingInfoRows), total)
 
-    while True:
-        try:
-            driver.get(trading_info_url)
-            WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-            TradingInfoContent = driver.find_element(By.TAG_NAME, value='body').text
-            TradingInfoRows = pd.DataFrame(json.loads(TradingInfoContent)['replies'])
-            
-            break
-        except JSONDecodeError as e:
-            time.sleep(1.5)
-#             print(stock, 'Trading Info JSON is not available!', 'Retrying!')
-    
-    time.sleep(0.75)
-    
     return TradingInfoRows
 
+# ## Trading Info From Stock Summary
+# 
+# BEIStockSummary already has the day's OHLC, volume, value and frequency of every stock. Stocks whose history is
+# complete up to the previous trading day get that row from the summary, GetTradingInfoSS is only called for gaps.
+
+def trading_info_columns(engine):
+    if not sqlalchemy.inspect(engine).has_table('IDXTradingInfo'):
+        return []
+
+    return [column['name'] for column in sqlalchemy.inspect(engine).get_columns('IDXTradingInfo') if column['name'] != 'LastScraped']
+
+def trading_rows_from_summary(BEIStockSummaryDF, columns):
+    # Summary rows of the latest summary date, reduced to the IDXTradingInfo columns
+    if 'Date' not in BEIStockSummaryDF.columns or not columns:
+        return None, pd.DataFrame()
+
+    summary_dates = parse_dates(BEIStockSummaryDF['Date']).dt.normalize()
+    summary_date = summary_dates.max()
+    TradingInfoRows = BEIStockSummaryDF[summary_dates == summary_date]
+    TradingInfoRows = TradingInfoRows[[column for column in columns if column in TradingInfoRows.columns]]
+
+    return summary_date, apply_schema('IDXTradingInfo', TradingInfoRows)
+
+def stocks_traded(BEIStockSummaryDF, summary_date):
+    # Stocks with trades in the summary session, every stock when the summary can't tell
+    if summary_date is None or 'Frequency' not in BEIStockSummaryDF.columns:
+        return set(BEIStockSummaryDF['StockCode'])
+
+    summary_dates = parse_dates(BEIStockSummaryDF['Date']).dt.normalize()
+    frequency = pd.to_numeric(BEIStockSummaryDF['Frequency'], errors='coerce')
+
+    return set(BEIStockSummaryDF.loc[(summary_dates == summary_date) & (frequency > 0), 'StockCode'])
+
+# ## Trading Info Plan
+# 
+# Every stock gets one of:
+# - backfill: no stored history, full history request
+# - current: already has the latest session, no request
+# - summary: only misses the latest session and it's in the stock summary, no request
+# - suspended: many sessions behind, didn't trade in the latest session and its stored history already ended in
+#   sessions without a trade, not polled until it trades again (or its gap passes MAX_SUSPENDED_GAP)
+# - fetch: GetTradingInfoSS for exactly the missing sessions
+
+def plan_trading_info(stock_list, watermarks, calendar, summary_stocks, traded_stocks):
+    plan = {}
+    for stock in stock_list:
+        max_date = watermarks.max_date(stock)
+        if max_date is None:
+            plan[stock] = 'backfill'
+        elif calendar.is_up_to_date(max_date):
+            plan[stock] = 'current'
+        elif calendar.missing_sessions(max_date) == 1 and stock in summary_stocks:
+            plan[stock] = 'summary'
+        elif calendar.is_suspended(max_date, watermarks.last_trade_date(stock), stock in traded_stocks):
+            plan[stock] = 'suspended'
+        else:
+            plan[stock] = 'fetch'
+
+    return plan
+
 # ## Financial Reports File Links
 # Maximum last 3 years (Current: 2023, Min: 2021)
 # 
 # Code will only find for any missing data, previous available data won't be overwritten.
+# 
+# Without kodeEmiten the listing of a (year, period) has every emitter, so the whole market is one listing per
+# (year, period), paged with indexFrom (1-based page) / pageSize, instead of one request per stock and (year, period).
+# Attachments are fanned out to their stocks locally. FINANCIAL_REPORT_LISTING=per_stock goes back to one request
+# per stock, and a listing that keeps failing falls back to per stock requests of its (year, period).
+
+FINANCIAL_REPORT_LISTING = os.getenv('FINANCIAL_REPORT_LISTING', 'bulk')
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', 100))
+REPORT_PERIODS = ['TW1', 'TW2', 'TW3', 'Audit']
+LISTING_ENDPOINT = 'FinancialReportListing'
 
-def get_financial_report_file_links(driver, engine, stock):
+def report_years():
     current_year = datetime.now().year
     # last 3 years
-    years = [current_year, current_year-2]
-    periods = ['TW1', 'TW2', 'TW3', 'Audit']
-    
-    FinancialReportRows = pd.DataFrame()
-    for year in years:
-        for period in periods:
-            query = '''
-                SELECT * FROM \"IDXFinancialReportLinks\" 
-                WHERE 
-                    \"IDXFinancialReportLinks\".\"StockCode\" = \'{}\' 
-                    AND \"IDXFinancialReportLinks\".\"Report_Period\" = \'{}\' 
-                    AND \"IDXFinancialReportLinks\".\"Report_Year\" = \'{}\'
-            '''.format(stock, period, year)
-
-            with engine.connect() as conn:
-                df = pd.read_sql(query, con=conn)
-            
-            if len(df) > 0:
-                continue
-            else:
-                while True:
-                    try:
-                        financial_report_url = 'https://www.idx.co.id/primary/ListedCompany/GetFinancialReport?periode={}&year={}&indexFrom=0&pageSize=1000&reportType=rdf&kodeEmiten={}'.format(period, year, stock)
-                        driver.get(financial_report_url)
-                        WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-                        FinancialReportContent = driver.find_element(By.TAG_NAME, value='body').text
-                        if json.loads(FinancialReportContent)['ResultCount'] > 0:
-                            FinancialReportRow = pd.DataFrame(json.loads(FinancialReportContent)['Results'][0]['Attachments'])
-                            FinancialReportRow = FinancialReportRow.rename(columns={'Emiten_Code':'StockCode'})
-                            FinancialReportRows = pd.concat([FinancialReportRows, FinancialReportRow])
-                        break
-                    except JSONDecodeError as e:
-                        time.sleep(1.5)
-    #                     print(stock, year, period, 'JSON is not available!', 'Retrying!')
-        time.sleep(0.75)
-    return FinancialReportRows
-
-# ## Multithreading Scrape
-
-# ### Driver Initialization
-
-num_threads = 6
-
-# ### Split StockID to Chunks
-
-stock_list = BEIStockSummaryDF['StockCode'].to_list()
-stock_chunks = np.array_split(stock_list, num_threads)
+    return [current_year, current_year-2]
 
-# ### Worker Function
+def financial_report_url(period, year, stock='', index_from=0, page_size=1000):
+    return 'https://www.idx.co.id/primary/ListedCompany/GetFinancialReport?periode={}&year={}&indexFrom={}&pageSize={}&reportType=rdf&kodeEmiten={}'.format(period, year, index_from, page_size, stock)
 
-# Define a worker function that takes stock codes from the queue and loads them in parallel
+# Listing units are keyed '<year>:<period>' in place of a stock code
+def listing_key(year, period):
+    return '{}:{}'.format(year, period)
 
-def load_stock(driver, engine, stock):
-    company_profiles = get_company_profiles(driver, stock)
-    trading_info = get_trading_info(driver, engine, stock)
-    financial_report_links = get_financial_report_file_links(driver, engine, stock)
-    
-    return company_profiles, trading_info, financial_report_links
+def parse_listing_key(key):
+    year, period = key.split(':')
+    return int(year), period
 
-def load_stock_chunks(stock_list, total_stock_length, thread_id):
-    global completion_count
-    chunks_dict = {
-        'CompanyProfiles':[],
-        'TradingInfo':[],
-        'FinancialReportLinks':[]
-    }
+def financial_report_rows(FinancialReportContent):
+    # Attachments of every emitter in the listing, built as one frame
+    attachments = [attachment for result in FinancialReportContent['Results'] for attachment in result['Attachments']]
 
-    driver = driver_setup()
-    engine = init_engine()
+    return apply_schema('IDXFinancialReportLinks', pd.DataFrame(attachments))
 
-    for i, stock_code in enumerate(stock_list):
-        company_profiles, trading_info, financial_report_links = load_stock(driver, engine, stock_code)
+async def get_financial_report_file_links(fetcher, watermarks, stock, responses, years=None, periods=None):
+    FinancialReportRows = []
+    for year in years or report_years():
+        for period in periods or REPORT_PERIODS:
+            if watermarks.has_report(stock, period, year):
+                continue
+            else:
+                FinancialReportContent = await fetcher.get_json_changed(financial_report_url(period, year, stock), responses)
+                if FinancialReportContent is not None and FinancialReportContent['ResultCount'] > 0:
+                    FinancialReportRows.append(financial_report_rows(FinancialReportContent))
+
+    return pd.concat(FinancialReportRows) if FinancialReportRows else pd.DataFrame()
+
+async def get_financial_report_listing(fetcher, watermarks, listed_stocks, year, period, responses):
+    # The first page gives the number of emitters, the other pages are fetched concurrently
+    FirstPage, changed = await fetcher.fetch_json_changed(financial_report_url(period, year, index_from=1, page_size=REPORT_PAGE_SIZE), responses)
+    page_count = -(-FirstPage['ResultCount'] // REPORT_PAGE_SIZE)
+    Pages = await asyncio.gather(*[
+        fetcher.get_json_changed(financial_report_url(period, year, index_from=page, page_size=REPORT_PAGE_SIZE), responses)
+        for page in range(2, page_count+1)
+    ])
+    # Pages the DB already has exactly are not built again
+    Pages = [FirstPage if changed else None] + Pages
+    FinancialReportRows = [financial_report_rows(Page) for Page in Pages if Page is not None and len(Page['Results']) > 0]
+    if not FinancialReportRows:
+        return pd.DataFrame()
+
+    FinancialReportRows = pd.concat(FinancialReportRows)
+    # Same rows as the per stock requests: listed stocks whose report of this (year, period) isn't stored yet
+    missing = [stock in listed_stocks and not watermarks.has_report(stock, period, year) for stock in FinancialReportRows['StockCode']]
+
+    return FinancialReportRows[missing]
+
+def report_fallback_units(watermarks, stock_list, year, period):
+    # Per stock requests of one (year, period), when its listing can't be fetched
+    return [
+        (PRIORITY_FINANCIAL_REPORT, stock, 'FinancialReportLinks:{}'.format(listing_key(year, period)))
+        for stock in stock_list if not watermarks.has_report(stock, period, year)
+    ]
 
-        chunks_dict['CompanyProfiles'].append(company_profiles)
-        chunks_dict['TradingInfo'].append(trading_info)
-        chunks_dict['FinancialReportLinks'].append(financial_report_links)
+# ## Async Scrape
+# 
+# Request pace is set by the per-host rate limit of the fetch engine (IDX_RATE), not by fixed sleeps
 
-        completion_count += 1
-        print(f"Thread {thread_id}: Stock {stock_code} processed, {i+1}/{len(stock_list)} in thread completed, {completion_count}/{total_stock_length} in total completed")
+# ### Worker Initialization
 
-    driver.close()
-    driver.quit()
+num_workers = DEFAULT_CONCURRENCY
 
-    return chunks_dict
+# ### Worker Function
 
-# ### Load SQL Engine for Previous Data
+# Every (stock, endpoint) unit is a separate task in the shared work queue, idle workers pull the next one by priority:
+# today's trading info first, then profiles and financial reports, full trading history backfill last
+
+async def load_stock_unit(work_queue, fetcher, watermarks, calendar, backfill_pages, listed_stocks, stock, endpoint, responses):
+    if endpoint == 'CompanyProfiles':
+        return await get_company_profiles(fetcher, stock, responses)
+    elif endpoint == 'TradingInfo':
+        max_date = watermarks.max_date(stock)
+        if max_date is None:
+            # No history yet, its history pages go to the back of the queue
+            backfill_pages.start(work_queue, stock)
+            return None
+        length = calendar.missing_sessions(max_date)
+        if length == 0:
+            return pd.DataFrame()
+        return await get_trading_info(fetcher, stock, length)
+    elif endpoint == BACKFILL_DONE:
+        # Dead letter of the old single request backfill
+        backfill_pages.start(work_queue, stock)
+        return None
+    elif is_page_endpoint(endpoint):
+        return await load_trading_info_page(work_queue, fetcher, backfill_pages, stock, page_start(endpoint))
+    elif endpoint == LISTING_ENDPOINT:
+        year, period = parse_listing_key(stock)
+        try:
+            return await get_financial_report_listing(fetcher, watermarks, listed_stocks, year, period, responses)
+        except RetryExhausted as e:
+            units = report_fallback_units(watermarks, sorted(listed_stocks), year, period)
+            print(f'Listing {stock} failed ({e}), falling back to {len(units)} per stock requests')
+            for priority, unit_stock, unit_endpoint in units:
+                work_queue.put(priority, unit_stock, unit_endpoint)
+            return None
+    elif endpoint == 'FinancialReportLinks':
+        return await get_financial_report_file_links(fetcher, watermarks, stock, responses)
+    elif endpoint.startswith('FinancialReportLinks:'):
+        year, period = parse_listing_key(endpoint.split(':', 1)[1])
+        return await get_financial_report_file_links(fetcher, watermarks, stock, responses, years=[year], periods=[period])
 
-def init_engine():
-    engine = create_engine(
-        "postgresql://{}:{}@{}/{}".format(
-            os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
-        )
-    )
-    return engine
+# ### Data Transformation
+# 
+# Applied per batch by the writer stage, right before the batch goes to the DB. Dropped columns, renames and dtypes
+# come from the table schemas (bei_ksei/schemas.py), already applied to every unit as it arrived and applied again
+# to the batch, so categories of different units are merged.
 
+def transform_company_profiles(CompanyProfilesDF):
+    CompanyProfilesDF['Logo'] = ['https://www.idx.co.id' + logo for logo in CompanyProfilesDF['Logo']]
+    CompanyProfilesDF['LastScraped'] = datetime.now()
 
-# ### Create list to store scraped data
+    return apply_schema('IDXCompanyProfiles', CompanyProfilesDF)
 
-results_dict = {
-    'CompanyProfiles':[],
-    'TradingInfo':[],
-    'FinancialReportLinks':[]
-}
+def transform_trading_info(TradingInfoDF):
+    TradingInfoDF['LastScraped'] = datetime.now()
 
-# ### Run MultiThreading with Progress Status
+    return apply_schema('IDXTradingInfo', TradingInfoDF)
 
-print("Start Scrape Stock Details")
+def transform_financial_report_links(FinancialReportLinksDF):
+    FinancialReportLinksDF['File_Path'] = 'https://www.idx.co.id/' + FinancialReportLinksDF['File_Path']
+    FinancialReportLinksDF['LastScraped'] = datetime.now()
 
-with ThreadPoolExecutor(max_workers=num_threads) as executor:
-    futures = []
-    completion_count = 0
+    return apply_schema('IDXFinancialReportLinks', FinancialReportLinksDF)
 
-    for i in range(num_threads):
-        print(f'Thread {i+1} has {len(stock_chunks[i])} stocks')
-        futures.append(executor.submit(load_stock_chunks, stock_chunks[i], len(stock_list), i+1))
+# ### Export SQL
+# 
+# Rows are merged on the natural key of each table (COPY into staging + INSERT ... ON CONFLICT), see bei_ksei/db_sink.py
 
-    for future in as_completed(futures):
-        chunks_dict = future.result()
+transforms = {
+    'IDXCompanyProfiles': transform_company_profiles,
+    'IDXTradingInfo': transform_trading_info,
+    'IDXFinancialReportLinks': transform_financial_report_links,
+}
 
-        results_dict['CompanyProfiles'].extend(chunks_dict['CompanyProfiles'])
-        results_dict['TradingInfo'].extend(chunks_dict['TradingInfo'])
-        results_dict['FinancialReportLinks'].extend(chunks_dict['FinancialReportLinks'])
+# History pages are recorded in the run ledger page by page, 'TradingInfoPage:<start>' is written to IDXTradingInfo,
+# per stock fallbacks of a report listing, 'FinancialReportLinks:<year>:<period>', to IDXFinancialReportLinks
+endpoint_tables = {
+    'CompanyProfiles': 'IDXCompanyProfiles',
+    'TradingInfo': 'IDXTradingInfo',
+    PAGE_ENDPOINT: 'IDXTradingInfo',
+    'FinancialReportLinks': 'IDXFinancialReportLinks',
+    LISTING_ENDPOINT: 'IDXFinancialReportLinks',
+}
 
-print("End Scrape Stock Details")
+def write_batch(table, df):
+    written = write_to_sinks(table, transforms[table](df))
+    print(f"{table}: {written} rows written")
 
-# ## Join All Stock Details and Export Result
-print("Data Transformation and Export Result")
+# ### Run Work Queue with Progress Status
+# 
+# Each finished unit goes straight to the bounded writer queue, so nothing is held until the end of the run.
+# Shared by the daily run and the backfill command: plan_units(ledger, backfill_pages, dead_letter_units) gives the
+# (priority, stock, endpoint) units to queue and frames that are already built, as (table, df, units).
+
+def pending_dead_letters(dead_letters, listed_stocks):
+    return [(stock, endpoint) for stock, endpoint in dead_letters.pending() if stock in listed_stocks or endpoint == LISTING_ENDPOINT]
+
+async def run_stock_units(idx_session, job, stock_list, resume, watermarks, calendar, plan_units):
+    # Every unit is recorded in the run ledger once its data is committed
+    ledger = RunLedger(get_engine(), job=job)
+    run_id = ledger.start(resume=resume)
+    print(f'Run {run_id}: {len(ledger.completed)} units already completed')
+
+    # Units that kept failing last time are retried first
+    dead_letters = DeadLetters(get_engine(), job=job)
+    listed_stocks = set(stock_list)
+    dead_letter_units = pending_dead_letters(dead_letters, listed_stocks)
+
+    backfill_pages = BackfillPages(ledger, PRIORITY_BACKFILL)
+    for stock, endpoint in dead_letter_units:
+        if is_page_endpoint(endpoint):
+            backfill_pages.mark_queued(stock, page_start(endpoint))
+    units, frames = plan_units(ledger, backfill_pages, dead_letter_units)
+
+    # Responses each unit was built from, recorded in the response cache as stored once the unit is committed
+    response_cache = idx_session.response_cache
+    unit_responses = {}
+
+    def commit_units(units):
+        ledger.mark_done(units)
+        if response_cache is not None:
+            response_cache.mark_stored([response for unit in units for response in unit_responses.pop(unit, [])])
+
+    async with FetchEngine(max_concurrency=num_workers, idx_session=idx_session, response_cache=response_cache) as fetcher, BatchWriter(write_batch, on_commit=commit_units) as writer:
+        async def handler(work_queue, stock, endpoint):
+            responses = []
+            result = await load_stock_unit(work_queue, fetcher, watermarks, calendar, backfill_pages, listed_stocks, stock, endpoint, responses)
+            if result is None:
+                return
+
+            unit = (stock, endpoint)
+            unit_responses[unit] = responses
+            units = [unit]
+            if is_page_endpoint(endpoint) and backfill_pages.history_completed(stock):
+                # Every page up to the end of the history is in, a resumed run skips this stock
+                units.append((stock, BACKFILL_DONE))
+            if len(result) > 0:
+                await writer.put(endpoint_tables[endpoint.split(':')[0]], result, units=units)
+            else:
+                # Nothing new to write, the unit is done already
+                await asyncio.to_thread(commit_units, units)
+            metrics.inc('units_completed_total', unit=endpoint.split(':')[0])
+            print(f"Stock {stock} {endpoint} processed, {metrics.total('units_completed_total')} units completed")
+
+        for table, df, frame_units in frames:
+            await writer.put(table, df, units=frame_units)
+
+        work_queue = WorkQueue(handler, num_workers)
+        for stock, endpoint in dead_letter_units:
+            work_queue.put(PRIORITY_DEAD_LETTER, stock, endpoint)
+        for priority, stock, endpoint in units:
+            work_queue.put(priority, stock, endpoint)
+        print(f'Work queue has {work_queue.pending()} units for {len(stock_list)} stocks')
+
+        work_queue.install_signal_handlers()
+        await work_queue.run()
+
+        for stock, endpoint, e in work_queue.errors:
+            print(stock, endpoint, 'failed:', repr(e))
+        print('Achieved requests/sec:', fetcher.rates())
+        if response_cache is not None:
+            print(f'Response cache: {response_cache.hits} served from cache, {response_cache.misses} fetched, {response_cache.unchanged} unchanged (not written)')
+
+    failed_units = {(stock, endpoint) for stock, endpoint, e in work_queue.errors}
+    dead_letters.add(work_queue.errors)
+    dead_letters.resolve([unit for unit in dead_letter_units if unit not in failed_units])
+    print(f'Dead letters: {len(dead_letter_units)} retried, {len(work_queue.errors)} failed in this run')
+
+    print('Rows written:', writer.written_rows)
+    if not work_queue.errors:
+        ledger.finish()
+
+# ### Daily Run
+
+def plan_stock_details(BEIStockSummaryDF):
+    # (stock_list, watermarks, calendar, plan_units) of a daily run, shared by the single process run and the
+    # coordinator of a distributed run
+    stock_list = BEIStockSummaryDF['StockCode'].to_list()
+    # One grouped query per table instead of a probe per stock
+    watermarks = load_watermarks(get_engine(), min_year=datetime.now().year-2)
+    print(f'Watermarks loaded: {len(watermarks.max_dates)} stocks with trading history, {len(watermarks.report_keys)} financial report keys')
+
+    # Trading sessions inferred from the stored history, the summary date is the latest session
+    summary_date, SummaryTradingRows = trading_rows_from_summary(BEIStockSummaryDF, trading_info_columns(get_engine()))
+    calendar = load_trading_calendar(get_engine(), summary_date)
+    summary_stocks = set(SummaryTradingRows['StockCode']) if len(SummaryTradingRows) > 0 else set()
+    trading_plan = plan_trading_info(stock_list, watermarks, calendar, summary_stocks, stocks_traded(BEIStockSummaryDF, summary_date))
+    print(f'Trading info of {calendar.latest_session:%Y-%m-%d}:', dict(Counter(trading_plan.values())))
+
+    def plan_units(ledger, backfill_pages, dead_letter_units):
+        # Steady state: stocks that only miss the latest session take its row from the summary
+        summary_stocks = {stock for stock, plan in trading_plan.items() if plan == 'summary' and not ledger.is_done(stock, 'TradingInfo')}
+        summary_rows = SummaryTradingRows[SummaryTradingRows['StockCode'].isin(summary_stocks)] if summary_stocks else pd.DataFrame()
+        frames = [('IDXTradingInfo', summary_rows, [(stock, 'TradingInfo') for stock in summary_stocks])]
+
+        # A resumed run continues history pages that were started, watermarks would only see their newest rows
+        backfilling = {stock for stock, endpoint in ledger.completed if is_page_endpoint(endpoint)}
+
+        units = []
+        if FINANCIAL_REPORT_LISTING == 'bulk':
+            # One market-wide listing per (year, period) that some stock is still missing
+            for year in report_years():
+                for period in REPORT_PERIODS:
+                    key = listing_key(year, period)
+                    if all(watermarks.has_report(stock, period, year) for stock in stock_list):
+                        continue
+                    if not ledger.is_done(key, LISTING_ENDPOINT) and (key, LISTING_ENDPOINT) not in dead_letter_units:
+                        units.append((PRIORITY_FINANCIAL_REPORT, key, LISTING_ENDPOINT))
+
+        for stock in stock_list:
+            if stock in backfilling and not backfill_pages.is_done(stock):
+                units.extend(backfill_pages.initial_units(stock))
+            for priority, endpoint in [
+                (PRIORITY_TRADING_TODAY, 'TradingInfo'),
+                (PRIORITY_PROFILE, 'CompanyProfiles'),
+                (PRIORITY_FINANCIAL_REPORT, 'FinancialReportLinks'),
+            ]:
+                if endpoint == 'TradingInfo' and (trading_plan[stock] not in ('backfill', 'fetch') or stock in backfilling):
+                    continue
+                if endpoint == 'FinancialReportLinks' and FINANCIAL_REPORT_LISTING == 'bulk':
+                    continue
+                if not ledger.is_done(stock, endpoint) and (stock, endpoint) not in dead_letter_units:
+                    units.append((priority, stock, endpoint))
+
+        return units, frames
+
+    return stock_list, watermarks, calendar, plan_units
+
+async def scrape_stock_details_async(idx_session, BEIStockSummaryDF, resume):
+    stock_list, watermarks, calendar, plan_units = plan_stock_details(BEIStockSummaryDF)
+
+    await run_stock_units(idx_session, 'IDXStocks', stock_list, resume, watermarks, calendar, plan_units)
+
+def scrape_stock_details(idx_session, BEIStockSummaryDF, resume=False):
+    print("Start Scrape Stock Details and Export Result")
+    asyncio.run(scrape_stock_details_async(idx_session, BEIStockSummaryDF, resume))
+    print("End Scrape Stock Details and Export Result")
+
+# ### Distributed Run
+# 
+# Several worker processes (one machine or many) share one run through a task table in the DB (see
+# bei_ksei/task_queue.py). The coordinator plans the run from the stock summary like the daily run, writes the
+# summary rows and seeds the units, every worker claims units, scrapes them and writes its own batches:
+# 
+#   python "01 - IDX Stocks.py" --coordinator
+#   python "01 - IDX Stocks.py" --worker      (as many as needed, on any machine with access to the DB)
+
+def seed_stock_tasks(BEIStockSummaryDF):
+    stock_list, watermarks, calendar, plan_units = plan_stock_details(BEIStockSummaryDF)
+
+    ledger = RunLedger(get_engine(), job='IDXStocks')
+    run_id = ledger.start()
+    dead_letter_units = pending_dead_letters(DeadLetters(get_engine(), job='IDXStocks'), set(stock_list))
+    backfill_pages = BackfillPages(ledger, PRIORITY_BACKFILL)
+    for stock, endpoint in dead_letter_units:
+        if is_page_endpoint(endpoint):
+            backfill_pages.mark_queued(stock, page_start(endpoint))
+    units, frames = plan_units(ledger, backfill_pages, dead_letter_units)
+
+    for table, df, frame_units in frames:
+        if len(df) > 0:
+            write_batch(table, df)
+        ledger.mark_done(frame_units)
+
+    # Workers load their own watermarks, the calendar and the stock list come from the coordinator
+    context = {'latest_session': calendar.latest_session.isoformat(), 'stocks': stock_list}
+    task_queue = TaskQueue(get_engine(), job='IDXStocks')
+    task_queue.seed(run_id, context, [(PRIORITY_DEAD_LETTER, stock, endpoint) for stock, endpoint in dead_letter_units] + units)
+    print(f'Run {run_id}: {len(dead_letter_units) + len(units)} units seeded for {len(stock_list)} stocks')
+
+    return run_id
+
+async def work_stock_tasks_async(idx_session, wait_seconds):
+    task_queue = TaskQueue(get_engine(), job='IDXStocks')
+    run = await asyncio.to_thread(task_queue.current_run)
+    while run is None and wait_seconds > 0:
+        # Workers can be started before the coordinator has seeded the run
+        await asyncio.sleep(TASK_POLL_SECONDS)
+        wait_seconds -= TASK_POLL_SECONDS
+        run = await asyncio.to_thread(task_queue.current_run)
+    if run is None:
+        print('No seeded run to work on')
+        return
+    run_id, context = run
+    print(f'Worker {task_queue.worker_id} joined run {run_id}')
+
+    ledger = RunLedger(get_engine(), job='IDXStocks')
+    ledger.join(run_id)
+    dead_letters = DeadLetters(get_engine(), job='IDXStocks')
+    listed_stocks = set(context['stocks'])
+    watermarks = load_watermarks(get_engine(), min_year=datetime.now().year-2)
+    calendar = load_trading_calendar(get_engine(), pd.Timestamp(context['latest_session']))
+    backfill_pages = BackfillPages(ledger, PRIORITY_BACKFILL)
+
+    response_cache = idx_session.response_cache
+    unit_responses = {}
+
+    def commit_units(units):
+        ledger.mark_done(units)
+        task_queue.complete(units)
+        if response_cache is not None:
+            response_cache.mark_stored([response for unit in units for response in unit_responses.pop(unit, [])])
+
+        # The pages of a stock are split over the workers, no worker sees them all. The history is complete once no
+        # page task of the stock is left in the task table (a full page queues the next one when it completes)
+        paged_stocks = {stock for stock, endpoint in units if is_page_endpoint(endpoint)}
+        ledger.mark_done([(stock, BACKFILL_DONE) for stock in paged_stocks if task_queue.all_done(stock, PAGE_ENDPOINT + ':')])
+
+    def on_failed(stock, endpoint, e):
+        dead_letters.add([(stock, endpoint, e)])
+
+    def fail_units(units, e):
+        # The units of a failed batch are released right away instead of staying leased until the lease expires
+        for stock, endpoint in units:
+            unit_responses.pop((stock, endpoint), None)
+            if task_queue.fail(stock, endpoint, e):
+                on_failed(stock, endpoint, e)
+
+    # Leases are renewed until the writer's last batch is committed, its units stay leased to this worker
+    async with keep_leases(task_queue), FetchEngine(max_concurrency=num_workers, idx_session=idx_session, response_cache=response_cache) as fetcher, BatchWriter(write_batch, on_commit=commit_units, on_error=fail_units) as writer:
+        # Follow-up units (history pages, per stock fallbacks) go to the task table instead of a local queue
+        async def handler(task_queue, stock, endpoint):
+            responses = []
+            unit = (stock, endpoint)
+            result = await load_stock_unit(task_queue, fetcher, watermarks, calendar, backfill_pages, listed_stocks, stock, endpoint, responses)
+            if result is None:
+                # The unit queued other units instead, they are inserted with its completion
+                await asyncio.to_thread(task_queue.complete, [unit])
+                return
+
+            unit_responses[unit] = responses
+            units = [unit]
+            if len(result) > 0:
+                await writer.put(endpoint_tables[endpoint.split(':')[0]], result, units=units)
+            else:
+                await asyncio.to_thread(commit_units, units)
+            metrics.inc('units_completed_total', unit=endpoint.split(':')[0])
+            print(f"Stock {stock} {endpoint} processed, {metrics.total('units_completed_total')} units completed by this worker")
+
+        await run_worker(task_queue, handler, num_workers, on_failed=on_failed)
+        print('Achieved requests/sec:', fetcher.rates())
+
+    print('Rows written:', writer.written_rows)
+    counts = task_queue.counts()
+    print(f'Run {run_id}:', counts)
+    if task_queue.outstanding() == 0:
+        # Last worker out closes the run, dead letters that were retried in it are resolved. Failed units don't keep
+        # it open: they are dead-lettered and retried by the next run, new workers don't attach to a stale run
+        dead_letters.resolve(task_queue.units('done', priority=PRIORITY_DEAD_LETTER))
+        ledger.finish()
+
+def work_stock_tasks(idx_session, wait_seconds=60):
+    print("Start Stock Details Worker")
+    asyncio.run(work_stock_tasks_async(idx_session, wait_seconds))
+    print("End Stock Details Worker")
+
+# ### Trading History Backfill
+# 
+# New listings and a fresh database: the full trading history of every stock without stored history (or the
+# given stocks), as start/length pages fetched concurrently and checkpointed page by page.
 
-# ### Export SQL
-def export_sql(df, name, if_exists='replace'):
-    engine = create_engine(
-        "postgresql://{}:{}@{}/{}".format(
-            os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
-        )
-    )
-    conn = engine.connect()
+async def backfill_trading_info_async(idx_session, stock_list, resume):
+    watermarks = load_watermarks(get_engine(), min_year=datetime.now().year-2)
 
-    df.to_sql(name, con=conn, if_exists=if_exists, index=False)
+    def plan_units(ledger, backfill_pages, dead_letter_units):
+        units = []
+        for stock in stock_list:
+            # Initial pages are queued right away, lookahead keeps more queued as pages come in
+            if not backfill_pages.is_done(stock):
+                units.extend(backfill_pages.initial_units(stock))
 
-# ### Data Transformation
+        return units, []
 
-CompanyProfilesDF = pd.concat(results_dict['CompanyProfiles']).reset_index(drop=True).drop(
-    columns=[
-        'DataID', 'Divisi', 'EfekEmiten_EBA', 'EfekEmiten_ETF', 
-        'EfekEmiten_Obligasi', 'EfekEmiten_SPEI', 'EfekEmiten_Saham',
-        'id', 'KodeDivisi', 'JenisEmiten', 'KodeEmiten', 'Status'
-    ]
-)
-CompanyProfilesDF['TanggalPencatatan'] = pd.to_datetime(CompanyProfilesDF['TanggalPencatatan']).dt.normalize()
-CompanyProfilesDF['Logo'] = ['https://www.idx.co.id' + logo for logo in CompanyProfilesDF['Logo']]
-CompanyProfilesDF['LastScraped'] = datetime.now()
-
-export_sql(CompanyProfilesDF, 'IDXCompanyProfiles')
-del CompanyProfilesDF
-results_dict['CompanyProfiles'] = None
-gc.collect()
-
-TradingInfoDF = pd.concat(results_dict['TradingInfo']).drop(columns=['No', 'Remarks']).reset_index(drop=True)
-TradingInfoDF['Date'] = pd.to_datetime(TradingInfoDF['Date'])
-TradingInfoDF['LastScraped'] = datetime.now()
-TradingInfoDF
-
-export_sql(TradingInfoDF, 'IDXTradingInfo', if_exists='append')
-del TradingInfoDF
-results_dict['TradingInfo'] = None
-gc.collect()
-
-FinancialReportLinksDF = pd.concat(results_dict['FinancialReportLinks']).reset_index(drop=True).drop(
-    columns=['File_ID', 'File_Size', 'File_Type']
-)
-FinancialReportLinksDF['File_Modified'] = pd.to_datetime(FinancialReportLinksDF['File_Modified']).dt.normalize()
-FinancialReportLinksDF['File_Path'] = 'https://www.idx.co.id/' + FinancialReportLinksDF['File_Path']
-FinancialReportLinksDF['LastScraped'] = datetime.now()
-FinancialReportLinksDF
+    await run_stock_units(idx_session, 'IDXTradingBackfill', stock_list, resume, watermarks, None, plan_units)
 
-export_sql(FinancialReportLinksDF, 'IDXFinancialReportLinks', if_exists='append')
-del FinancialReportLinksDF, results_dict
-gc.collect()
+def backfill_trading_info(idx_session, stock_list, resume=False):
+    print(f"Start Trading History Backfill of {len(stock_list)} stocks")
+    asyncio.run(backfill_trading_info_async(idx_session, stock_list, resume))
+    print("End Trading History Backfill")
 
 # # Export Result
 
@@ -336,4 +667,50 @@ gc.collect()
 #     FinancialReportLinksDF.to_excel(writer, sheet_name='Financial Reports', index=False)
 
 # ## Export to DB
+# 
+# Done by the writer stage while scraping, see Run Work Queue with Progress Status
 
+# # Main
+# 
+# run_all.py imports this script and runs the summary and details as separate jobs, running it directly does both
+# 
+# --resume: continue the last unfinished run, units already committed are skipped
+# --backfill: full trading history of every stock without stored history (or of --stocks), as concurrent pages
+
+def main(resume=False, backfill=False, stocks=None, coordinator=False, worker=False):
+    # Old to_sql tables get their natural key index (duplicates removed) before the first batch
+    migrate_natural_keys(tables=sorted(set(endpoint_tables.values())))
+
+    print("Initialize IDX Session")
+    # A worker is one of many processes, it keeps a single browser for challenges
+    idx_session = IDXSession(pool_size=1 if worker else 6, response_cache=get_response_cache())
+
+    if coordinator or worker:
+        if coordinator:
+            seed_stock_tasks(scrape_stock_summary(idx_session))
+        if worker:
+            work_stock_tasks(idx_session)
+    elif backfill:
+        if not stocks:
+            watermarks = load_watermarks(get_engine(), min_year=datetime.now().year)
+            stocks = [stock for stock in scrape_stock_summary(idx_session)['StockCode'] if watermarks.max_date(stock) is None]
+        backfill_trading_info(idx_session, stocks, resume=resume)
+    else:
+        BEIStockSummaryDF = scrape_stock_summary(idx_session)
+        scrape_stock_details(idx_session, BEIStockSummaryDF, resume=resume)
+
+    idx_session.close()
+    print(f"IDX Session: {idx_session.handshake_count} browser handshakes, {idx_session.browser_fallback_count} browser fallbacks")
+    close_browser_pool()
+    write_run_report('IDXStocks')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--backfill', action='store_true')
+    parser.add_argument('--stocks', nargs='+')
+    parser.add_argument('--coordinator', action='store_true', help='seed a distributed run')
+    parser.add_argument('--worker', action='store_true', help='work on the seeded distributed run')
+    args, _ = parser.parse_known_args()
+
+    main(resume=args.resume, backfill=args.backfill, stocks=args.stocks, coordinator=args.coordinator, worker=args.worker)
@@ -1,6 +1,16 @@
 # Code History:
 # 1. Version 1.0 (2023/03/09):
 # - Base version, working as expected
+# 2. Version 1.1 (2026/10/18):
+# - Summary fetches use a bounded retry policy (exponential backoff + jitter) instead of retrying forever.
+# - Chrome driver is leased from the shared browser pool instead of being started by the script.
+# - Script body moved into functions with a main(), so run_all.py can run it as a job. DB connection comes from the shared engine.
+# - Dates are parsed through the shared memoized date parser (bei_ksei/dates.py).
+# - Scraped summaries also go to the other configured sinks (SINKS=postgres,parquet), Parquet is partitioned by index code and year.
+# - Dropped columns, renames and dtypes (category index codes, float index levels, datetime64 dates) come from the table schemas (bei_ksei/schemas.py).
+# - Only the new snapshot is appended to the history tables (keyed on IndexCode + DTCreate), instead of reading the whole history and writing it back with to_sql replace.
+# - Request counts, latency, retries, JSON parse and DB write times per endpoint are recorded in bei_ksei/metrics.py and written as a Prometheus textfile and a JSON run summary (METRICS_DIR).
+# - Summaries are fetched through the IDX session (browser handshake once, then keep-alive JSON GETs) and kept in the response cache, so RESPONSE_CACHE_OFFLINE=1 replays this script too.
 
 # <strong>Features:</strong>
 # - Scrape IDX stock sectoral summary
@@ -8,46 +18,24 @@
 # 
 # Plan: Data is scraped <strong>every weekday on 6PM GMT+7</strong>, few hours after the market has closed for the day. So the data you see before 6PM is previous trading day data.
 
-import json
-from json.decoder import JSONDecodeError
 import pandas as pd
-import time
 from datetime import datetime
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-import threading
-import concurrent.futures
-from tqdm import tqdm
-import os
-import sqlalchemy
-from sqlalchemy import create_engine
-
-# # Chrome Selenium Starter
-# 
-# Why Selenium? Because I need it to bypass cloudfare restriction
-
-# Initialize the Chrome driver
-
-print("Start Initialize Chrome Driver!")
-options = Options()
-options.add_argument("--headless=new")
-options.add_argument("--no-sandbox")
-driver = webdriver.Chrome(options=options)
-print("Initialize Chrome Driver Done!")
 
+from bei_ksei.browser_pool import close_browser_pool
+from bei_ksei.db_sink import migrate_natural_keys
+from bei_ksei.idx_session import IDXSession
+from bei_ksei.index_history import append_snapshot
+from bei_ksei.metrics import write_run_report
+from bei_ksei.response_cache import get_response_cache
+from bei_ksei.schemas import apply_schema
 
-# # Scrape Summary URL
-
-engine = create_engine(
-    "postgresql://{}:{}@{}/{}".format(
-        os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
-    )
-)
-conn = engine.connect()
+# # IDX Session
+# 
+# Why Selenium? Because I need it to bypass cloudfare restriction
+# 
+# The browser only passes the cloudfare check once, the summaries are then fetched with the keep-alive HTTP session
+# of the IDX session (created in main, or shared by run_all.py). Its bounded retry policy replaces the old retry
+# loop, and both responses go to the response cache: always fetched online (TTL 0), replayed offline.
 
 # ## URL List
 
@@ -56,74 +44,59 @@ urls = {
     'BEIIndexSummary':'https://www.idx.co.id/primary/StockData/GetConstituent',
 }
 
-# ## BEI Sectoral Summary
-while True:
-    try:
-        print("Start Scrape Sectoral and Index Summary")
-        driver.get(urls['BEISectoralSummary'])
-        WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-        BEISectoralSummaryContent = driver.find_element(By.TAG_NAME, value='body').text
-
-        BEISectoralSummaryDF = pd.DataFrame(json.loads(BEISectoralSummaryContent)['data']).drop(columns='IntRow')
-        BEISectoralSummaryDF['DTCreate'] = pd.to_datetime(BEISectoralSummaryDF['DTCreate']).dt.normalize()
-        BEISectoralSummaryDF['LastScraped'] = datetime.now()
-        BEISectoralSummaryDF
-        break
-    except JSONDecodeError as e:
-        time.sleep(1.5)
-
-PrevSectoralSummary = pd.read_sql('BEISectoralSummary', con=conn)
-BEISectoralSummaryDF = pd.concat(
-    [BEISectoralSummaryDF, PrevSectoralSummary]
-).sort_values(
-    by=['DTCreate', 'LastScraped']
-).drop_duplicates(
-    subset=['IndexCode', 'DTCreate'],
-    keep='first'
-)
-BEISectoralSummaryDF
-
-# ## BEI Index Summary
-
-while True:
-    try:
-        driver.get(urls['BEIIndexSummary'])
-        WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-        BEIIndexSummaryContent = driver.find_element(By.TAG_NAME, value='body').text
-
-        BEIIndexSummaryDF = pd.DataFrame(json.loads(BEIIndexSummaryContent)['Items']).drop(columns='Links')
-        BEIIndexSummaryDF['DtCreate'] = pd.to_datetime(BEIIndexSummaryDF['DtCreate']).dt.normalize()
-        BEIIndexSummaryDF = BEIIndexSummaryDF.rename(columns={'DtCreate':'DTCreate'})
-        BEIIndexSummaryDF['LastScraped'] = datetime.now()
-        BEIIndexSummaryDF
-        break
-    except JSONDecodeError as e:
-        time.sleep(1.5)
-
-PrevIndexSummary = pd.read_sql('BEIIndexSummary', con=conn)
-BEIIndexSummaryDF = pd.concat(
-    [BEIIndexSummaryDF, PrevIndexSummary]
-).sort_values(
-    by=['DTCreate', 'LastScraped']
-).drop_duplicates(
-    subset=['IndexCode', 'DTCreate'],
-    keep='first'
-)
-BEIIndexSummaryDF
-
-# ## Close and Quit Driver
-
-driver.quit()
-print("End Scrape Sectoral and Index Summary")
-# # Export Result
-print("Export Result")
-# ## Export to Excel
-
-# with pd.ExcelWriter('stock_index_sectoral.xlsx') as writer:
-#     BEISectoralSummaryDF.to_excel(writer, sheet_name='Sectoral Summary', index=False)
-#     BEIIndexSummaryDF.to_excel(writer, sheet_name='Index Summary', index=False)
-
-# ## Export to DB
-
-BEISectoralSummaryDF.to_sql('BEISectoralSummary', con=conn, if_exists='replace', index=False)
-BEIIndexSummaryDF.to_sql('BEIIndexSummary', con=conn, if_exists='replace', index=False)
\ No newline at end of file
+# # Scrape Summary URL
+
+def scrape_sectoral_and_index(idx_session):
+    # ## BEI Sectoral Summary
+    print("Start Scrape Sectoral and Index Summary")
+    BEISectoralSummaryContent = idx_session.get_json(urls['BEISectoralSummary'])
+
+    # Dropped columns, renames and dtypes come from the table schemas (bei_ksei/schemas.py)
+    BEISectoralSummaryDF = apply_schema('BEISectoralSummary', pd.DataFrame(BEISectoralSummaryContent['data']))
+    BEISectoralSummaryDF['LastScraped'] = datetime.now()
+
+    # ## BEI Index Summary
+
+    BEIIndexSummaryContent = idx_session.get_json(urls['BEIIndexSummary'])
+
+    BEIIndexSummaryDF = apply_schema('BEIIndexSummary', pd.DataFrame(BEIIndexSummaryContent['Items']))
+    BEIIndexSummaryDF['LastScraped'] = datetime.now()
+
+    print("End Scrape Sectoral and Index Summary")
+    # # Export Result
+    print("Export Result")
+    # ## Export to Excel
+
+    # with pd.ExcelWriter('stock_index_sectoral.xlsx') as writer:
+    #     BEISectoralSummaryDF.to_excel(writer, sheet_name='Sectoral Summary', index=False)
+    #     BEIIndexSummaryDF.to_excel(writer, sheet_name='Index Summary', index=False)
+
+    # ## Export to DB
+    # 
+    # Only today's snapshot is appended to the history, a day that is already stored keeps its first scraped rows
+    # (see bei_ksei/index_history.py). Goes to the other configured sinks too.
+
+    written = append_snapshot('BEISectoralSummary', BEISectoralSummaryDF)
+    print(f"BEISectoralSummary: {written} new rows")
+    written = append_snapshot('BEIIndexSummary', BEIIndexSummaryDF)
+    print(f"BEIIndexSummary: {written} new rows")
+
+# # Main
+# 
+# run_all.py imports this script and runs it as a job next to the stock and bond jobs
+
+def main():
+    # Old to_sql tables get their natural key index (duplicates removed) before the first batch
+    migrate_natural_keys(tables=list(urls))
+
+    print("Initialize IDX Session")
+    idx_session = IDXSession(pool_size=1, response_cache=get_response_cache())
+
+    scrape_sectoral_and_index(idx_session)
+
+    idx_session.close()
+    close_browser_pool()
+    write_run_report('IDXStockSectoralAndIndex')
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,80 @@
 # Code History:
 # 1. Version 1.0 (2023/03/09):
 # - Base version, working as expected
+# 2. Version 1.1 (2026/10/18):
+# - Bond details are fetched by the shared async fetch engine, request pace is set by a per-host rate limit instead of fixed sleeps.
+# - Fetches use a bounded retry policy (exponential backoff + jitter), bonds that still fail go to a dead-letter table and are retried first on the next run.
+# - Chrome driver is leased from the shared browser pool instead of being started by the script.
+# - Bond details are merged on Short Code through COPY + INSERT ... ON CONFLICT, instead of rewriting the whole table.
+# - Script body moved into functions with a main(), so run_all.py can run it as a job.
+# - Fixed the previous-bond check (it tested the Series index, not the Short Codes). Only new bonds and bonds whose summary fingerprint changed are fetched.
+# - Bond pages are parsed from the deflist block with lxml instead of a full BeautifulSoup html.parser tree.
+# - Dates are parsed once per unique string with explicit formats after mapping Indonesian month names, dateparser is only the fallback.
+# - Bond pages are kept in the on-disk response cache for a day.
+# - Bond details go to every configured sink (SINKS=postgres,parquet), Parquet snapshots are partitioned by year.
+# - Dropped columns and dtypes (float32 rate, datetime64 dates) come from the BondDetails table schema (bei_ksei/schemas.py).
+# - Request counts, latency, retries, JSON parse and DB write times per endpoint are recorded in bei_ksei/metrics.py and written as a Prometheus textfile and a JSON run summary (METRICS_DIR).
+# - Bond lists are fetched through the IDX session (browser handshake once, then keep-alive JSON GETs) and kept in the response cache, so RESPONSE_CACHE_OFFLINE=1 replays this script too.
 
 # <strong>Features:</strong>
 # - Scrape corporate and government bonds summary and details
 # 
 # Plan: Data is scraped <strong>every weekday on 6PM GMT+7</strong>, few hours after the market has closed for the day. So the data you see before 6PM is previous trading day data.
 
-import json
-from json.decoder import JSONDecodeError
 import numpy as np
 import pandas as pd
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
+import asyncio
 from datetime import datetime
-from selenium import webdriver
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-import queue
-import threading
-import requests
-from bs4 import BeautifulSoup
 from tqdm import tqdm
-import dateparser
 
-import os
-import sqlalchemy
-from sqlalchemy import create_engine
-
-# # Chrome Selenium Starter
+from bei_ksei.db_sink import get_engine, migrate_natural_keys
+from bei_ksei.bond_cache import BondCache
+from bei_ksei.bond_page import parse_bond_details
+from bei_ksei.browser_pool import close_browser_pool
+from bei_ksei.dates import parse_dates
+from bei_ksei.dead_letters import DeadLetters
+from bei_ksei.fetch_engine import FetchEngine
+from bei_ksei.idx_session import IDXSession
+from bei_ksei.metrics import endpoint_name, write_run_report
+from bei_ksei.response_cache import get_response_cache
+from bei_ksei.retry_policy import RetryExhausted
+from bei_ksei.schemas import apply_schema
+from bei_ksei.sinks import write_to_sinks
+
+# # IDX Session
 # 
 # Why Selenium? Because I need it to bypass cloudfare restriction
+# 
+# The browser only passes the cloudfare check once, the bond lists are then fetched with the keep-alive HTTP session
+# of the IDX session (created in main, or shared by run_all.py) and kept in the response cache (replayed offline)
 
-# Initialize the Chrome driver
-print("Start Initialize Chrome Driver!")
-options = Options()
-options.add_argument("--headless=new")
-options.add_argument("--no-sandbox")
-driver = webdriver.Chrome(options=options)
-print("Initialize Chrome Driver Done!")
 # # Scrape Bond Summary
 
 # ## BEI Bonds List
-print("Start Scrape Bond Summary")
 urls = {
     'Corporate Bond':'https://www.idx.co.id/secondary/get/BondSukuk/bond?pageSize=10000&indexFrom=1&bondType=1',
     'Goverment Bond':'https://www.idx.co.id/secondary/get/BondSukuk/bond?pageSize=10000&indexFrom=1&bondType=2'  
 }
 
-BEIBondsListDF = pd.DataFrame()
-for issuer_type in urls:
-    print(issuer_type)
-    driver.get(urls[issuer_type])
-    WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
-    BEIBondsListContent = driver.find_element(By.TAG_NAME, value='body').text
-    BEIBondsTypeListDF = pd.DataFrame(json.loads(BEIBondsListContent)['Results']).drop(columns='Nomor')
-    BEIBondsTypeListDF['IssuerType'] = issuer_type
-    
-    BEIBondsListDF = pd.concat([BEIBondsListDF, BEIBondsTypeListDF])
-    
-BEIBondsListDF['MatureDate'] = pd.to_datetime(BEIBondsListDF['MatureDate']).dt.normalize()
+def get_bonds_list(idx_session, url):
+    return idx_session.get_json(url)['Results']
+
+def scrape_bond_summary(idx_session):
+    print("Start Scrape Bond Summary")
+    BEIBondsListDF = pd.DataFrame()
+    for issuer_type in urls:
+        print(issuer_type)
+        BEIBondsListContent = get_bonds_list(idx_session, urls[issuer_type])
+        BEIBondsTypeListDF = pd.DataFrame(BEIBondsListContent).drop(columns='Nomor')
+        BEIBondsTypeListDF['IssuerType'] = issuer_type
+
+        BEIBondsListDF = pd.concat([BEIBondsListDF, BEIBondsTypeListDF])
 
-BEIBondsListDF
+    BEIBondsListDF['MatureDate'] = parse_dates(BEIBondsListDF['MatureDate']).dt.normalize()
 
-# ## Close and Quit Driver
+    print("End Scrape Bond Summary")
 
-driver.close()
-driver.quit()
-print("End Scrape Bond Summary")
+    return BEIBondsListDF
 
 # # Scrape Bond Details
 
@@ -82,124 +87,141 @@ print("End Scrape Bond Summary")
 # 'https://www.ksei.co.id/services/registered-securities/medium-term-notes/lc/ABLS01XXMF'
 # 'https://www.ksei.co.id/services/registered-securities/government-bonds/lc/FR0037'
 
-def get_bond_details(BondId):
-    while True:
-        try:
-            url = 'https://www.ksei.co.id/services/registered-securities/corporate-bonds/lc/' + BondId
-            response = requests.get(url)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            data = {}
-
-            # Find the dl tag with class="deflist deflist--with-colon"
-            dl_tag = soup.find('dl', class_='deflist deflist--with-colon')
-
-            # Loop through all dt tags within the dl tag and get their text values
-            dt_tags = dl_tag.find_all('dt')
-            for dt in dt_tags:
-                # Get the text value of the dt tag
-                dt_text = dt.get_text(strip=True)
-                # Get the corresponding dd tag and its text value
-                # find_next_sibling is actually an important function and it's new for me xD
-                dd_text = dt.find_next_sibling('dd').get_text(strip=True)
-                # Add the dd_text to the data dictionary with the dt_text as the key
-                data[dt_text] = dd_text
-            break
-        except:
-            time.sleep(1.5)
-    
-    time.sleep(1)
-    return data
-
-# ## Multithreading with Progress Bar
+# The bond details are parsed straight from the deflist block with lxml (see bei_ksei/bond_page.py),
+# benchmarks/bond_pages.py compares it with the old BeautifulSoup html.parser version
+
+async def get_bond_details(fetcher, BondId):
+    url = 'https://www.ksei.co.id/services/registered-securities/corporate-bonds/lc/' + BondId
+
+    async def get_bond_details_once():
+        # Only pages with the details block are kept in the response cache
+        content = await fetcher.get_bytes(url, endpoint='KSEIBondDetails', validate=parse_bond_details)
+        return parse_bond_details(content)
+
+    # A page without the definition list (AttributeError) is fetched again, bounded by the retry policy
+    return await fetcher.retry_policy.call_async(BondId, get_bond_details_once, retry_on=(AttributeError,), endpoint=endpoint_name(url))
 
 # ## Load Previous Scraped Data
+# 
+# Only the Short Codes and summary fingerprints are loaded (see bei_ksei/bond_cache.py), not the whole table
 
-def read_sql():
-    engine = create_engine(
-        "postgresql://{}:{}@{}/{}".format(
-            os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
-        )
-    )
-    conn = engine.connect()
+# ## Async Workers with Progress Bar
 
-    prev_bond_details_df = pd.read_sql('SELECT * FROM \"BondDetails\"', con=conn)
+async def load_bond_details(fetcher, BondId):
+    try:
+        return BondId, await get_bond_details(fetcher, BondId)
+    except RetryExhausted as e:
+        return BondId, e
 
-    return prev_bond_details_df
+async def scrape_bond_details_async(bond_ids, df_list, failed_bonds):
+    async with FetchEngine(response_cache=get_response_cache()) as fetcher:
+        tasks = []
+        
+        for BondId in bond_ids:
+            tasks.append(load_bond_details(fetcher, BondId))
 
-prev_bond_details_df = read_sql()
+        # Use tqdm to add a progress bar to the async workers
+        with tqdm(total=len(tasks)) as pbar:
+            for task in asyncio.as_completed(tasks):
+                BondId, result = await task
+                if isinstance(result, RetryExhausted):
+                    failed_bonds.append((BondId, 'BondDetails', result))
+                else:
+                    df_list.append(result)
+                pbar.update(1)
 
-# ## Create List to Store Scraped Data
+        print('Achieved requests/sec:', fetcher.rates())
 
-df_list = []
+def scrape_bond_details(BEIBondsListDF):
+    # Only new bonds and bonds whose summary changed are fetched
+    bond_cache = BondCache.load(get_engine())
+    fingerprints, hits, misses, refresh = bond_cache.plan(BEIBondsListDF)
+    print(f'Bond cache: {len(hits)} hit, {len(misses)} missed, {len(refresh)} refreshed')
 
-print("Start Scrape Bond Details")
-with tqdm(total=len(BEIBondsListDF['BondId'])) as pbar:
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        futures = []
-        
-        for BondId in BEIBondsListDF['BondId']:
-            if BondId in prev_bond_details_df['Short Code']:
-                continue
-            else:
-                future = executor.submit(get_bond_details, BondId)
-                futures.append(future)
-
-        # Use tqdm to add a progress bar to the multithreading process
-        for future in as_completed(futures):
-            pbar.update(1)
-            df_list.append(future.result())
-
-print("End Scrape Bond Details")
-# ## Join All Bond Details and Cleaning
+    # ## Create List to Store Scraped Data
+
+    df_list = []
+    failed_bonds = []
+
+    # Bonds that kept failing last time are retried first
+    dead_letters = DeadLetters(get_engine(), job='KSEIBonds')
+    dead_letter_bonds = [BondId for BondId, endpoint in dead_letters.pending()]
+
+    bond_ids = [BondId for BondId in dead_letter_bonds if BondId in fingerprints]
+    bond_ids += [BondId for BondId in misses + refresh if BondId not in dead_letter_bonds]
 
-# ### Join Bond Details
+    print("Start Scrape Bond Details")
+    asyncio.run(scrape_bond_details_async(bond_ids, df_list, failed_bonds))
 
-BondDetailsDF = pd.DataFrame(df_list)
-BondDetailsDF
+    failed_bond_ids = {BondId for BondId, endpoint, e in failed_bonds}
+    dead_letters.add(failed_bonds)
+    dead_letters.resolve([(BondId, 'BondDetails') for BondId in dead_letter_bonds if BondId not in failed_bond_ids])
+    print(f'Dead letters: {len(dead_letter_bonds)} retried, {len(failed_bonds)} failed in this run')
 
-BondDetailsDF.columns
+    print("End Scrape Bond Details")
+
+    return df_list, fingerprints
+
+# ## Join All Bond Details and Cleaning
 
 # ### Data Transformation
 # 
-# 1. Some dates are written in Indonesian format string, 'May' is written as 'Mei', so I use dateparser library to tackle this issue and convert it to pandas datetime column
+# 1. Some dates are written in Indonesian format string, 'May' is written as 'Mei', parse_dates (bei_ksei/dates.py) maps the month names and parses every unique date once, dateparser is only the fallback
 # 2. Interest rate format is string, convert it to float32
 # 3. Replace '-' string with NaN
+# 4. Dropped columns and dtypes come from the table schema (bei_ksei/schemas.py)
 
-print("Data Transformation")
-BondDetailsDF['Listing Date'] = BondDetailsDF['Listing Date'].apply(lambda x: dateparser.parse(x) if x != '-' else np.nan)
-BondDetailsDF['Mature Date'] = BondDetailsDF['Mature Date'].apply(lambda x: dateparser.parse(x) if ((x != '-') and (type(x) == str)) else np.nan)
-BondDetailsDF['Effective Date ISIN'] = BondDetailsDF['Effective Date ISIN'].apply(lambda x: dateparser.parse(x) if x != '-' else np.nan)
-BondDetailsDF['Interest/Disc Rate'] = BondDetailsDF['Interest/Disc Rate'].replace('%', '', regex=True).apply('float32')
-BondDetailsDF = BondDetailsDF.replace('-', np.nan)
+def transform_bond_details(df_list, fingerprints):
+    # ### Join Bond Details
+    BondDetailsDF = pd.DataFrame(df_list)
 
-BondDetailsDF.describe(include='all')
+    print("Data Transformation")
+    BondDetailsDF['Interest/Disc Rate'] = BondDetailsDF['Interest/Disc Rate'].replace('%', '', regex=True)
+    BondDetailsDF = BondDetailsDF.replace('-', np.nan)
+    BondDetailsDF['SummaryFingerprint'] = BondDetailsDF['Short Code'].map(fingerprints)
+    BondDetailsDF['LastScraped'] = datetime.now()
 
-# ### Drop Unnecessary Columns
-# 
-# 1. Every column dropped has mostly missing value
-
-BondDetailsDF = BondDetailsDF.drop(columns=['Current Amount', 'Effective Date ISIN', 'Day Count Basis'])
+    return apply_schema('BondDetails', BondDetailsDF)
 
 # # Export Result
-print("Export Result")
-BondDetailsDF['LastScraped'] = datetime.now()
-BondDetailsDF = pd.concat([prev_bond_details_df, BondDetailsDF])
-BondDetailsDF
 
-# ## Export to Excel
+def scrape_bonds(idx_session):
+    BEIBondsListDF = scrape_bond_summary(idx_session)
+    df_list, fingerprints = scrape_bond_details(BEIBondsListDF)
+    if len(df_list) == 0:
+        print("No Bond Details to Export")
+        return
+
+    BondDetailsDF = transform_bond_details(df_list, fingerprints)
+
+    print("Export Result")
+
+    # ## Export to Excel
+
+    # BondDetailsDF.to_excel('bonds.xlsx', index=False)
+
+    # ## Export to DB
+    # 
+    # Only the scraped bonds are written, merged on Short Code (COPY into staging + INSERT ... ON CONFLICT)
+
+    write_to_sinks('BondDetails', BondDetailsDF)
+
+# # Main
+# 
+# run_all.py imports this script and runs it as a job next to the stock and index jobs
 
-# BondDetailsDF.to_excel('bonds.xlsx', index=False)
+def main():
+    # Old to_sql tables get their natural key index (duplicates removed) before the first batch
+    migrate_natural_keys(tables=['BondDetails'])
 
-# ## Export to DB
+    print("Initialize IDX Session")
+    idx_session = IDXSession(pool_size=1, response_cache=get_response_cache())
 
-def export_sql(df, name):
-    engine = create_engine(
-        "postgresql://{}:{}@{}/{}".format(
-            os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
-        )
-    )
-    conn = engine.connect()
+    scrape_bonds(idx_session)
 
-    df.to_sql(name, con=conn, if_exists='replace', index=False)
+    idx_session.close()
+    close_browser_pool()
+    write_run_report('KSEIBonds')
 
-export_sql(BondDetailsDF, 'BondDetails')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
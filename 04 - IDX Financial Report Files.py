@@ -0,0 +1,196 @@
+# Code History:
+# 1. Version 1.0 (2026/10/18):
+# - Base version: downloads the attachments of the financial report links stored in IDXFinancialReportLinks.
+# - Files are streamed to disk in chunks by the shared async fetch engine (per-host rate limit, bounded concurrency), never held in memory.
+# - A partial file (failed attempt, stopped run) is resumed with a Range request instead of being downloaded again.
+# - Files are deduplicated by SHA-256 content hash, an attachment whose content is already stored points to the stored copy.
+# - Local path, size and hash of every file are recorded in IDXFinancialReportFiles, only links without a record are downloaded.
+
+# <strong>Features:</strong>
+# - Download IDX financial report attachments (PDF / XLSX) to REPORT_FILES_DIR/<StockCode>/<Year>/<Period>/<Link Hash>/<File Name>
+#
+# Plan: Runs after the stock details (run_all.py job report_files), so new report links are downloaded the same night.
+
+import argparse
+import asyncio
+import hashlib
+import os
+from datetime import datetime
+from urllib.parse import unquote, urlsplit
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import text
+
+from bei_ksei.db_sink import get_engine, migrate_natural_keys
+from bei_ksei.fetch_engine import FetchEngine
+from bei_ksei.idx_session import IDXSession
+from bei_ksei.browser_pool import close_browser_pool
+from bei_ksei.metrics import write_run_report
+from bei_ksei.pipeline import BatchWriter
+from bei_ksei.schemas import apply_schema
+from bei_ksei.sinks import write_to_sinks
+from bei_ksei.work_queue import WorkQueue, PRIORITY_FINANCIAL_REPORT
+
+REPORT_FILES_DIR = os.getenv('REPORT_FILES_DIR', 'report_files')
+# Attachments are large, a few streams at a time already fill the IDX rate limit
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 4))
+
+# # Pending Links
+#
+# Links without a file record, newest reports first. A link whose download failed has no record either, so the next
+# run picks it up again (and resumes its partial file).
+
+def load_pending_links(engine, years=None, stocks=None):
+    inspector = sqlalchemy.inspect(engine)
+    if not inspector.has_table('IDXFinancialReportLinks'):
+        return pd.DataFrame(columns=['File_Path', 'StockCode', 'Report_Year', 'Report_Period'])
+
+    conditions = []
+    if inspector.has_table('IDXFinancialReportFiles'):
+        conditions.append('NOT EXISTS (SELECT 1 FROM "IDXFinancialReportFiles" f WHERE f."File_Path" = l."File_Path")')
+    if years:
+        # Report_Year is TEXT in tables created by the old to_sql export
+        conditions.append('CAST(l."Report_Year" AS INTEGER) IN :years')
+    if stocks:
+        conditions.append('l."StockCode" IN :stocks')
+
+    query = text('''
+        SELECT l."File_Path", l."StockCode", l."Report_Year", l."Report_Period" FROM "IDXFinancialReportLinks" l
+        {}
+        ORDER BY l."Report_Year" DESC, l."Report_Period", l."StockCode"
+    '''.format('WHERE ' + ' AND '.join(conditions) if conditions else ''))
+    params = {}
+    if years:
+        query = query.bindparams(sqlalchemy.bindparam('years', expanding=True))
+        params['years'] = [int(year) for year in years]
+    if stocks:
+        query = query.bindparams(sqlalchemy.bindparam('stocks', expanding=True))
+        params['stocks'] = list(stocks)
+
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+def load_stored_files(engine):
+    # Content hash -> local path of every recorded file
+    if not sqlalchemy.inspect(engine).has_table('IDXFinancialReportFiles'):
+        return {}
+
+    with engine.connect() as conn:
+        rows = conn.execute(text('SELECT "File_Hash", "Local_Path" FROM "IDXFinancialReportFiles"'))
+
+        return {file_hash: local_path for file_hash, local_path in rows}
+
+# # Download Files
+
+# Relative to REPORT_FILES_DIR, so the directory can be moved. Attachment names repeat within a report (every
+# report type has its own "Lampiran.pdf"), a short hash of the link keeps the path of every link its own
+def local_path(link):
+    file_name = unquote(os.path.basename(urlsplit(link['File_Path']).path))
+    link_hash = hashlib.sha256(link['File_Path'].encode('utf-8')).hexdigest()[:12]
+
+    return os.path.join(str(link['StockCode']), str(link['Report_Year']), str(link['Report_Period']), link_hash, file_name)
+
+def file_digest(path, chunk_size=1 << 20):
+    # Read back in chunks, a resumed file was written by more than one request
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+async def download_report_file(fetcher, stored_files, link):
+    path = local_path(link)
+    full_path = os.path.join(REPORT_FILES_DIR, path)
+
+    if not os.path.exists(full_path):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        partial_path = full_path + '.part'
+        await fetcher.download(link['File_Path'], partial_path, endpoint='ReportFile')
+        file_hash = await asyncio.to_thread(file_digest, partial_path)
+
+        stored_path = stored_files.get(file_hash)
+        if stored_path is not None and os.path.exists(os.path.join(REPORT_FILES_DIR, stored_path)):
+            # Same content as a stored file (e.g. an attachment uploaded again), only one copy is kept
+            os.remove(partial_path)
+            path = stored_path
+        else:
+            os.replace(partial_path, full_path)
+            stored_files[file_hash] = path
+    else:
+        # Downloaded by a run that stopped before the file was recorded
+        file_hash = await asyncio.to_thread(file_digest, full_path)
+        stored_files.setdefault(file_hash, path)
+
+    return pd.DataFrame([{
+        'File_Path': link['File_Path'], 'Local_Path': path, 'File_Bytes': os.path.getsize(os.path.join(REPORT_FILES_DIR, path)),
+        'File_Hash': file_hash, 'Downloaded': datetime.now(),
+    }])
+
+def write_batch(table, df):
+    written = write_to_sinks(table, apply_schema(table, df))
+    print(f"{table}: {written} rows written")
+
+async def download_report_files_async(idx_session, links):
+    stored_files = await asyncio.to_thread(load_stored_files, get_engine())
+    links_by_path = {link['File_Path']: link for link in links.to_dict('records')}
+    downloaded = {'files': 0, 'bytes': 0, 'deduplicated': 0}
+
+    # Records are flushed every 100 files, a stopped run loses at most a few records (their files are hashed again)
+    async with FetchEngine(max_concurrency=DOWNLOAD_CONCURRENCY, idx_session=idx_session) as fetcher, BatchWriter(write_batch, batch_rows=100) as writer:
+        async def handler(work_queue, file_path, endpoint):
+            link = links_by_path[file_path]
+            row = await download_report_file(fetcher, stored_files, link)
+            await writer.put('IDXFinancialReportFiles', row)
+
+            downloaded['files'] += 1
+            downloaded['bytes'] += int(row['File_Bytes'].iloc[0])
+            downloaded['deduplicated'] += int(row['Local_Path'].iloc[0] != local_path(link))
+            print(f"{link['StockCode']} {link['Report_Year']} {link['Report_Period']} {row['Local_Path'].iloc[0]} downloaded, {downloaded['files']}/{len(links_by_path)} files")
+
+        work_queue = WorkQueue(handler, DOWNLOAD_CONCURRENCY)
+        for file_path in links_by_path:
+            work_queue.put(PRIORITY_FINANCIAL_REPORT, file_path, 'ReportFile')
+
+        work_queue.install_signal_handlers()
+        await work_queue.run()
+
+        for file_path, endpoint, e in work_queue.errors:
+            print(file_path, 'failed:', repr(e))
+        print('Achieved requests/sec:', fetcher.rates())
+
+    print(f"Report files: {downloaded['files']} downloaded ({downloaded['bytes'] / 2 ** 20:.1f} MiB), {downloaded['deduplicated']} duplicates of stored files, {len(work_queue.errors)} failed (retried next run)")
+
+    return downloaded
+
+def download_report_files(idx_session, years=None, stocks=None):
+    links = load_pending_links(get_engine(), years=years, stocks=stocks)
+    print(f"Start Download of {len(links)} Financial Report Files")
+    downloaded = asyncio.run(download_report_files_async(idx_session, links))
+    print("End Download Financial Report Files")
+
+    return downloaded
+
+# # Main
+
+def main(years=None, stocks=None):
+    migrate_natural_keys(tables=['IDXFinancialReportFiles'])
+
+    # Attachments are behind the same cloudfare check as the JSON endpoints, the handshake cookies are reused
+    print("Initialize IDX Session")
+    idx_session = IDXSession(pool_size=1)
+
+    download_report_files(idx_session, years=years, stocks=stocks)
+
+    idx_session.close()
+    close_browser_pool()
+    write_run_report('IDXFinancialReportFiles')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', nargs='+', type=int)
+    parser.add_argument('--stocks', nargs='+')
+    args, _ = parser.parse_known_args()
+
+    main(years=args.years, stocks=args.stocks)
@@ -0,0 +1 @@
+# Shared helpers for the IDX and KSEI scraping scripts
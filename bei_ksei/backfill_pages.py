@@ -0,0 +1,114 @@
+# # Paginated Trading History Backfill
+#
+# A stock's full trading history used to be one GetTradingInfoSS request with length=10000: one huge response held
+# in memory, no way to resume it and no parallelism. The history is now fetched as start/length pages:
+# - every page is its own work queue unit (stock, 'TradingInfoPage:<start>'), pages of many stocks are fetched
+#   concurrently by the queue workers under the shared per-host rate limit
+# - pages go to the writer as soon as they arrive and are checkpointed in the run ledger, so --resume only
+#   fetches the pages that never made it to the DB
+# - the number of sessions is only known when the response has recordsTotal. Otherwise lookahead pages are kept
+#   queued ahead, every full page queues the next one and a short page marks the end of the history
+# - once every page up to the end is loaded, (stock, 'TradingInfoBackfill') is committed with the last page and
+#   a resumed run skips the stock
+#
+# Page size can be configured from env: BACKFILL_PAGE_SIZE
+
+import os
+import threading
+
+PAGE_ENDPOINT = 'TradingInfoPage'
+BACKFILL_DONE = 'TradingInfoBackfill'
+PAGE_SIZE = int(os.getenv('BACKFILL_PAGE_SIZE', 250))
+LOOKAHEAD = 3
+
+def page_endpoint(start):
+    return '{}:{}'.format(PAGE_ENDPOINT, start)
+
+def is_page_endpoint(endpoint):
+    return endpoint.startswith(PAGE_ENDPOINT + ':')
+
+def page_start(endpoint):
+    return int(endpoint.split(':', 1)[1])
+
+class BackfillPages:
+    def __init__(self, ledger, priority, page_size=PAGE_SIZE, lookahead=LOOKAHEAD):
+        self.ledger = ledger
+        self.priority = priority
+        self.page_size = page_size
+        self.lookahead = lookahead
+
+        # stock -> queued page starts / loaded page starts / first start past the history
+        self.queued = {}
+        self.loaded = {}
+        self.end = {}
+        self.completed = set()
+        self.lock = threading.Lock()
+
+    def is_done(self, stock):
+        return self.ledger.is_done(stock, BACKFILL_DONE)
+
+    def next_start(self, stock, start):
+        # First page from start that is neither queued nor committed (resume)
+        queued = self.queued.setdefault(stock, set())
+        while start in queued or self.ledger.is_done(stock, page_endpoint(start)):
+            start += self.page_size
+
+        return start
+
+    def queue(self, work_queue, stock, start):
+        start = self.next_start(stock, start)
+        if stock in self.end and start >= self.end[stock]:
+            return
+        self.queued[stock].add(start)
+        work_queue.put(self.priority, stock, page_endpoint(start))
+
+    # ## Page Lifecycle
+
+    def mark_queued(self, stock, start):
+        # Page queued from outside (dead letter)
+        with self.lock:
+            self.queued.setdefault(stock, set()).add(start)
+
+    def initial_units(self, stock):
+        # (priority, stock, endpoint) of the first lookahead pages that are neither queued nor committed
+        units = []
+        with self.lock:
+            for _ in range(self.lookahead):
+                start = self.next_start(stock, 0)
+                self.queued[stock].add(start)
+                units.append((self.priority, stock, page_endpoint(start)))
+
+        return units
+
+    def start(self, work_queue, stock):
+        for priority, stock, endpoint in self.initial_units(stock):
+            work_queue.put(priority, stock, endpoint)
+
+    def is_past_end(self, stock, start):
+        return stock in self.end and start >= self.end[stock]
+
+    def page_loaded(self, work_queue, stock, start, rows, total=None):
+        with self.lock:
+            self.loaded.setdefault(stock, set()).add(start)
+            if total is not None:
+                self.end[stock] = total
+                # Everything left is known, queue it all at once
+                for page in range(0, total, self.page_size):
+                    self.queue(work_queue, stock, page)
+            elif rows < self.page_size:
+                self.end[stock] = min(self.end.get(stock, start + rows), start + rows)
+            else:
+                # Keep lookahead pages in flight
+                self.queue(work_queue, stock, start + self.lookahead * self.page_size)
+
+    def history_completed(self, stock):
+        # True once, when every queued page before the end of the history is loaded
+        with self.lock:
+            if stock in self.completed or stock not in self.end:
+                return False
+            outstanding = {start for start in self.queued.get(stock, set()) if start < self.end[stock]} - self.loaded.get(stock, set())
+            if outstanding:
+                return False
+            self.completed.add(stock)
+
+        return True
@@ -0,0 +1,57 @@
+# # Bond Detail Cache
+#
+# A bond page on KSEI only has to be fetched again when the bond is new, or when its row in the IDX bond summary
+# changed. Every stored BondDetails row keeps a fingerprint of the summary fields it was scraped with, so a run
+# splits the summary into:
+# - hit: known Short Code, same fingerprint -> skipped
+# - miss: unknown Short Code -> fetched
+# - refresh: known Short Code, fingerprint changed (maturity, outstanding, rating) -> fetched again
+#
+# Rows stored before fingerprints existed have none, they are refreshed once and then hit from the next run on.
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import text
+
+# Summary fields that mean the bond details changed, only the ones present in the summary are used
+FINGERPRINT_FIELDS = ['MatureDate', 'Outstanding', 'Rating']
+
+def summary_fingerprints(BEIBondsListDF):
+    fields = [field for field in FINGERPRINT_FIELDS if field in BEIBondsListDF.columns]
+    hashes = pd.util.hash_pandas_object(BEIBondsListDF[fields].astype(str), index=False)
+
+    return dict(zip(BEIBondsListDF['BondId'], hashes.astype(str)))
+
+class BondCache:
+    def __init__(self, fingerprints=None):
+        # Short Code -> stored fingerprint (None for rows scraped before fingerprints existed)
+        self.fingerprints = fingerprints or {}
+
+    @classmethod
+    def load(cls, engine):
+        inspector = sqlalchemy.inspect(engine)
+        if not inspector.has_table('BondDetails'):
+            return cls()
+
+        columns = {column['name'] for column in inspector.get_columns('BondDetails')}
+        fingerprint = '"SummaryFingerprint"' if 'SummaryFingerprint' in columns else 'NULL'
+        with engine.connect() as conn:
+            rows = conn.execute(text('SELECT "Short Code", {} FROM "BondDetails"'.format(fingerprint)))
+
+            return cls({short_code: value for short_code, value in rows})
+
+    def __contains__(self, short_code):
+        return short_code in self.fingerprints
+
+    def plan(self, BEIBondsListDF):
+        current = summary_fingerprints(BEIBondsListDF)
+        hits, misses, refresh = [], [], []
+        for BondId, fingerprint in current.items():
+            if BondId not in self.fingerprints:
+                misses.append(BondId)
+            elif self.fingerprints[BondId] != fingerprint:
+                refresh.append(BondId)
+            else:
+                hits.append(BondId)
+
+        return current, hits, misses, refresh
@@ -0,0 +1,166 @@
+# # Browser Pool
+#
+# Why Selenium? Because I need it to bypass cloudfare restriction.
+# Chrome startup is the most expensive part of that, so drivers are kept warm and leased out instead of every
+# script calling webdriver.Chrome itself:
+# - health check (a tiny script call) before every lease, a dead driver is replaced
+# - recycled after max_pages page loads or when Chrome uses more than max_rss_mb
+# - every driver has its own temp profile dir, removed when the driver quits (no more rm -r /tmp/.com.google.Chrome*)
+#
+# Pool size and limits can be configured from env: BROWSER_POOL_SIZE, BROWSER_MAX_PAGES, BROWSER_MAX_RSS_MB
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import psutil
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+
+from bei_ksei.metrics import endpoint_name, metrics
+from bei_ksei.upstream import upstream_url
+
+# ## Pooled Browser
+
+class PooledBrowser:
+    def __init__(self):
+        self.profile_dir = tempfile.mkdtemp(prefix='bei-ksei-chrome-')
+        self.pages = 0
+
+        options = Options()
+        options.add_argument("--headless=new")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--user-data-dir={}".format(self.profile_dir))
+        self.driver = webdriver.Chrome(options=options)
+
+    # Everything else goes straight to the driver, so a leased browser can be used like a webdriver.Chrome
+    def __getattr__(self, name):
+        if name == 'driver':
+            raise AttributeError(name)
+        return getattr(self.driver, name)
+
+    def get(self, url):
+        self.pages += 1
+        with metrics.timer('browser_page_load_seconds', endpoint=endpoint_name(url)):
+            self.driver.get(upstream_url(url))
+
+    def is_healthy(self):
+        try:
+            return self.driver.execute_script('return 1') == 1
+        except WebDriverException:
+            return False
+
+    def rss_mb(self):
+        try:
+            process = psutil.Process(self.driver.service.process.pid)
+            processes = [process] + process.children(recursive=True)
+            return sum(p.memory_info().rss for p in processes) / 1024 / 1024
+        except (psutil.Error, AttributeError):
+            return 0
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            pass
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+# ## Pool
+
+class BrowserPool:
+    def __init__(self, size=None, max_pages=None, max_rss_mb=None):
+        self.size = size or int(os.getenv('BROWSER_POOL_SIZE', 1))
+        self.max_pages = max_pages or int(os.getenv('BROWSER_MAX_PAGES', 200))
+        self.max_rss_mb = max_rss_mb or int(os.getenv('BROWSER_MAX_RSS_MB', 1024))
+
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.started_count = 0
+        self.recycled_count = 0
+
+    def acquire(self):
+        while True:
+            try:
+                browser = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_start = self.created < self.size
+                    if can_start:
+                        self.created += 1
+                if can_start:
+                    return self.start_browser()
+                # A leased browser can also be discarded, so don't wait forever for it to come back
+                try:
+                    browser = self.idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+            if browser.is_healthy():
+                return browser
+
+            self.discard(browser)
+
+    def release(self, browser):
+        if browser.pages >= self.max_pages or browser.rss_mb() > self.max_rss_mb:
+            self.recycled_count += 1
+            self.discard(browser)
+        else:
+            self.idle.put(browser)
+
+    @contextmanager
+    def lease(self):
+        browser = self.acquire()
+        try:
+            yield browser
+        finally:
+            self.release(browser)
+
+    def start_browser(self):
+        try:
+            browser = PooledBrowser()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+        self.started_count += 1
+
+        return browser
+
+    def discard(self, browser):
+        browser.quit()
+        with self.lock:
+            self.created -= 1
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().quit()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.created = 0
+
+# ## Shared Pool
+
+pool_lock = threading.Lock()
+shared_pool = None
+
+def get_browser_pool():
+    global shared_pool
+    with pool_lock:
+        if shared_pool is None:
+            shared_pool = BrowserPool()
+
+    return shared_pool
+
+def close_browser_pool():
+    global shared_pool
+    with pool_lock:
+        if shared_pool is not None:
+            shared_pool.close()
+            shared_pool = None
@@ -0,0 +1,90 @@
+# # Date Parsing
+#
+# KSEI writes dates with Indonesian month names ('12 Mei 2021'), IDX JSON uses ISO strings. dateparser handles both
+# but costs milliseconds per value, and the same few hundred date strings repeat across thousands of rows. So:
+# 1. only unique strings are parsed, results are memoized for the whole run
+# 2. Indonesian and English month tokens are mapped to English abbreviations in one vectorized string pass
+# 3. pd.to_datetime with explicit formats parses everything that matches
+# 4. dateparser is only used for what is left
+#
+# '-', empty strings and missing values become NaT. Offsets are dropped, dates stay naive local time.
+
+import re
+import threading
+
+import dateparser
+import pandas as pd
+
+# Month token -> English abbreviation understood by %b
+MONTHS = {
+    'januari': 'Jan', 'january': 'Jan', 'jan': 'Jan',
+    'februari': 'Feb', 'february': 'Feb', 'feb': 'Feb', 'peb': 'Feb',
+    'maret': 'Mar', 'march': 'Mar', 'mar': 'Mar',
+    'april': 'Apr', 'apr': 'Apr',
+    'mei': 'May', 'may': 'May',
+    'juni': 'Jun', 'june': 'Jun', 'jun': 'Jun',
+    'juli': 'Jul', 'july': 'Jul', 'jul': 'Jul',
+    'agustus': 'Aug', 'august': 'Aug', 'agu': 'Aug', 'agt': 'Aug', 'ags': 'Aug', 'aug': 'Aug',
+    'september': 'Sep', 'sept': 'Sep', 'sep': 'Sep',
+    'oktober': 'Oct', 'october': 'Oct', 'okt': 'Oct', 'oct': 'Oct',
+    'november': 'Nov', 'nopember': 'Nov', 'nop': 'Nov', 'nov': 'Nov',
+    'desember': 'Dec', 'december': 'Dec', 'des': 'Dec', 'dec': 'Dec',
+}
+MONTH_PATTERN = r'\b(' + '|'.join(sorted(MONTHS, key=len, reverse=True)) + r')\b\.?'
+
+# Tried in order on the normalized strings, ISO first because most IDX values are ISO
+DATE_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+    '%d %b %Y',
+    '%d-%b-%Y',
+    '%b %d %Y',
+    '%d/%m/%Y',
+]
+
+MISSING_VALUES = {'', '-'}
+
+date_cache = {}
+cache_lock = threading.Lock()
+
+def normalize_months(values):
+    values = pd.Series(values, dtype=object).str.strip().str.replace(',', ' ', regex=False).str.replace(r'\s+', ' ', regex=True)
+    # Dates are stored naive in local (Jakarta) time, a UTC offset would make the column tz-aware
+    values = values.str.replace(r'(\d:\d\d(?:\.\d+)?)(?:Z|[+-]\d\d:?\d\d)$', r'\1', regex=True)
+    return values.str.replace(MONTH_PATTERN, lambda m: MONTHS[m.group(1).lower()], flags=re.IGNORECASE, regex=True)
+
+def parse_unique(values):
+    normalized = normalize_months(values)
+    parsed = pd.Series(pd.NaT, index=normalized.index, dtype='datetime64[ns]')
+    for date_format in DATE_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(normalized[missing], format=date_format, errors='coerce')
+
+    results = {}
+    for value, timestamp in zip(values, parsed):
+        if pd.isna(timestamp) and value.strip() not in MISSING_VALUES:
+            # Fallback for anything the explicit formats don't cover
+            fallback = dateparser.parse(value)
+            timestamp = pd.Timestamp(fallback).tz_localize(None) if fallback is not None else pd.NaT
+        results[value] = timestamp
+
+    return results
+
+def parse_dates(series):
+    series = pd.Series(series)
+    strings = series[series.map(lambda value: isinstance(value, str))]
+
+    with cache_lock:
+        new_values = [value for value in strings.unique() if value not in date_cache]
+    if new_values:
+        parsed = parse_unique(new_values)
+        with cache_lock:
+            date_cache.update(parsed)
+
+    # Values that are already dates are kept, anything else that isn't a string is missing
+    dates = series.map(lambda value: date_cache[value] if isinstance(value, str) else value)
+    return pd.to_datetime(dates, errors='coerce')
@@ -0,0 +1,204 @@
+# # PostgreSQL Sink
+#
+# One pooled engine shared by every script, instead of a new engine (and a connection that is never closed)
+# on every export.
+#
+# Rows are streamed with COPY into a temp staging table, then merged into the target table with
+# INSERT ... ON CONFLICT on the table's natural key, so write time follows the size of the daily change
+# instead of the size of the table.
+#
+# Column types, natural keys and secondary indexes come from the table schemas (bei_ksei/schemas.py). Rows of
+# append-only tables are only inserted (ON CONFLICT DO NOTHING), a stored key is never updated.
+#
+# Tables written by the old to_sql(if_exists='append') exports can hold duplicate keys and have no key index.
+# migrate_natural_keys() dedupes them and creates the key index once, in its own transaction, before the first
+# batch is written (run_all.py and every script's main() call it, or: python -m bei_ksei.db_sink).
+#
+# Point POSTGRE_HOST / POSTGRE_DB at a local Postgres to try it out without touching production.
+
+import io
+import os
+import threading
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from bei_ksei.schemas import TABLE_SCHEMAS
+
+# Natural key of every table we write
+TABLE_KEYS = {table: schema.keys for table, schema in TABLE_SCHEMAS.items()}
+
+# ## Pooled Engine
+
+engine_lock = threading.Lock()
+shared_engine = None
+
+def database_url():
+    return "postgresql://{}:{}@{}/{}".format(
+        os.getenv('POSTGRE_USER'), os.getenv('POSTGRE_PW'), os.getenv('POSTGRE_HOST'), os.getenv('POSTGRE_DB')
+    )
+
+def get_engine():
+    global shared_engine
+    with engine_lock:
+        if shared_engine is None:
+            shared_engine = create_engine(database_url(), pool_size=5, max_overflow=5, pool_pre_ping=True)
+
+    return shared_engine
+
+# ## Table Setup
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def sql_type(dtype):
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'BIGINT'
+    if dtype == 'float32':
+        return 'REAL'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'DOUBLE PRECISION'
+    return 'TEXT'
+
+def column_type(table, column, dtype):
+    # Declared in the table schema, else from the frame's dtype
+    schema = TABLE_SCHEMAS.get(table)
+    return (schema.sql_type(column) if schema is not None else None) or sql_type(dtype)
+
+def ensure_table(cursor, df, table, keys):
+    cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s', (table,))
+    existing_columns = {row[0] for row in cursor.fetchall()}
+
+    if not existing_columns:
+        columns = ', '.join('{} {}'.format(quote(column), column_type(table, column, df[column].dtype)) for column in df.columns)
+        cursor.execute('CREATE TABLE {} ({})'.format(quote(table), columns))
+    else:
+        # The site sometimes adds a field, keep it instead of failing the COPY
+        for column in df.columns:
+            if column not in existing_columns:
+                cursor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(quote(table), quote(column), column_type(table, column, df[column].dtype)))
+
+    ensure_key_index(cursor, table, keys)
+    ensure_indexes(cursor, table, df.columns)
+
+def key_index_name(table):
+    return '{}_natural_key'.format(table)
+
+def ensure_key_index(cursor, table, keys):
+    cursor.execute('SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s AND indexname = %s', (table, key_index_name(table)))
+    if cursor.fetchone() is not None:
+        return
+
+    # New tables (and old ones without duplicate keys). A table with duplicate keys fails with an error that names the migration
+    try:
+        cursor.execute('CREATE UNIQUE INDEX {} ON {} ({})'.format(quote(key_index_name(table)), quote(table), ', '.join(quote(key) for key in keys)))
+    except Exception as e:
+        raise RuntimeError('{} has no natural key index, run migrate_natural_keys() (python -m bei_ksei.db_sink) first'.format(table)) from e
+
+def ensure_indexes(cursor, table, columns):
+    # Secondary indexes of the table schema, once their columns exist
+    schema = TABLE_SCHEMAS.get(table)
+    if schema is None or not schema.indexes:
+        return
+
+    # Checked first, CREATE INDEX IF NOT EXISTS would still lock the table until the batch commits
+    cursor.execute('SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s', (table,))
+    existing_indexes = {row[0] for row in cursor.fetchall()}
+    for index in schema.indexes:
+        index_name = '{}_{}'.format(table, '_'.join(index)).replace(' ', '_')
+        if index_name not in existing_indexes and all(column in columns for column in index):
+            cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(quote(index_name), quote(table), ', '.join(quote(column) for column in index)))
+
+# ## Natural Key Migration
+#
+# Keeps the last copy (highest ctid) of every key. Natural keys are never NULL, so the duplicates are found with a
+# window over the key columns (one sort) instead of a self join on IS NOT DISTINCT FROM, which Postgres can only run
+# as a nested loop over the whole table.
+
+def migrate_key_index(conn, table, keys):
+    # Rows deleted, None when the table doesn't exist or already has its key index
+    # Several processes (distributed workers) can start at once, only one migrates a table
+    conn.execute(text('SELECT pg_advisory_xact_lock(hashtext(:table))'), {'table': table})
+    exists = conn.execute(text('''
+        SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = current_schema() AND table_name = :table)
+    '''), {'table': table}).scalar()
+    indexed = conn.execute(text('''
+        SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table AND indexname = :index_name)
+    '''), {'table': table, 'index_name': key_index_name(table)}).scalar()
+    if not exists or indexed:
+        return None
+
+    key_columns = ', '.join(quote(key) for key in keys)
+    deleted = conn.execute(text('''
+        DELETE FROM {table} WHERE ctid IN (
+            SELECT ctid FROM (
+                SELECT ctid, row_number() OVER (PARTITION BY {keys} ORDER BY ctid DESC) AS copy FROM {table}
+            ) copies
+            WHERE copy > 1
+        )
+    '''.format(table=quote(table), keys=key_columns))).rowcount
+    conn.execute(text('CREATE UNIQUE INDEX {} ON {} ({})'.format(quote(key_index_name(table)), quote(table), key_columns)))
+
+    return deleted
+
+def migrate_natural_keys(engine=None, tables=None):
+    engine = engine or get_engine()
+    for table in tables or TABLE_KEYS:
+        # One transaction per table, a big table doesn't hold the locks of the others
+        with engine.begin() as conn:
+            deleted = migrate_key_index(conn, table, TABLE_KEYS[table])
+        if deleted is not None:
+            print(f'{table}: natural key index created, {deleted} duplicate rows removed')
+
+# ## COPY Upsert
+
+def upsert(df, table, keys=None, engine=None):
+    if len(df) == 0:
+        return 0
+
+    keys = keys or TABLE_KEYS[table]
+    engine = engine or get_engine()
+    append_only = table in TABLE_SCHEMAS and TABLE_SCHEMAS[table].append_only
+    # ON CONFLICT can't touch the same row twice in one statement
+    df = df.drop_duplicates(subset=keys, keep='first' if append_only else 'last')
+
+    columns = ', '.join(quote(column) for column in df.columns)
+    updates = ', '.join('{0} = EXCLUDED.{0}'.format(quote(column)) for column in df.columns if column not in keys)
+    on_conflict = 'DO UPDATE SET {}'.format(updates) if updates and not append_only else 'DO NOTHING'
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            ensure_table(cursor, df, table, keys)
+            cursor.execute('CREATE TEMP TABLE staging (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(quote(table)))
+            cursor.copy_expert('COPY staging ({}) FROM STDIN WITH (FORMAT csv)'.format(columns), buffer)
+            cursor.execute('''
+                INSERT INTO {table} ({columns})
+                SELECT {columns} FROM staging
+                ON CONFLICT ({keys}) {on_conflict}
+            '''.format(
+                table=quote(table),
+                columns=columns,
+                keys=', '.join(quote(key) for key in keys),
+                on_conflict=on_conflict,
+            ))
+            written = cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return written
+
+if __name__ == '__main__':
+    migrate_natural_keys()
@@ -0,0 +1,73 @@
+# # Dead Letters
+#
+# Units that still fail after the retry policy gives up are stored here instead of blocking a worker forever.
+# The next run of the same job loads the unresolved ones and retries them first.
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS "ScrapeDeadLetters" (
+        "Job" TEXT NOT NULL,
+        "UnitKey" TEXT NOT NULL,
+        "Endpoint" TEXT NOT NULL,
+        "Error" TEXT,
+        "Failures" INTEGER NOT NULL DEFAULT 1,
+        "FailedAt" TIMESTAMP NOT NULL,
+        "ResolvedAt" TIMESTAMP,
+        PRIMARY KEY ("Job", "UnitKey", "Endpoint")
+    )
+'''
+
+class DeadLetters:
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+
+        with self.engine.begin() as conn:
+            conn.execute(text(CREATE_TABLE))
+
+    def pending(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT "UnitKey", "Endpoint" FROM "ScrapeDeadLetters"
+                WHERE "Job" = :job AND "ResolvedAt" IS NULL
+                ORDER BY "FailedAt"
+            '''), {'job': self.job})
+
+            return [(key, endpoint) for key, endpoint in rows]
+
+    def add(self, failures):
+        # failures: list of (unit key, endpoint, exception)
+        if not failures:
+            return
+
+        failed_at = datetime.now()
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO "ScrapeDeadLetters" ("Job", "UnitKey", "Endpoint", "Error", "FailedAt")
+                VALUES (:job, :key, :endpoint, :error, :failed_at)
+                ON CONFLICT ("Job", "UnitKey", "Endpoint") DO UPDATE SET
+                    "Error" = EXCLUDED."Error",
+                    "Failures" = "ScrapeDeadLetters"."Failures" + 1,
+                    "FailedAt" = EXCLUDED."FailedAt",
+                    "ResolvedAt" = NULL
+            '''), [
+                {'job': self.job, 'key': key, 'endpoint': endpoint, 'error': repr(error), 'failed_at': failed_at}
+                for key, endpoint, error in failures
+            ])
+
+    def resolve(self, units):
+        if not units:
+            return
+
+        resolved_at = datetime.now()
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                UPDATE "ScrapeDeadLetters" SET "ResolvedAt" = :resolved_at
+                WHERE "Job" = :job AND "UnitKey" = :key AND "Endpoint" = :endpoint AND "ResolvedAt" IS NULL
+            '''), [
+                {'job': self.job, 'key': key, 'endpoint': endpoint, 'resolved_at': resolved_at}
+                for key, endpoint in units
+            ])
@@ -0,0 +1,319 @@
+# # Async Fetch Engine
+#
+# Shared by the stock and bond scrapers. Instead of fixed sleeps after every request, each host gets its own
+# token bucket (requests/sec) and the whole engine has a concurrency cap, so we run as fast as the site allows.
+#
+# Rates and concurrency can be configured from env:
+# - IDX_RATE: requests/sec to www.idx.co.id
+# - KSEI_RATE: requests/sec to www.ksei.co.id
+# - FETCH_CONCURRENCY: maximum in-flight requests
+#
+# With a response cache (bei_ksei/response_cache.py) fresh responses are served from disk without a request.
+
+import asyncio
+import os
+import threading
+import time
+from json.decoder import JSONDecodeError
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from bei_ksei.metrics import metrics
+from bei_ksei.retry_policy import RetryPolicy, CircuitBreaker
+from bei_ksei.upstream import upstream_url
+
+DEFAULT_HOST_RATES = {
+    'www.idx.co.id': float(os.getenv('IDX_RATE', 4)),
+    'www.ksei.co.id': float(os.getenv('KSEI_RATE', 2)),
+}
+DEFAULT_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 8))
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# ## Token Bucket
+
+# Reservation based: every request books the next free slot of its host. The booking is guarded by a thread lock,
+# so the same bucket can be shared by fetch engines running in different jobs (threads / event loops).
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        # rate None / 0 means the host is not limited
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1 / self.rate
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+host_buckets_lock = threading.Lock()
+host_buckets = {}
+
+def get_host_bucket(host, rate):
+    with host_buckets_lock:
+        if (host, rate) not in host_buckets:
+            host_buckets[(host, rate)] = TokenBucket(rate)
+
+        return host_buckets[(host, rate)]
+
+# ## Fetch Engine
+
+class FetchError(Exception):
+    pass
+
+class ChallengeError(FetchError):
+    pass
+
+RETRYABLE_ERRORS = (FetchError, aiohttp.ClientError, asyncio.TimeoutError)
+
+def is_challenge(response):
+    return response.headers.get('cf-mitigated') == 'challenge' or (
+        response.status in (403, 503) and 'text/html' in response.headers.get('Content-Type', '')
+    )
+
+class FetchEngine:
+    def __init__(self, host_rates=None, max_concurrency=DEFAULT_CONCURRENCY, timeout=30, idx_session=None, retry_policy=None, response_cache=None):
+        self.host_rates = dict(DEFAULT_HOST_RATES if host_rates is None else host_rates)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # IDXSession owning the browser handshake, its cookies and user agent are reused here
+        self.idx_session = idx_session
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.response_cache = response_cache
+
+        self.breakers = {}
+        self.semaphore = None
+        self.session = None
+        self.request_count = {}
+        self.request_window = {}
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Keep-alive pool shared by every request of the run, one TCP+TLS handshake per connection instead of per page
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        # Offline runs never reach the site, so there is no handshake to load
+        if self.idx_session is not None and not self.offline():
+            self.load_idx_handshake()
+
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def load_idx_handshake(self):
+        if self.idx_session.handshake_count == 0:
+            self.idx_session.refresh(0)
+
+        self.session.headers.update(self.idx_session.session.headers)
+        self.session.cookie_jar.update_cookies({cookie.name: cookie.value for cookie in self.idx_session.session.cookies})
+
+    def bucket(self, host):
+        return get_host_bucket(host, self.host_rates.get(host))
+
+    def offline(self):
+        return self.response_cache is not None and self.response_cache.offline
+
+    def breaker(self, endpoint):
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(endpoint)
+
+        return self.breakers[endpoint]
+
+    # ## Raw GET
+
+    def count_request(self, host):
+        now = time.monotonic()
+        self.request_count[host] = self.request_count.get(host, 0) + 1
+        self.request_window[host] = (self.request_window.get(host, (now, now))[0], now)
+
+    async def get(self, url):
+        host = urlsplit(url).hostname
+        await self.bucket(host).acquire()
+
+        async with self.semaphore:
+            self.count_request(host)
+            with metrics.request(url) as request:
+                async with self.session.get(upstream_url(url)) as response:
+                    body = await response.read()
+                    challenge = is_challenge(response)
+                    status = response.status
+                request['status'], request['bytes'] = status, len(body)
+
+        if challenge:
+            await self.refresh_challenge()
+            raise ChallengeError(url)
+        if status >= 400:
+            raise FetchError('{} returned {}'.format(url, status))
+
+        return body
+
+    async def refresh_challenge(self):
+        if self.idx_session is None:
+            return
+
+        seen_handshakes = self.idx_session.handshake_count
+        await asyncio.to_thread(self.idx_session.refresh, seen_handshakes)
+        self.load_idx_handshake()
+
+    # ## Retried GET
+    # 
+    # Bounded by the retry policy, every endpoint (URL path unless given) has its own circuit breaker.
+    # Responses go through the response cache when there is one, a body is only cached once it's valid.
+
+    async def cached(self, url, endpoint, fetch):
+        # (body, body_hash, parsed), parsed is None for a body served from the cache
+        if self.response_cache is None:
+            body, parsed = await fetch()
+            return body, None, parsed
+
+        cached = await asyncio.to_thread(self.response_cache.get, url, endpoint)
+        if cached is not None:
+            return cached[0], cached[1], None
+
+        body, parsed = await fetch()
+        body_hash = await asyncio.to_thread(self.response_cache.put, url, endpoint, body)
+
+        return body, body_hash, parsed
+
+    async def get_bytes(self, url, endpoint=None, validate=None):
+        # validate(body) raises on a body that must not be cached (e.g. a page without the expected block)
+        endpoint = endpoint or urlsplit(url).path
+
+        async def fetch():
+            body = await self.retry_policy.call_async(url, lambda: self.get(url), retry_on=RETRYABLE_ERRORS, breaker=self.breaker(endpoint))
+            if validate is not None:
+                validate(body)
+            return body, None
+
+        body, _, _ = await self.cached(url, endpoint, fetch)
+
+        return body
+
+    async def fetch_json(self, url, endpoint=None):
+        # (content, body_hash), body_hash is None without a response cache
+        endpoint = endpoint or urlsplit(url).path
+
+        async def get_json_once():
+            body = await self.get(url)
+            try:
+                return body, metrics.parse_json(body, url)
+            except JSONDecodeError:
+                # Challenge page served with a 200
+                if body.lstrip().startswith(b'<'):
+                    await self.refresh_challenge()
+                raise
+
+        async def fetch():
+            return await self.retry_policy.call_async(
+                url, get_json_once, retry_on=RETRYABLE_ERRORS + (JSONDecodeError,), breaker=self.breaker(endpoint),
+            )
+
+        body, body_hash, content = await self.cached(url, endpoint, fetch)
+        if content is None:
+            content = metrics.parse_json(body, url)
+
+        return content, body_hash
+
+    async def get_json(self, url, endpoint=None):
+        content, body_hash = await self.fetch_json(url, endpoint)
+
+        return content
+
+    async def get_json_changed(self, url, responses, endpoint=None):
+        # None when the DB already has exactly this response. Otherwise (url, body_hash) is added to responses,
+        # pass them to response_cache.mark_stored once the rows built from it are committed.
+        content, changed = await self.fetch_json_changed(url, responses, endpoint)
+
+        return content if changed else None
+
+    async def fetch_json_changed(self, url, responses, endpoint=None):
+        # (content, changed), the content is returned even when the DB already has it (e.g. a page count is needed)
+        content, body_hash = await self.fetch_json(url, endpoint)
+        if body_hash is None:
+            return content, True
+        if await asyncio.to_thread(self.response_cache.is_stored, url, body_hash):
+            return content, False
+
+        responses.append((url, body_hash))
+        return content, True
+
+    async def get_text(self, url, endpoint=None):
+        body = await self.get_bytes(url, endpoint)
+
+        return body.decode('utf-8', errors='replace')
+
+    # ## Streamed Download
+    #
+    # Large files (financial report attachments) go straight to disk chunk by chunk, they are never held in memory
+    # and never go through the response cache. What is already on disk at path (an earlier attempt or an earlier
+    # run) is resumed with a Range request, so every retry continues where the last one stopped.
+
+    async def download(self, url, path, endpoint=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        # Returns the size of the complete file at path
+        endpoint = endpoint or urlsplit(url).path
+
+        return await self.retry_policy.call_async(url, lambda: self.download_once(url, path, chunk_size), retry_on=RETRYABLE_ERRORS, breaker=self.breaker(endpoint))
+
+    async def download_once(self, url, path, chunk_size):
+        host = urlsplit(url).hostname
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        # Only connecting and each read are bounded, a large file can take longer than the request timeout
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        await self.bucket(host).acquire()
+
+        async with self.semaphore:
+            self.count_request(host)
+            with metrics.request(url) as request:
+                async with self.session.get(upstream_url(url), headers=headers, timeout=timeout) as response:
+                    challenge = is_challenge(response)
+                    status = response.status
+                    content_range = response.headers.get('Content-Range', '')
+                    written = not challenge and (status == 200 or (status == 206 and content_range.startswith('bytes {}-'.format(offset))))
+                    if written:
+                        # A server that ignores the range sends the whole file again (200), it is written from the start.
+                        # Disk writes run in a thread, a slow disk doesn't stall the other fetches on the event loop
+                        f = await asyncio.to_thread(open, path, 'ab' if status == 206 else 'wb')
+                        try:
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                await asyncio.to_thread(f.write, chunk)
+                                request['bytes'] += len(chunk)
+                        finally:
+                            await asyncio.to_thread(f.close)
+                    request['status'] = status
+            if written:
+                return os.path.getsize(path)
+
+        if challenge:
+            await self.refresh_challenge()
+            raise ChallengeError(url)
+        if status == 416 and content_range == 'bytes */{}'.format(offset):
+            # The partial file is complete already
+            return offset
+        if status in (206, 416):
+            # The partial file doesn't match the file on the server anymore, it starts over
+            os.remove(path)
+            raise FetchError('{} range {} returned {} {}'.format(url, offset, status, content_range))
+        raise FetchError('{} returned {}'.format(url, status))
+
+    # ## Achieved Rate
+
+    # Requests/sec per host, measured between the first and the last request sent to that host
+    def rates(self):
+        rates = {}
+        for host, count in self.request_count.items():
+            first, last = self.request_window[host]
+            rates[host] = (count - 1) / (last - first) if last > first else float(count)
+
+        return rates
@@ -0,0 +1,127 @@
+# # IDX Session Handoff
+#
+# Why Selenium? Because I need it to bypass cloudfare restriction.
+# But only once per session: after the check is passed, the browser cookies and user agent are handed
+# to a pooled keep-alive requests Session that does the actual JSON GETs.
+# The browser is only used again when a challenge shows up.
+#
+# With a response cache, fresh (or, offline, any) cached responses are served without a handshake or a request.
+
+import json
+import threading
+from json.decoder import JSONDecodeError
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.wait import WebDriverWait
+
+from bei_ksei.browser_pool import get_browser_pool
+from bei_ksei.metrics import metrics
+from bei_ksei.retry_policy import RetryPolicy
+from bei_ksei.upstream import upstream_url
+
+IDX_HOME_URL = 'https://www.idx.co.id/id'
+
+# Cloudflare answers with 403/503 and an HTML page ("Just a moment...") instead of JSON
+
+def is_challenge(response):
+    if response.headers.get('cf-mitigated') == 'challenge':
+        return True
+    if response.status_code in (403, 503) and 'text/html' in response.headers.get('Content-Type', ''):
+        return True
+    return False
+
+def read_body_json(driver, url):
+    driver.get(url)
+    WebDriverWait(driver, timeout=10).until(lambda d: d.find_element(By.TAG_NAME, 'body'))
+    content = driver.find_element(By.TAG_NAME, value='body').text
+
+    return metrics.parse_json(content, url)
+
+class IDXSession:
+    def __init__(self, pool_size=6, timeout=30, retry_policy=None, browser_pool=None, response_cache=None):
+        self.timeout = timeout
+        self.response_cache = response_cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.browser_pool = browser_pool or get_browser_pool()
+        self.user_agent = None
+        self.handshake_count = 0
+        self.browser_fallback_count = 0
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json, text/plain, */*',
+            'Referer': IDX_HOME_URL,
+        })
+
+    # ## Browser Handshake
+
+    def handshake(self):
+        with self.browser_pool.lease() as driver:
+            driver.get(IDX_HOME_URL)
+            WebDriverWait(driver, timeout=30).until(
+                lambda d: d.find_element(By.TAG_NAME, 'body') and 'Just a moment' not in d.title
+            )
+
+            self.user_agent = driver.execute_script('return navigator.userAgent')
+            self.session.headers['User-Agent'] = self.user_agent
+            for cookie in driver.get_cookies():
+                self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+        self.handshake_count += 1
+
+    def refresh(self, seen_handshakes):
+        # Several threads can hit the same challenge, only the first one goes back to the browser
+        with self.lock:
+            if self.handshake_count == seen_handshakes:
+                self.handshake()
+
+    # ## Browser Fallback
+
+    def browser_get_json(self, url):
+        self.browser_fallback_count += 1
+        with self.browser_pool.lease() as driver:
+            return read_body_json(driver, url)
+
+    # ## JSON GET
+
+    def get_json_once(self, url):
+        seen_handshakes = self.handshake_count
+        with metrics.request(url) as request:
+            response = self.session.get(upstream_url(url), timeout=self.timeout)
+            request['status'], request['bytes'] = response.status_code, len(response.content)
+        if is_challenge(response):
+            self.refresh(seen_handshakes)
+            return self.browser_get_json(url)
+
+        return metrics.parse_json(response.content, url)
+
+    def get_json(self, url, endpoint=None):
+        endpoint = endpoint or urlsplit(url).path
+        if self.response_cache is not None:
+            cached = self.response_cache.get(url, endpoint)
+            if cached is not None:
+                return metrics.parse_json(cached[0], url)
+
+        if self.handshake_count == 0:
+            self.refresh(0)
+
+        content = self.retry_policy.call(
+            url, lambda: self.get_json_once(url),
+            retry_on=(JSONDecodeError, requests.exceptions.RequestException, WebDriverException),
+        )
+        if self.response_cache is not None:
+            # Stored re-encoded, a browser fallback only gives the parsed content
+            self.response_cache.put(url, endpoint, json.dumps(content).encode('utf-8'))
+
+        return content
+
+    # Leased browsers go back to the pool, the pool owner closes them
+    def close(self):
+        self.session.close()
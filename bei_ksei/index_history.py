@@ -0,0 +1,74 @@
+# # Sectoral and Index History Store
+#
+# BEISectoralSummary and BEIIndexSummary are daily snapshots, one row per (IndexCode, DTCreate). They used to be
+# read whole, merged with the new snapshot in pandas and written back with to_sql(if_exists='replace'): the daily
+# cost grew with the whole history and a crash during the replace left the table empty.
+#
+# Both tables are now append-only (bei_ksei/schemas.py): a snapshot is inserted with ON CONFLICT DO NOTHING on
+# (IndexCode, DTCreate), so a day that is already stored keeps its first scraped row, as before. The unique key
+# index (IndexCode, DTCreate) serves per-index queries, the DTCreate index serves per-day queries.
+#
+# Reading a history back never loads the whole table:
+#
+#   index_history('BEIIndexSummary', 'COMPOSITE', start='2023-01-01')
+#   index_levels('BEISectoralSummary', ['IDXENERGY', 'IDXFINANCE'], column='LastVal')
+
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+from bei_ksei.db_sink import get_engine, quote
+from bei_ksei.schemas import TABLE_SCHEMAS, apply_schema
+from bei_ksei.sinks import write_to_sinks
+
+INDEX_HISTORY_TABLES = ('BEISectoralSummary', 'BEIIndexSummary')
+
+def append_snapshot(table, df):
+    # Rows inserted into the DB, days already stored are left as they are
+    return write_to_sinks(table, df)
+
+# ## Time Series Queries
+
+def history_query(table, columns, start, end):
+    if table not in INDEX_HISTORY_TABLES:
+        raise ValueError('{} is not an index history table'.format(table))
+
+    conditions = ['"IndexCode" IN :index_codes']
+    if start is not None:
+        conditions.append('"DTCreate" >= :start')
+    if end is not None:
+        conditions.append('"DTCreate" <= :end')
+
+    return text('SELECT {} FROM {} WHERE {} ORDER BY "IndexCode", "DTCreate"'.format(
+        ', '.join(quote(column) for column in columns), quote(table), ' AND '.join(conditions),
+    )).bindparams(bindparam('index_codes', expanding=True))
+
+def load_history(table, index_codes, columns=None, start=None, end=None, engine=None):
+    # Long frame of the given index codes, sorted by index code and date
+    engine = engine or get_engine()
+    columns = list(columns or TABLE_SCHEMAS[table].columns)
+    for key in ['IndexCode', 'DTCreate']:
+        if key not in columns:
+            columns.insert(0, key)
+
+    params = {'index_codes': list(index_codes)}
+    if start is not None:
+        params['start'] = pd.Timestamp(start).to_pydatetime()
+    if end is not None:
+        params['end'] = pd.Timestamp(end).to_pydatetime()
+
+    with engine.connect() as conn:
+        rows = pd.read_sql(history_query(table, columns, start, end), conn, params=params)
+
+    return apply_schema(table, rows)
+
+def index_history(table, index_code, columns=None, start=None, end=None, engine=None):
+    # Time series of one index, indexed by DTCreate
+    rows = load_history(table, [index_code], columns, start, end, engine)
+
+    return rows.drop(columns='IndexCode').set_index('DTCreate')
+
+def index_levels(table, index_codes, column='LastVal', start=None, end=None, engine=None):
+    # One column per index code, indexed by DTCreate
+    rows = load_history(table, index_codes, [column], start, end, engine)
+
+    return rows.pivot(index='DTCreate', columns='IndexCode', values=column)
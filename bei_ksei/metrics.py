@@ -0,0 +1,247 @@
+# # Run Metrics
+#
+# One process-wide registry that every layer reports to, instead of print lines and tqdm bars:
+# - requests per endpoint and status, request latency histogram (rate limit waits excluded), response bytes
+# - retries per endpoint
+# - Chrome page-load time (handshakes, browser fallbacks, pages read with a pooled browser)
+# - JSON parse time per endpoint
+# - DB write time and rows per table and sink
+# - completed work units per unit endpoint (TradingInfo, CompanyProfiles, ...)
+#
+# Endpoints are named from the URL (see ENDPOINT_NAMES), so both sites and every fetch path share the same labels.
+#
+# At the end of a run (run_all.py, or a script's main()) write_run_report() writes:
+# - a Prometheus textfile, for the node_exporter textfile collector: METRICS_TEXTFILE (default metrics/bei_ksei.prom)
+# - a JSON run summary with latency quantiles and totals: METRICS_DIR/run-<timestamp>.json (default metrics/)
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlsplit
+
+METRICS_DIR = os.getenv('METRICS_DIR', 'metrics')
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', os.path.join(METRICS_DIR, 'bei_ksei.prom'))
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ENDPOINT_NAMES = {
+    '/primary/ListedCompany/GetCompanyProfilesDetail': 'profiles',
+    '/primary/ListedCompany/GetTradingInfoSS': 'trading_info',
+    '/primary/ListedCompany/GetFinancialReport': 'financial_reports',
+    '/primary/TradingSummary/GetStockSummary': 'stock_summary',
+    '/primary/StockData/GetIndexIC': 'sectoral_summary',
+    '/primary/StockData/GetConstituent': 'index_summary',
+    '/secondary/get/BondSukuk/bond': 'bond_list',
+}
+
+def endpoint_name(url):
+    path = urlsplit(url).path
+    if path in ENDPOINT_NAMES:
+        return ENDPOINT_NAMES[path]
+    if '/lc/' in path:
+        return 'ksei_bond_detail'
+    if path.startswith('/Portals/'):
+        return 'report_files'
+    if path in ('/', '/id'):
+        return 'home'
+    return 'other'
+
+# name -> (type, help)
+METRICS = {
+    'requests_total': ('counter', 'Requests sent, by endpoint and status'),
+    'request_seconds': ('histogram', 'Request latency from send to full response'),
+    'response_bytes_total': ('counter', 'Response body bytes received'),
+    'retries_total': ('counter', 'Attempts retried by the retry policy'),
+    'browser_page_load_seconds': ('histogram', 'Chrome page loads, until the page body is there'),
+    'json_parse_seconds': ('histogram', 'Time spent in json.loads'),
+    'db_write_seconds': ('histogram', 'Batch writes, by table and sink'),
+    'db_rows_total': ('counter', 'Rows written, by table and sink'),
+    'rows_dropped_total': ('counter', 'Rows a sink could not write (no partition date), by table and sink'),
+    'units_completed_total': ('counter', 'Work units completed, by unit endpoint (TradingInfo, CompanyProfiles, ...)'),
+    'job_duration_seconds': ('gauge', 'Duration of the last run of each run_all.py job, by pipeline'),
+    'last_run_timestamp_seconds': ('gauge', 'End of the last run'),
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket, like histogram_quantile()
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count > 0:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+
+        return BUCKETS[-1]
+
+    def summary(self):
+        return {
+            'count': self.count, 'seconds': round(self.sum, 3),
+            **{name: None if value is None else round(value, 4) for name, value in
+               [('p50', self.quantile(0.5)), ('p95', self.quantile(0.95)), ('p99', self.quantile(0.99))]},
+        }
+
+class Metrics:
+    def __init__(self):
+        # (name, labels as a sorted tuple of pairs) -> value / Histogram
+        self.values = {}
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = Histogram()
+            self.values[key].observe(value)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (key, labels), value in self.values.items() if key == name)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    # ## Request Helpers
+
+    @contextmanager
+    def request(self, url):
+        # with metrics.request(url) as request: ... request['status'], request['bytes'] = ...
+        # A request that raises before a status is set is counted with status 'error'
+        endpoint = endpoint_name(url)
+        request = {'status': 'error', 'bytes': 0}
+        start = time.monotonic()
+        try:
+            yield request
+        finally:
+            self.observe('request_seconds', time.monotonic() - start, endpoint=endpoint)
+            self.inc('requests_total', endpoint=endpoint, status=str(request['status']))
+            if request['bytes']:
+                self.inc('response_bytes_total', request['bytes'], endpoint=endpoint)
+
+    def parse_json(self, body, url):
+        with self.timer('json_parse_seconds', endpoint=endpoint_name(url)):
+            return json.loads(body)
+
+    # ## Output
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.values.items(), key=lambda item: (item[0][0], item[0][1]))
+
+    def prometheus_text(self):
+        lines = []
+        seen = set()
+        for (name, labels), value in self.snapshot():
+            metric_type, help_text = METRICS.get(name, ('untyped', name))
+            full_name = 'bei_ksei_' + name
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP {} {}'.format(full_name, help_text))
+                lines.append('# TYPE {} {}'.format(full_name, metric_type))
+            if isinstance(value, Histogram):
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ['+Inf'], value.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(full_name, label_text(labels + (('le', str(bound)),)), cumulative))
+                lines.append('{}_sum{} {}'.format(full_name, label_text(labels), value.sum))
+                lines.append('{}_count{} {}'.format(full_name, label_text(labels), value.count))
+            else:
+                lines.append('{}{} {}'.format(full_name, label_text(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # Per endpoint and per table totals, latency quantiles in seconds
+        endpoints = {}
+        db_writes = {}
+        units = {}
+        other = {}
+        for (name, labels), value in self.snapshot():
+            labels = dict(labels)
+            if 'unit' in labels:
+                units[labels['unit']] = value
+            elif 'endpoint' in labels:
+                endpoint = endpoints.setdefault(labels['endpoint'], {})
+                if name == 'requests_total':
+                    endpoint.setdefault('requests', {})[labels['status']] = value
+                else:
+                    endpoint[name] = value.summary() if isinstance(value, Histogram) else value
+            elif 'table' in labels:
+                write = db_writes.setdefault(labels['table'], {}).setdefault(labels['sink'], {})
+                write[name] = value.summary() if isinstance(value, Histogram) else value
+            else:
+                key = name if not labels else '{}{}'.format(name, label_text(tuple(labels.items())))
+                other[key] = value.summary() if isinstance(value, Histogram) else value
+
+        return {'endpoints': endpoints, 'db_writes': db_writes, 'units_completed': units, 'other': other}
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+metrics = Metrics()
+
+# ## Run Report
+
+def write_run_report(name, jobs=None):
+    # jobs: run_all.py job report, {job: {'status', 'start', 'duration'}}
+    finished_at = datetime.now()
+    # Labelled pipeline, not job: Prometheus sets job to the scrape target and renames a clashing label exported_job
+    for job, row in (jobs or {}).items():
+        metrics.set('job_duration_seconds', round(row['duration'], 3), pipeline=job, status=row['status'])
+    metrics.set('last_run_timestamp_seconds', finished_at.timestamp(), run=name)
+
+    textfile_dir = os.path.dirname(METRICS_TEXTFILE)
+    if textfile_dir:
+        os.makedirs(textfile_dir, exist_ok=True)
+    # Written next to it and renamed, the textfile collector never reads half a file
+    with open(METRICS_TEXTFILE + '.tmp', 'w') as f:
+        f.write(metrics.prometheus_text())
+    os.replace(METRICS_TEXTFILE + '.tmp', METRICS_TEXTFILE)
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    summary_path = os.path.join(METRICS_DIR, 'run-{:%Y%m%dT%H%M%S}.json'.format(finished_at))
+    summary = dict(
+        run=name, started_at=metrics.started_at.isoformat(), finished_at=finished_at.isoformat(),
+        seconds=round((finished_at - metrics.started_at).total_seconds(), 3), jobs=jobs or {}, **metrics.summary(),
+    )
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(f'Metrics: {METRICS_TEXTFILE}, run summary: {summary_path}')
+
+    return summary_path
@@ -0,0 +1,102 @@
+# # Streaming Result Pipeline
+#
+# Scrape workers push record batches into a bounded queue, a writer stage flushes them to the DB while scraping
+# continues. Memory stays flat (the queue is bounded, so workers wait when the DB falls behind) and DB writes
+# overlap network I/O.
+#
+# A table is flushed when it has buffered batch_rows rows, or flush_seconds after its last flush.
+# on_commit(units) is called with the units of every batch that made it to the DB (e.g. for the run ledger).
+
+import asyncio
+import time
+
+import pandas as pd
+
+class BatchWriter:
+    def __init__(self, write_batch, max_queue=64, batch_rows=5000, flush_seconds=30, on_commit=None, on_error=None):
+        # write_batch(table, df), on_commit(units) and on_error(units, e) are blocking functions (transform + upsert),
+        # they run in a thread
+        self.write_batch = write_batch
+        self.on_commit = on_commit
+        self.on_error = on_error
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.buffers = {}
+        self.buffered_units = {}
+        self.buffered_rows = {}
+        self.last_flush = {}
+        self.written_rows = {}
+        self.errors = []
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.queue.put(None)
+        await self.task
+        if self.errors:
+            raise self.errors[0]
+
+    async def put(self, table, df, unit=None, units=None):
+        # units: several units committed by the same frame (e.g. one bulk response covering many stocks)
+        if df is None or len(df) == 0:
+            return
+        units = list(units or []) + ([unit] if unit is not None else [])
+        await self.queue.put((table, df, units))
+
+    # ## Writer Stage
+
+    async def run(self):
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                item = False
+
+            if item is None:
+                break
+
+            if item:
+                table, df, units = item
+                self.buffers.setdefault(table, []).append(df)
+                self.buffered_units.setdefault(table, []).extend(units)
+                self.buffered_rows[table] = self.buffered_rows.get(table, 0) + len(df)
+                self.last_flush.setdefault(table, time.monotonic())
+
+            for table in list(self.buffers):
+                if self.buffered_rows[table] >= self.batch_rows or time.monotonic() - self.last_flush[table] >= self.flush_seconds:
+                    await self.flush(table)
+
+        for table in list(self.buffers):
+            await self.flush(table)
+
+    async def flush(self, table):
+        frames = self.buffers.pop(table, [])
+        units = self.buffered_units.pop(table, [])
+        self.buffered_rows[table] = 0
+        self.last_flush[table] = time.monotonic()
+        if not frames:
+            return
+
+        df = pd.concat(frames, ignore_index=True)
+        try:
+            await asyncio.to_thread(self.write_batch, table, df)
+            self.written_rows[table] = self.written_rows.get(table, 0) + len(df)
+            if self.on_commit is not None and units:
+                await asyncio.to_thread(self.on_commit, units)
+        except Exception as e:
+            # Keep draining the queue so the scrape workers don't block on a full queue, the error is raised on exit
+            print(table, 'batch of', len(df), 'rows failed:', repr(e))
+            if self.on_error is None or not units:
+                self.errors.append(e)
+                return
+
+            # The caller releases or fails the units of the batch, the error isn't raised on exit
+            try:
+                await asyncio.to_thread(self.on_error, units, e)
+            except Exception as e:
+                self.errors.append(e)
@@ -0,0 +1,172 @@
+# # Response Cache
+#
+# Company profiles and financial report listings barely change from day to day, so responses are kept on disk:
+# - bodies are content addressed (bodies/<sha256>), identical responses (e.g. every empty report listing) are stored once
+# - an index (SQLite) maps URL -> body hash, fetch time, last use and the body hash the DB already has
+# - every endpoint class has its own TTL, a fresh response is served without a request. TTL 0 means always fetched,
+#   but still stored for the offline mode
+# - least recently used responses are evicted when the bodies go over the size cap
+# - a response whose body hash is the one already stored in the DB can skip the DataFrame build and DB write,
+#   the hash is only recorded as stored after the DB commit (mark_stored)
+#
+# Offline mode replays runs from the cache only: every response is served regardless of its age, and a URL that
+# is not cached raises CacheMiss instead of going to the network. Useful for reprocessing and testing.
+#
+# Configured from env: RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB, RESPONSE_CACHE_OFFLINE=1
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DAY = 24 * 60 * 60
+
+# Endpoint class (the fetch engine endpoint name, URL path unless given) -> TTL in seconds
+DEFAULT_TTLS = {
+    '/primary/ListedCompany/GetCompanyProfilesDetail': 7 * DAY,
+    '/primary/ListedCompany/GetFinancialReport': DAY,
+    'KSEIBondDetails': DAY,
+}
+
+class CacheMiss(Exception):
+    pass
+
+class ResponseCache:
+    def __init__(self, directory=None, max_mb=None, ttls=None, offline=None):
+        self.directory = directory or os.getenv('RESPONSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'bei_ksei', 'responses'))
+        self.max_bytes = (max_mb or int(os.getenv('RESPONSE_CACHE_MAX_MB', 2048))) * 1024 * 1024
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.offline = os.getenv('RESPONSE_CACHE_OFFLINE') == '1' if offline is None else offline
+
+        self.hits = 0
+        self.misses = 0
+        self.unchanged = 0
+
+        os.makedirs(os.path.join(self.directory, 'bodies'), exist_ok=True)
+        # One connection shared by the fetch engine threads, every statement runs under the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                endpoint TEXT,
+                body_hash TEXT,
+                size INTEGER,
+                fetched_at REAL,
+                used_at REAL,
+                stored_hash TEXT
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+        self.total_bytes = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM responses GROUP BY body_hash)'
+        ).fetchone()[0]
+
+    def body_path(self, body_hash):
+        return os.path.join(self.directory, 'bodies', body_hash[:2], body_hash)
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, 0)
+
+    # ## Read
+
+    def get(self, url, endpoint):
+        # (body, body_hash) when the cached response is fresh (any age when offline), else None
+        with self.lock:
+            row = self.db.execute('SELECT body_hash, fetched_at FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None and (self.offline or time.time() - row[1] < self.ttl(endpoint)):
+                try:
+                    with open(self.body_path(row[0]), 'rb') as f:
+                        body = f.read()
+                except FileNotFoundError:
+                    body = None
+                if body is not None:
+                    self.db.execute('UPDATE responses SET used_at = ? WHERE url = ?', (time.time(), url))
+                    self.hits += 1
+                    return body, row[0]
+
+        if self.offline:
+            raise CacheMiss(url)
+        return None
+
+    def is_stored(self, url, body_hash):
+        with self.lock:
+            row = self.db.execute('SELECT stored_hash FROM responses WHERE url = ?', (url,)).fetchone()
+            stored = row is not None and row[0] == body_hash
+            if stored:
+                self.unchanged += 1
+
+        return stored
+
+    # ## Write
+
+    def put(self, url, endpoint, body):
+        body_hash = hashlib.sha256(body).hexdigest()
+        path = self.body_path(body_hash)
+        now = time.time()
+
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Written to a temp file first, a crash never leaves a half written body behind
+                temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+                with open(temp_path, 'wb') as f:
+                    f.write(body)
+                os.replace(temp_path, path)
+                self.total_bytes += len(body)
+
+            self.db.execute('''
+                INSERT INTO responses (url, endpoint, body_hash, size, fetched_at, used_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    endpoint = excluded.endpoint, body_hash = excluded.body_hash, size = excluded.size,
+                    fetched_at = excluded.fetched_at, used_at = excluded.used_at
+            ''', (url, endpoint, body_hash, len(body), now, now))
+            self.misses += 1
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+        return body_hash
+
+    def mark_stored(self, responses):
+        # responses: (url, body_hash) whose data is committed to the DB
+        if not responses:
+            return
+        with self.lock:
+            self.db.executemany('UPDATE responses SET stored_hash = ? WHERE url = ?', [(body_hash, url) for url, body_hash in responses])
+
+    # ## LRU Eviction
+
+    def evict(self):
+        # Down to 90% of the cap, so a full cache doesn't evict on every put
+        target = self.max_bytes * 0.9
+        rows = self.db.execute('SELECT url, body_hash, size FROM responses ORDER BY used_at').fetchall()
+        for url, body_hash, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            if self.db.execute('SELECT 1 FROM responses WHERE body_hash = ? LIMIT 1', (body_hash,)).fetchone() is None:
+                try:
+                    os.remove(self.body_path(body_hash))
+                except FileNotFoundError:
+                    pass
+                self.total_bytes -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# ## Shared Cache
+
+cache_lock = threading.Lock()
+shared_cache = None
+
+def get_response_cache():
+    global shared_cache
+    with cache_lock:
+        if shared_cache is None:
+            shared_cache = ResponseCache()
+
+    return shared_cache
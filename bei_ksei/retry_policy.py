@@ -0,0 +1,93 @@
+# # Retry Policy
+#
+# One retry policy for every fetch loop, instead of `while True` with a fixed 1.5s sleep:
+# - exponential backoff with full jitter, up to max_attempts, then RetryExhausted is raised
+# - a circuit breaker per endpoint that pauses traffic to it for a cooldown when its error rate spikes
+#
+# Units that still fail go to the dead-letter table (see dead_letters.py) and are retried first on the next run.
+
+import asyncio
+import random
+import time
+from collections import deque
+
+from bei_ksei.metrics import endpoint_name, metrics
+
+class RetryExhausted(Exception):
+    def __init__(self, key, attempts, last_error):
+        super().__init__('{} failed after {} attempts: {!r}'.format(key, attempts, last_error))
+        self.key = key
+        self.attempts = attempts
+        self.last_error = last_error
+
+class RetryPolicy:
+    def __init__(self, max_attempts=6, base_delay=0.5, max_delay=30):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # ## Sync Retry
+
+    # fn is called until it returns, retry_on exceptions are retried, anything else is raised right away.
+    # Retries are counted per endpoint (metrics label), named from the key when it's a URL
+    def call(self, key, fn, retry_on=(Exception,), endpoint=None):
+        for attempt in range(self.max_attempts):
+            try:
+                return fn()
+            except retry_on as e:
+                last_error = e
+                if attempt + 1 < self.max_attempts:
+                    metrics.inc('retries_total', endpoint=endpoint or endpoint_name(key))
+                    time.sleep(self.delay(attempt))
+
+        raise RetryExhausted(key, self.max_attempts, last_error)
+
+    # ## Async Retry
+
+    async def call_async(self, key, fn, retry_on=(Exception,), breaker=None, endpoint=None):
+        for attempt in range(self.max_attempts):
+            if breaker is not None:
+                await breaker.wait()
+            try:
+                result = await fn()
+                if breaker is not None:
+                    breaker.record(True)
+                return result
+            except retry_on as e:
+                last_error = e
+                if breaker is not None:
+                    breaker.record(False)
+                if attempt + 1 < self.max_attempts:
+                    metrics.inc('retries_total', endpoint=endpoint or endpoint_name(key))
+                    await asyncio.sleep(self.delay(attempt))
+
+        raise RetryExhausted(key, self.max_attempts, last_error)
+
+# ## Circuit Breaker
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_requests=10, error_rate=0.5, cooldown=60):
+        self.name = name
+        self.outcomes = deque(maxlen=window)
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.open_until = 0
+        self.trips = 0
+
+    def record(self, success):
+        self.outcomes.append(success)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_requests and failures / len(self.outcomes) >= self.error_rate:
+            self.open_until = time.monotonic() + self.cooldown
+            self.trips += 1
+            self.outcomes.clear()
+            print(f"Circuit breaker {self.name} open for {self.cooldown}s ({failures} errors)")
+
+    async def wait(self):
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
@@ -0,0 +1,101 @@
+# # Run Ledger
+#
+# Records every completed (run_id, stock, endpoint) unit once its data is committed, so a crashed run can be
+# resumed with --resume and only redo the units that never made it to the DB.
+#
+# Data is committed before its ledger rows, a crash in between only means the unit is scraped again
+# (the upsert is idempotent).
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+CREATE_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS "ScrapeRuns" (
+        "RunId" TEXT PRIMARY KEY,
+        "Job" TEXT NOT NULL,
+        "StartedAt" TIMESTAMP NOT NULL,
+        "FinishedAt" TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS "ScrapeRunLedger" (
+        "RunId" TEXT NOT NULL,
+        "StockCode" TEXT NOT NULL,
+        "Endpoint" TEXT NOT NULL,
+        "CompletedAt" TIMESTAMP NOT NULL,
+        PRIMARY KEY ("RunId", "StockCode", "Endpoint")
+    )
+    ''',
+]
+
+class RunLedger:
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+        self.run_id = None
+        self.completed = set()
+
+        with self.engine.begin() as conn:
+            for statement in CREATE_TABLES:
+                conn.execute(text(statement))
+
+    # ## Run Lifecycle
+
+    def start(self, resume=False):
+        if resume:
+            with self.engine.connect() as conn:
+                self.run_id = conn.execute(text('''
+                    SELECT "RunId" FROM "ScrapeRuns"
+                    WHERE "Job" = :job AND "FinishedAt" IS NULL
+                    ORDER BY "StartedAt" DESC LIMIT 1
+                '''), {'job': self.job}).scalar()
+
+        if self.run_id is None:
+            self.run_id = '{}-{}'.format(self.job, datetime.now().strftime('%Y%m%dT%H%M%S%f'))
+            with self.engine.begin() as conn:
+                conn.execute(text('''
+                    INSERT INTO "ScrapeRuns" ("RunId", "Job", "StartedAt") VALUES (:run_id, :job, :started_at)
+                '''), {'run_id': self.run_id, 'job': self.job, 'started_at': datetime.now()})
+        else:
+            self.join(self.run_id)
+
+        return self.run_id
+
+    def join(self, run_id):
+        # Continue a run started elsewhere (another process of a distributed run, see bei_ksei/task_queue.py)
+        self.run_id = run_id
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT "StockCode", "Endpoint" FROM "ScrapeRunLedger" WHERE "RunId" = :run_id
+            '''), {'run_id': self.run_id})
+            self.completed = {(stock, endpoint) for stock, endpoint in rows}
+
+    def finish(self):
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                UPDATE "ScrapeRuns" SET "FinishedAt" = :finished_at WHERE "RunId" = :run_id
+            '''), {'run_id': self.run_id, 'finished_at': datetime.now()})
+
+    # ## Units
+
+    def is_done(self, stock, endpoint):
+        return (stock, endpoint) in self.completed
+
+    def mark_done(self, units):
+        units = [unit for unit in units if unit not in self.completed]
+        if not units:
+            return
+
+        completed_at = datetime.now()
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO "ScrapeRunLedger" ("RunId", "StockCode", "Endpoint", "CompletedAt")
+                VALUES (:run_id, :stock, :endpoint, :completed_at)
+                ON CONFLICT DO NOTHING
+            '''), [
+                {'run_id': self.run_id, 'stock': stock, 'endpoint': endpoint, 'completed_at': completed_at}
+                for stock, endpoint in units
+            ])
+        self.completed.update(units)
@@ -0,0 +1,167 @@
+# # Table Schemas
+#
+# Every frame used to come from pd.DataFrame(json.loads(...)) with inferred object dtypes: prices and volumes were
+# strings or generic objects, every row kept its own StockCode / period string, and the tables were created with
+# TEXT columns. Each table now has one declared schema:
+# - columns dropped and renamed as the rows arrive
+# - column dtypes: category for repeated labels, float32 for prices, Int64 (nullable int64) for counts and volumes,
+#   datetime64 for dates ('date' is datetime64 normalized to midnight)
+# - natural key and secondary indexes
+# - append-only tables (daily history snapshots): a key that is already stored is never updated, the first stored
+#   row of a day wins, later rows with the same key are dropped
+#
+# apply() runs on every unit's frame as soon as it is fetched, so buffered batches are held compact, and again on
+# the concatenated batch (concat of categories that differ falls back to object). It only touches declared columns,
+# a field the site adds later is kept as it comes. The DB sink creates columns with the SQL type of the declared
+# dtype and creates the indexes (bei_ksei/db_sink.py).
+#
+# Index levels stay float64: a float32 has 7 significant digits, 5130.004 would come back as 5130.0039.
+
+import pandas as pd
+
+from bei_ksei.dates import parse_dates
+
+# Declared dtype -> SQL column type
+SQL_TYPES = {
+    'category': 'TEXT',
+    'float32': 'REAL',
+    'float64': 'DOUBLE PRECISION',
+    'Int64': 'BIGINT',
+    'datetime64[ns]': 'TIMESTAMP',
+    'date': 'TIMESTAMP',
+}
+
+def coerce(values, dtype):
+    if dtype == 'category':
+        return values.astype('category')
+    if dtype in ('float32', 'float64'):
+        return pd.to_numeric(values, errors='coerce').astype(dtype)
+    if dtype == 'Int64':
+        # Volumes sometimes come as 1.2e+10 floats
+        return pd.to_numeric(values, errors='coerce').round().astype('Int64')
+    if dtype in ('datetime64[ns]', 'date'):
+        if not pd.api.types.is_datetime64_any_dtype(values):
+            values = parse_dates(values)
+        return values.dt.normalize() if dtype == 'date' else values
+    raise ValueError('Unknown dtype {}'.format(dtype))
+
+class TableSchema:
+    def __init__(self, table, keys, columns, drop=(), rename=None, indexes=(), append_only=False):
+        self.table = table
+        self.keys = list(keys)
+        self.columns = dict(columns)
+        self.drop = list(drop)
+        self.rename = dict(rename or {})
+        self.indexes = [tuple(index) for index in indexes]
+        self.append_only = append_only
+
+    def apply(self, df):
+        if df is None or len(df.columns) == 0:
+            return df
+
+        df = df.rename(columns=self.rename).drop(columns=[column for column in self.drop if column in df.columns])
+        for column, dtype in self.columns.items():
+            if column in df.columns:
+                df[column] = coerce(df[column], dtype)
+
+        return df
+
+    def sql_type(self, column):
+        # None for columns that are not declared
+        return SQL_TYPES.get(self.columns.get(column))
+
+# ## Registry
+
+TABLE_SCHEMAS = {schema.table: schema for schema in [
+    TableSchema(
+        'IDXTradingInfo',
+        keys=['StockCode', 'Date'],
+        columns={
+            'StockCode': 'category', 'Date': 'datetime64[ns]',
+            'Previous': 'float32', 'OpenPrice': 'float32', 'FirstTrade': 'float32', 'High': 'float32', 'Low': 'float32',
+            'Close': 'float32', 'Change': 'float32', 'Offer': 'float32', 'Bid': 'float32',
+            'Volume': 'Int64', 'Value': 'Int64', 'Frequency': 'Int64', 'OfferVolume': 'Int64', 'BidVolume': 'Int64',
+            'ListedShares': 'Int64', 'TradebleShares': 'Int64', 'ForeignSell': 'Int64', 'ForeignBuy': 'Int64',
+            'NonRegularVolume': 'Int64', 'NonRegularValue': 'Int64', 'NonRegularFrequency': 'Int64',
+            'IndexIndividual': 'float64', 'WeightForIndex': 'float64',
+            'LastScraped': 'datetime64[ns]',
+        },
+        drop=['No', 'Remarks'],
+        # Trading calendar groups by date
+        indexes=[('Date',)],
+    ),
+    TableSchema(
+        'IDXCompanyProfiles',
+        keys=['StockCode'],
+        columns={
+            'Sektor': 'category', 'SubSektor': 'category', 'Industri': 'category', 'SubIndustri': 'category',
+            'PapanPencatatan': 'category', 'BAE': 'category',
+            'TanggalPencatatan': 'date', 'LastScraped': 'datetime64[ns]',
+        },
+        drop=[
+            'DataID', 'Divisi', 'EfekEmiten_EBA', 'EfekEmiten_ETF',
+            'EfekEmiten_Obligasi', 'EfekEmiten_SPEI', 'EfekEmiten_Saham',
+            'id', 'KodeDivisi', 'JenisEmiten', 'KodeEmiten', 'Status'
+        ],
+        indexes=[('Sektor', 'SubSektor')],
+    ),
+    TableSchema(
+        'IDXFinancialReportLinks',
+        keys=['File_Path'],
+        columns={
+            'StockCode': 'category', 'Report_Period': 'category', 'Report_Year': 'Int64',
+            'File_Modified': 'date', 'LastScraped': 'datetime64[ns]',
+        },
+        drop=['File_ID', 'File_Size', 'File_Type'],
+        rename={'Emiten_Code': 'StockCode'},
+        # Financial report watermarks
+        indexes=[('StockCode', 'Report_Year', 'Report_Period')],
+    ),
+    TableSchema(
+        # Downloaded attachments of IDXFinancialReportLinks (04 - IDX Financial Report Files.py)
+        'IDXFinancialReportFiles',
+        keys=['File_Path'],
+        columns={'File_Bytes': 'Int64', 'Downloaded': 'datetime64[ns]'},
+    ),
+    TableSchema(
+        'BEISectoralSummary',
+        keys=['IndexCode', 'DTCreate'],
+        columns={
+            'IndexCode': 'category', 'DTCreate': 'date',
+            'PrevVal': 'float64', 'HighVal': 'float64', 'LowVal': 'float64', 'LastVal': 'float64',
+            'ChgVal': 'float64', 'ChgPct': 'float32',
+            'LastScraped': 'datetime64[ns]',
+        },
+        drop=['IntRow'],
+        indexes=[('DTCreate',)],
+        append_only=True,
+    ),
+    TableSchema(
+        'BEIIndexSummary',
+        keys=['IndexCode', 'DTCreate'],
+        columns={
+            'IndexCode': 'category', 'DTCreate': 'date',
+            'PrevVal': 'float64', 'HighVal': 'float64', 'LowVal': 'float64', 'LastVal': 'float64',
+            'ChgVal': 'float64', 'ChgPct': 'float32',
+            'LastScraped': 'datetime64[ns]',
+        },
+        drop=['Links'],
+        rename={'DtCreate': 'DTCreate'},
+        indexes=[('DTCreate',)],
+        append_only=True,
+    ),
+    TableSchema(
+        'BondDetails',
+        keys=['Short Code'],
+        columns={
+            'Listing Date': 'datetime64[ns]', 'Mature Date': 'datetime64[ns]', 'Interest/Disc Rate': 'float32',
+            'LastScraped': 'datetime64[ns]',
+        },
+        # Mostly missing values
+        drop=['Current Amount', 'Effective Date ISIN', 'Day Count Basis'],
+        indexes=[('Mature Date',)],
+    ),
+]}
+
+def apply_schema(table, df):
+    return TABLE_SCHEMAS[table].apply(df)
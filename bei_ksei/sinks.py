@@ -0,0 +1,160 @@
+# # Output Sinks
+#
+# Every transformed batch goes to each configured sink, instead of straight to Postgres:
+# - postgres: COPY + INSERT ... ON CONFLICT into the hosted DB (bei_ksei/db_sink.py)
+# - parquet: local Parquet files, so years of history can be scanned without pulling whole tables through pd.read_sql
+#
+# Sinks are chosen from env: SINKS=postgres,parquet (default postgres), PARQUET_ROOT (default ./parquet)
+#
+# ## Parquet Layout
+#
+# <root>/<table>/<code column>=<code>/year=<year>/part-<timestamp>.parquet
+# - partitioned by stock / index code and year of the date column, one partition is one code's history of a year
+# - append-only: every write adds a new part file to each partition it touches, a file is never rewritten
+# - compact() merges the files of a partition into one file, sorted by date and deduplicated on the table key
+#   (the latest written row wins, the first one for append-only tables), so daily files don't pile up
+# - the code column lives in the path only
+# - rows without a date have no partition, they are skipped with a warning (and counted in rows_dropped_total)
+#
+# Reading with predicate pushdown (partitions are pruned, row groups are skipped on their date statistics):
+#
+#   pd.read_parquet('parquet/IDXTradingInfo', filters=[('StockCode', '==', 'BBCA'), ('year', '>=', 2020)])
+
+import glob
+import os
+import threading
+from datetime import datetime
+from urllib.parse import quote as quote_path
+
+import pandas as pd
+
+from bei_ksei.db_sink import TABLE_KEYS, upsert
+from bei_ksei.metrics import metrics
+from bei_ksei.schemas import TABLE_SCHEMAS
+
+# table -> date column, code column (None: date partitions only)
+PARQUET_TABLES = {
+    'IDXTradingInfo': ('Date', 'StockCode'),
+    'BEISectoralSummary': ('DTCreate', 'IndexCode'),
+    'BEIIndexSummary': ('DTCreate', 'IndexCode'),
+    'BondDetails': ('LastScraped', None),
+}
+
+# ## Postgres
+
+class PostgresSink:
+    name = 'postgres'
+
+    def write(self, table, df):
+        return upsert(df, table)
+
+# ## Parquet
+
+class ParquetSink:
+    name = 'parquet'
+
+    def __init__(self, root=None):
+        self.root = root or os.getenv('PARQUET_ROOT', 'parquet')
+        self.lock = threading.Lock()
+        self.sequence = 0
+
+    def partition_dir(self, table, code, year):
+        date_column, code_column = PARQUET_TABLES[table]
+        if code_column is None:
+            return os.path.join(self.root, table, 'year={}'.format(year))
+
+        return os.path.join(self.root, table, '{}={}'.format(code_column, quote_path(str(code), safe='')), 'year={}'.format(year))
+
+    def part_name(self):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+
+        return 'part-{}-{}-{:06d}.parquet'.format(datetime.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), sequence)
+
+    def write(self, table, df):
+        if table not in PARQUET_TABLES or len(df) == 0:
+            return 0
+
+        date_column, code_column = PARQUET_TABLES[table]
+        years = pd.to_datetime(df[date_column]).dt.year.rename('year')
+        undated = int(years.isna().sum())
+        if undated:
+            print(f"Parquet {table}: {undated} rows without {date_column} skipped")
+            metrics.inc('rows_dropped_total', undated, table=table, sink=self.name)
+            df, years = df[years.notna()], years[years.notna()].astype(int)
+
+        written = 0
+        # Plain objects, a categorical code column would group every category with every year
+        codes = df[code_column].astype(object) if code_column is not None else pd.Series(None, index=df.index, dtype=object)
+        for (code, year), rows in df.groupby([codes.fillna(''), years], sort=False):
+            directory = self.partition_dir(table, code, year)
+            os.makedirs(directory, exist_ok=True)
+            if code_column is not None:
+                rows = rows.drop(columns=code_column)
+            rows.sort_values(date_column).to_parquet(os.path.join(directory, self.part_name()), index=False)
+            written += len(rows)
+
+        return written
+
+    # ## Compaction
+
+    def compact(self, table=None, min_files=2):
+        # Returns the number of partitions compacted
+        compacted = 0
+        for table in [table] if table else PARQUET_TABLES:
+            date_column, code_column = PARQUET_TABLES[table]
+            keys = [key for key in TABLE_KEYS.get(table, []) if key != code_column]
+            keep = 'first' if table in TABLE_SCHEMAS and TABLE_SCHEMAS[table].append_only else 'last'
+            for directory in glob.glob(os.path.join(self.root, table, '**', 'year=*'), recursive=True):
+                # Part file names sort in write order, so the last copy of a key is the latest one
+                paths = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+                if len(paths) < min_files:
+                    continue
+
+                rows = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+                if keys:
+                    rows = rows.drop_duplicates(subset=keys, keep=keep)
+                # Written before the old files are removed, a crash in between only leaves duplicates behind
+                rows.sort_values(date_column).to_parquet(os.path.join(directory, self.part_name()), index=False)
+                for path in paths:
+                    os.remove(path)
+                compacted += 1
+
+        return compacted
+
+# ## Configured Sinks
+
+sink_types = {
+    'postgres': PostgresSink,
+    'parquet': ParquetSink,
+}
+
+sinks_lock = threading.Lock()
+shared_sinks = None
+
+def get_sinks():
+    global shared_sinks
+    with sinks_lock:
+        if shared_sinks is None:
+            names = [name.strip() for name in os.getenv('SINKS', 'postgres').split(',') if name.strip()]
+            shared_sinks = [sink_types[name]() for name in names]
+
+    return shared_sinks
+
+def write_to_sinks(table, df, exclude=()):
+    # Rows written by the first sink (the DB when it is configured)
+    written = None
+    for sink in get_sinks():
+        if sink.name in exclude:
+            continue
+        with metrics.timer('db_write_seconds', table=table, sink=sink.name):
+            rows = sink.write(table, df)
+        metrics.inc('db_rows_total', rows or 0, table=table, sink=sink.name)
+        if written is None:
+            written = rows
+
+    return written or 0
+
+def compact_parquet(table=None):
+    return sum(sink.compact(table) for sink in get_sinks() if isinstance(sink, ParquetSink))
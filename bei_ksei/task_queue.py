@@ -0,0 +1,299 @@
+# # Distributed Task Queue
+#
+# The (stock, endpoint) units of a run in a shared Postgres table, so several worker processes (on one machine or
+# on many) scrape the same run instead of one process with a fixed number of threads:
+# - a coordinator creates the run and seeds its units, planned from the stock summary exactly like a single
+#   process run (01 - IDX Stocks.py --coordinator)
+# - workers claim batches of pending units with SELECT ... FOR UPDATE SKIP LOCKED, two workers never get the same
+#   unit and nobody waits on a row another worker has locked (01 - IDX Stocks.py --worker)
+# - a claimed unit is leased for LEASE_SECONDS, a worker's heartbeat renews the leases of everything it holds. The
+#   leases of a dead worker run out and its units are claimed again by the others
+# - a unit is done once its rows are committed by the worker that scraped it. Units queued while scraping
+#   (history pages, per stock fallbacks) are added to the same run, in the transaction that completes the unit
+# - a unit that failed TASK_ATTEMPTS times is not claimed again, it goes to the dead-letter table
+#
+# Timestamps are the DB's clock, so the workers' clocks don't have to agree.
+#
+# Every worker has its own per-host rate limit: with N workers, set IDX_RATE of each to the site budget / N.
+#
+# Settings can be configured from env: TASK_LEASE_SECONDS, TASK_ATTEMPTS, TASK_POLL_SECONDS
+
+import asyncio
+import json
+import os
+import socket
+import threading
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+
+from sqlalchemy import text
+
+LEASE_SECONDS = int(os.getenv('TASK_LEASE_SECONDS', 120))
+TASK_ATTEMPTS = int(os.getenv('TASK_ATTEMPTS', 3))
+POLL_SECONDS = float(os.getenv('TASK_POLL_SECONDS', 5))
+
+CREATE_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS "ScrapeTaskRuns" (
+        "RunId" TEXT PRIMARY KEY,
+        "Job" TEXT NOT NULL,
+        "Context" TEXT,
+        "SeededAt" TIMESTAMP NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS "ScrapeTasks" (
+        "TaskId" BIGSERIAL,
+        "RunId" TEXT NOT NULL,
+        "StockCode" TEXT NOT NULL,
+        "Endpoint" TEXT NOT NULL,
+        "Priority" INTEGER NOT NULL,
+        "Status" TEXT NOT NULL DEFAULT 'pending',
+        "Attempts" INTEGER NOT NULL DEFAULT 0,
+        "LeasedBy" TEXT,
+        "LeaseExpires" TIMESTAMPTZ,
+        "Error" TEXT,
+        "CompletedAt" TIMESTAMPTZ,
+        PRIMARY KEY ("RunId", "StockCode", "Endpoint")
+    )
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS "ScrapeTasks_claim" ON "ScrapeTasks" ("RunId", "Status", "Priority", "TaskId")
+    ''',
+]
+
+INSERT_TASK = text('''
+    INSERT INTO "ScrapeTasks" ("RunId", "StockCode", "Endpoint", "Priority")
+    VALUES (:run_id, :stock, :endpoint, :priority)
+    ON CONFLICT DO NOTHING
+''')
+
+def default_worker_id():
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+class TaskQueue:
+    def __init__(self, engine, job, worker_id=None, lease_seconds=LEASE_SECONDS, max_attempts=TASK_ATTEMPTS):
+        self.engine = engine
+        self.job = job
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.run_id = None
+
+        # Units queued by handlers, inserted with the next claim
+        self.queued = []
+        self.lock = threading.Lock()
+
+        with self.engine.begin() as conn:
+            for statement in CREATE_TABLES:
+                conn.execute(text(statement))
+
+    # ## Runs
+
+    def seed(self, run_id, context, units):
+        # units: (priority, stock, endpoint), context is what workers need to plan their units (JSON)
+        self.run_id = run_id
+        with self.engine.begin() as conn:
+            conn.execute(text('''
+                INSERT INTO "ScrapeTaskRuns" ("RunId", "Job", "Context", "SeededAt") VALUES (:run_id, :job, :context, :seeded_at)
+                ON CONFLICT ("RunId") DO UPDATE SET "Context" = EXCLUDED."Context"
+            '''), {'run_id': run_id, 'job': self.job, 'context': json.dumps(context), 'seeded_at': datetime.now()})
+            if units:
+                conn.execute(INSERT_TASK, [
+                    {'run_id': run_id, 'stock': stock, 'endpoint': endpoint, 'priority': priority}
+                    for priority, stock, endpoint in units
+                ])
+
+    def current_run(self):
+        # (run_id, context) of the latest seeded run of the job that isn't finished, None when there is none
+        with self.engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT t."RunId", t."Context" FROM "ScrapeTaskRuns" t
+                JOIN "ScrapeRuns" r ON r."RunId" = t."RunId"
+                WHERE t."Job" = :job AND r."FinishedAt" IS NULL
+                ORDER BY t."SeededAt" DESC LIMIT 1
+            '''), {'job': self.job}).first()
+
+        if row is None:
+            return None
+        self.run_id = row[0]
+
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    # ## Units
+
+    def put(self, priority, stock, endpoint):
+        # Same signature as WorkQueue.put, so the unit handlers can queue follow-up units in either
+        with self.lock:
+            self.queued.append((priority, stock, endpoint))
+
+    @contextmanager
+    def take_queued(self):
+        # The queued units, put back when the transaction that inserts them fails
+        with self.lock:
+            queued, self.queued = self.queued, []
+        try:
+            yield queued
+        except Exception:
+            with self.lock:
+                self.queued = queued + self.queued
+            raise
+
+    def insert_queued(self, conn, queued):
+        if queued:
+            conn.execute(INSERT_TASK, [
+                {'run_id': self.run_id, 'stock': stock, 'endpoint': endpoint, 'priority': priority}
+                for priority, stock, endpoint in queued
+            ])
+
+    def flush(self):
+        with self.take_queued() as queued:
+            if queued:
+                with self.engine.begin() as conn:
+                    self.insert_queued(conn, queued)
+
+    def claim(self, limit):
+        # Up to limit (stock, endpoint) units: pending ones, and leased ones whose worker stopped renewing them
+        self.flush()
+        if limit <= 0:
+            return []
+
+        with self.engine.begin() as conn:
+            rows = conn.execute(text('''
+                UPDATE "ScrapeTasks" t SET
+                    "Status" = 'leased', "LeasedBy" = :worker_id, "Attempts" = t."Attempts" + 1,
+                    "LeaseExpires" = now() + make_interval(secs => :lease_seconds)
+                FROM (
+                    SELECT "RunId", "StockCode", "Endpoint" FROM "ScrapeTasks"
+                    WHERE "RunId" = :run_id AND ("Status" = 'pending' OR ("Status" = 'leased' AND "LeaseExpires" < now()))
+                    ORDER BY "Priority", "TaskId"
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                ) claimed
+                WHERE t."RunId" = claimed."RunId" AND t."StockCode" = claimed."StockCode" AND t."Endpoint" = claimed."Endpoint"
+                RETURNING t."StockCode", t."Endpoint"
+            '''), {'run_id': self.run_id, 'worker_id': self.worker_id, 'lease_seconds': self.lease_seconds, 'limit': limit})
+
+            return [(stock, endpoint) for stock, endpoint in rows]
+
+    def heartbeat(self):
+        # Renews the leases of every unit this worker holds, returns how many
+        with self.engine.begin() as conn:
+            return conn.execute(text('''
+                UPDATE "ScrapeTasks" SET "LeaseExpires" = now() + make_interval(secs => :lease_seconds)
+                WHERE "RunId" = :run_id AND "LeasedBy" = :worker_id AND "Status" = 'leased'
+            '''), {'run_id': self.run_id, 'worker_id': self.worker_id, 'lease_seconds': self.lease_seconds}).rowcount
+
+    def complete(self, units):
+        # The units queued so far (the follow-ups of these units among them) are inserted in the same transaction:
+        # a crash can't leave a unit done without the units it queued. Units that aren't tasks are ignored
+        if not units:
+            return
+
+        with self.take_queued() as queued, self.engine.begin() as conn:
+            self.insert_queued(conn, queued)
+            conn.execute(text('''
+                UPDATE "ScrapeTasks" SET "Status" = 'done', "CompletedAt" = now(), "LeaseExpires" = NULL
+                WHERE "RunId" = :run_id AND "StockCode" = :stock AND "Endpoint" = :endpoint
+            '''), [{'run_id': self.run_id, 'stock': stock, 'endpoint': endpoint} for stock, endpoint in units])
+
+    def all_done(self, stock, endpoint_prefix):
+        # True when every task of the stock whose endpoint starts with endpoint_prefix is done, whichever worker ran it
+        with self.engine.connect() as conn:
+            return conn.execute(text('''
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM "ScrapeTasks"
+                    WHERE "RunId" = :run_id AND "StockCode" = :stock AND "Endpoint" LIKE :pattern AND "Status" <> 'done'
+                )
+            '''), {'run_id': self.run_id, 'stock': stock, 'pattern': endpoint_prefix + '%'}).scalar()
+
+    def fail(self, stock, endpoint, error):
+        # True when the unit is out of attempts, it's failed for good. Otherwise it's pending again
+        with self.engine.begin() as conn:
+            status = conn.execute(text('''
+                UPDATE "ScrapeTasks" SET
+                    "Status" = CASE WHEN "Attempts" >= :max_attempts THEN 'failed' ELSE 'pending' END,
+                    "LeasedBy" = NULL, "LeaseExpires" = NULL, "Error" = :error
+                WHERE "RunId" = :run_id AND "StockCode" = :stock AND "Endpoint" = :endpoint
+                RETURNING "Status"
+            '''), {'run_id': self.run_id, 'stock': stock, 'endpoint': endpoint, 'error': repr(error), 'max_attempts': self.max_attempts}).scalar()
+
+        return status == 'failed'
+
+    # ## Progress
+
+    def counts(self):
+        # Status -> number of units of the run
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                SELECT "Status", count(*) FROM "ScrapeTasks" WHERE "RunId" = :run_id GROUP BY "Status"
+            '''), {'run_id': self.run_id})
+
+            return {status: count for status, count in rows}
+
+    def outstanding(self, exclude_own=False):
+        # Units that are still pending or leased (by other workers only with exclude_own)
+        with self.engine.connect() as conn:
+            return conn.execute(text('''
+                SELECT count(*) FROM "ScrapeTasks"
+                WHERE "RunId" = :run_id AND ("Status" = 'pending' OR ("Status" = 'leased' AND NOT (:exclude_own AND "LeasedBy" = :worker_id)))
+            '''), {'run_id': self.run_id, 'worker_id': self.worker_id, 'exclude_own': exclude_own}).scalar()
+
+    def units(self, status, priority=None):
+        query = 'SELECT "StockCode", "Endpoint" FROM "ScrapeTasks" WHERE "RunId" = :run_id AND "Status" = :status'
+        params = {'run_id': self.run_id, 'status': status}
+        if priority is not None:
+            query += ' AND "Priority" = :priority'
+            params['priority'] = priority
+
+        with self.engine.connect() as conn:
+            return [(stock, endpoint) for stock, endpoint in conn.execute(text(query), params)]
+
+# ## Worker Loop
+#
+# handler(task_queue, stock, endpoint) is awaited for every claimed unit, on_failed(stock, endpoint, error) is
+# called for units that are out of attempts. The handler completes its units itself (once their rows are
+# committed). Returns once nothing is pending and no other worker holds a lease that could still run out.
+#
+# Leases are renewed by keep_leases(), which the caller holds until its last batch is committed: units whose rows
+# are still buffered when run_worker returns are leased until the final flush completes them.
+
+@asynccontextmanager
+async def keep_leases(task_queue):
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(task_queue.lease_seconds / 3)
+            await asyncio.to_thread(task_queue.heartbeat)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        yield
+    finally:
+        heartbeat_task.cancel()
+
+async def run_worker(task_queue, handler, num_workers, on_failed=None, poll_seconds=POLL_SECONDS):
+    async def run_unit(stock, endpoint):
+        try:
+            await handler(task_queue, stock, endpoint)
+        except Exception as e:
+            print(stock, endpoint, 'failed:', repr(e))
+            if await asyncio.to_thread(task_queue.fail, stock, endpoint, e) and on_failed is not None:
+                await asyncio.to_thread(on_failed, stock, endpoint, e)
+
+    running = set()
+    try:
+        while True:
+            claimed = await asyncio.to_thread(task_queue.claim, num_workers - len(running))
+            running.update(asyncio.create_task(run_unit(stock, endpoint)) for stock, endpoint in claimed)
+
+            if running:
+                done, running = await asyncio.wait(running, timeout=poll_seconds, return_when=asyncio.FIRST_COMPLETED)
+            elif await asyncio.to_thread(task_queue.outstanding, True) == 0:
+                break
+            else:
+                # Everything left is leased by other workers, wait in case one of them dies
+                await asyncio.sleep(poll_seconds)
+    finally:
+        # Units queued by the last handlers
+        await asyncio.to_thread(task_queue.flush)
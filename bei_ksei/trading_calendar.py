@@ -0,0 +1,81 @@
+# # IDX Trading Calendar
+#
+# IDX has no holiday API, so trading sessions are inferred from what we already stored: every date with rows for
+# at least MIN_STOCKS_PER_SESSION stocks in IDXTradingInfo was a session. The latest session is the stock summary
+# date. Between the stored history and the latest session (missed runs) holidays are unknown, business days are
+# used there, so a gap is over-fetched by a holiday at worst, never under-fetched.
+#
+# With it a stock's trading info request asks for exactly the sessions it misses, and stocks that are already up
+# to date are not requested at all.
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import text
+
+SESSIONS_QUERY = text('''
+    SELECT "Date", COUNT(*) AS "Stocks" FROM "IDXTradingInfo"
+    GROUP BY "Date"
+''')
+
+# A date with fewer rows is a stray row, not a session
+MIN_STOCKS_PER_SESSION = 5
+# A stock is treated as suspended when it is this many sessions behind, didn't trade in the latest session and its
+# stored history already ended in this many sessions without a trade. One quiet day of an illiquid stock that fell
+# behind (missed runs) is not a suspension, its gap is fetched.
+SUSPENDED_AFTER_SESSIONS = 5
+# Past this many missing sessions a suspended stock is fetched anyway, nothing stays stale forever
+MAX_SUSPENDED_GAP = 60
+
+class TradingCalendar:
+    def __init__(self, stored_sessions, latest_session):
+        self.latest_session = pd.Timestamp(latest_session).normalize()
+
+        sessions = pd.DatetimeIndex(pd.to_datetime(list(stored_sessions))).normalize()
+        sessions = sessions[sessions <= self.latest_session]
+        if len(sessions) > 0:
+            unknown = pd.bdate_range(sessions.max() + pd.Timedelta(days=1), self.latest_session)
+        else:
+            unknown = pd.DatetimeIndex([])
+        self.sessions = sessions.union(unknown).union(pd.DatetimeIndex([self.latest_session]))
+
+    def previous_session(self, date=None):
+        date = self.latest_session if date is None else pd.Timestamp(date).normalize()
+        position = self.sessions.searchsorted(date) - 1
+        if position < 0:
+            return date - pd.offsets.BDay(1)
+
+        return self.sessions[position]
+
+    def missing_sessions(self, max_date):
+        # Sessions after max_date up to and including the latest session
+        max_date = pd.Timestamp(max_date).normalize()
+        missing = len(self.sessions) - self.sessions.searchsorted(max_date, side='right')
+        if max_date < self.sessions[0]:
+            # Older than anything we know of, business days up to the first known session
+            missing += len(pd.bdate_range(max_date + pd.Timedelta(days=1), self.sessions[0] - pd.Timedelta(days=1)))
+
+        return missing
+
+    def is_up_to_date(self, max_date):
+        return pd.Timestamp(max_date).normalize() >= self.latest_session
+
+    def is_suspended(self, max_date, last_trade_date, traded_latest):
+        if traded_latest or last_trade_date is None:
+            return False
+        gap = self.missing_sessions(max_date)
+        # Stored sessions after the last trade, up to the end of the stored history
+        untraded_stored = self.missing_sessions(last_trade_date) - gap
+
+        return SUSPENDED_AFTER_SESSIONS < gap <= MAX_SUSPENDED_GAP and untraded_stored >= SUSPENDED_AFTER_SESSIONS
+
+def load_trading_calendar(engine, latest_session=None):
+    if latest_session is None:
+        # No summary date, the last business day up to today
+        latest_session = pd.offsets.BDay().rollback(pd.Timestamp.today().normalize())
+
+    stored_sessions = []
+    if sqlalchemy.inspect(engine).has_table('IDXTradingInfo'):
+        with engine.connect() as conn:
+            stored_sessions = [date for date, stocks in conn.execute(SESSIONS_QUERY) if stocks >= MIN_STOCKS_PER_SESSION]
+
+    return TradingCalendar(stored_sessions, latest_session)
@@ -0,0 +1,28 @@
+# # Upstream Override
+#
+# Every IDX / KSEI request (fetch engine, IDX session, pooled browsers) can be sent to another server instead, e.g.
+# the local mock server of the benchmarks (benchmarks/mock_server.py):
+#
+#   UPSTREAM_URL=http://127.0.0.1:8765 python run_all.py
+#
+# The path and query are kept and the original host becomes the first path segment, so one server can answer for
+# both sites: https://www.idx.co.id/primary/... -> http://127.0.0.1:8765/www.idx.co.id/primary/...
+#
+# Only the request goes elsewhere. Rate limits, circuit breakers and response cache keys still use the original
+# URL, so a run against the mock paces and caches exactly like a production run.
+
+import os
+from urllib.parse import urlsplit
+
+UPSTREAM_HOSTS = ('www.idx.co.id', 'www.ksei.co.id')
+
+def upstream_url(url, upstream=None):
+    upstream = upstream if upstream is not None else os.getenv('UPSTREAM_URL')
+    if not upstream:
+        return url
+
+    parts = urlsplit(url)
+    if parts.hostname not in UPSTREAM_HOSTS:
+        return url
+
+    return '{}/{}{}{}'.format(upstream.rstrip('/'), parts.hostname, parts.path or '/', '?' + parts.query if parts.query else '')
@@ -0,0 +1,68 @@
+# # Watermark Preload
+#
+# One grouped query per table at startup instead of one probe per stock:
+# - max stored trading date per stock, and the last stored date the stock traded on (Frequency > 0)
+# - (stock, period, year) financial report keys already stored
+# Scrape workers check this in-memory index instead of going to the DB.
+
+import sqlalchemy
+from sqlalchemy import text
+
+MAX_TRADING_DATE_QUERY = text('''
+    SELECT "StockCode", MAX("Date") AS "MaxDate" FROM "IDXTradingInfo"
+    GROUP BY "StockCode"
+''')
+
+# Frequency is TEXT in tables created by the old to_sql export
+TRADING_DATES_QUERY = text('''
+    SELECT "StockCode", MAX("Date") AS "MaxDate",
+        MAX("Date") FILTER (WHERE CAST(NULLIF(CAST("Frequency" AS TEXT), '') AS DOUBLE PRECISION) > 0) AS "LastTradeDate"
+    FROM "IDXTradingInfo"
+    GROUP BY "StockCode"
+''')
+
+FINANCIAL_REPORT_KEYS_QUERY = text('''
+    SELECT DISTINCT "StockCode", "Report_Period", "Report_Year" FROM "IDXFinancialReportLinks"
+    WHERE CAST("Report_Year" AS INTEGER) >= :min_year
+''')
+
+class Watermarks:
+    def __init__(self, max_dates=None, report_keys=None, last_trade_dates=None):
+        self.max_dates = max_dates or {}
+        self.report_keys = report_keys or set()
+        self.last_trade_dates = last_trade_dates or {}
+
+    def max_date(self, stock):
+        return self.max_dates.get(stock)
+
+    def last_trade_date(self, stock):
+        # None when the stock never traded in the stored history (or the table has no Frequency)
+        return self.last_trade_dates.get(stock)
+
+    def has_report(self, stock, period, year):
+        return (stock, period, str(year)) in self.report_keys
+
+    def add_report(self, stock, period, year):
+        self.report_keys.add((stock, period, str(year)))
+
+def load_watermarks(engine, min_year):
+    watermarks = Watermarks()
+
+    # First run, tables don't exist yet
+    inspector = sqlalchemy.inspect(engine)
+    with engine.connect() as conn:
+        if inspector.has_table('IDXTradingInfo'):
+            if any(column['name'] == 'Frequency' for column in inspector.get_columns('IDXTradingInfo')):
+                for stock, max_date, last_trade_date in conn.execute(TRADING_DATES_QUERY):
+                    watermarks.max_dates[stock] = max_date
+                    if last_trade_date is not None:
+                        watermarks.last_trade_dates[stock] = last_trade_date
+            else:
+                for stock, max_date in conn.execute(MAX_TRADING_DATE_QUERY):
+                    watermarks.max_dates[stock] = max_date
+
+        if inspector.has_table('IDXFinancialReportLinks'):
+            for stock, period, year in conn.execute(FINANCIAL_REPORT_KEYS_QUERY, {'min_year': min_year}):
+                watermarks.add_report(stock, period, year)
+
+    return watermarks
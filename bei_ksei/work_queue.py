@@ -0,0 +1,83 @@
+# # Dynamic Work Queue
+#
+# Shared priority queue of (stock, endpoint) units, idle workers pull the next unit instead of working
+# through a fixed chunk, so one slow stock only holds up one worker.
+#
+# The number of workers can be changed while the run is going with resize(), or from the shell:
+# - kill -USR1 <pid>: add one worker
+# - kill -USR2 <pid>: remove one worker (it stops after its current unit)
+
+import asyncio
+import itertools
+import signal
+
+# Lower runs first, dead letters from the previous run go before everything else
+PRIORITY_DEAD_LETTER = -1
+PRIORITY_TRADING_TODAY = 0
+PRIORITY_PROFILE = 1
+PRIORITY_FINANCIAL_REPORT = 2
+PRIORITY_BACKFILL = 3
+
+class WorkQueue:
+    def __init__(self, handler, num_workers, on_result=None):
+        # handler(queue, stock, endpoint) is awaited for every unit, on_result(stock, endpoint, result) gets its result
+        self.handler = handler
+        self.on_result = on_result
+        self.target_workers = num_workers
+
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.workers = {}
+        self.completed = 0
+        self.errors = []
+
+    def put(self, priority, stock, endpoint):
+        # counter keeps FIFO order between units with the same priority
+        self.queue.put_nowait((priority, next(self.counter), stock, endpoint))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    # ## Worker Scaling
+
+    def resize(self, num_workers):
+        self.target_workers = max(num_workers, 1)
+        for worker_id in range(self.target_workers):
+            if worker_id not in self.workers:
+                self.workers[worker_id] = asyncio.create_task(self.worker(worker_id))
+        print(f"Work queue resized to {self.target_workers} workers")
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, lambda: self.resize(self.target_workers + 1))
+            loop.add_signal_handler(signal.SIGUSR2, lambda: self.resize(self.target_workers - 1))
+        except (ValueError, RuntimeError):
+            # Signals can only be handled in the main thread, e.g. not when run_all.py runs this as a job
+            pass
+
+    # ## Worker
+
+    async def worker(self, worker_id):
+        try:
+            while worker_id < self.target_workers:
+                priority, _, stock, endpoint = await self.queue.get()
+                try:
+                    result = await self.handler(self, stock, endpoint)
+                    if self.on_result is not None:
+                        self.on_result(stock, endpoint, result)
+                    self.completed += 1
+                except Exception as e:
+                    self.errors.append((stock, endpoint, e))
+                finally:
+                    self.queue.task_done()
+        finally:
+            del self.workers[worker_id]
+
+    async def run(self):
+        self.resize(self.target_workers)
+        await self.queue.join()
+
+        for task in list(self.workers.values()):
+            task.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
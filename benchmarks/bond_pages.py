@@ -0,0 +1,163 @@
+# # Bond Page Parser Benchmark
+#
+# Compares the old bond page parser (full BeautifulSoup html.parser tree) with bei_ksei/bond_page.py (deflist
+# block cut out of the raw bytes, parsed with lxml) on saved KSEI bond pages, reports pages/sec and peak memory.
+# Every parser runs in its own process, so peak memory (max RSS above the RSS after loading the pages) is not
+# mixed up between them.
+#
+# Pages are read from benchmarks/fixtures/ksei/*.html. The committed pages carry real bond records (values of the
+# bonds.xlsx export) in the KSEI page layout, with the markup the parser has to cope with:
+# - ADHI03ACN3, FR0037: plain layout, FR0037 with empty ('-') fields
+# - ABLS01XXMF: MTN without listing date / exchange, values in spans with comments and whitespace
+# - INKP01BCN1: entities (&amp;) in values, single-quoted class after another attribute
+# - ASSA01CB: no rate or frequency, uppercase DL tags, &nbsp; padding
+# - SIAGII02ACN5: only part of the fields, a nested dl inside one value (full parse fallback)
+# - UNDEFINED: almost every field missing
+# They were not captured from ksei.co.id: --save overwrites them with live pages (needs access to the site).
+# Without any pages a synthetic page with the same layout (page chrome + one deflist) is used, the output says so.
+#
+# Usage:
+# - python benchmarks/bond_pages.py --save FR0037 ABLS01XXMF
+# - python benchmarks/bond_pages.py --rounds 20
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, base_dir)
+
+from bei_ksei.bond_page import parse_bond_details
+
+fixtures_dir = os.path.join(base_dir, 'benchmarks', 'fixtures', 'ksei')
+
+# ## Parsers
+
+# The parser 03 - KSEI Bonds.py used before bei_ksei/bond_page.py
+def parse_bond_details_bs4(content):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser')
+    data = {}
+    dl_tag = soup.find('dl', class_='deflist deflist--with-colon')
+    for dt in dl_tag.find_all('dt'):
+        data[dt.get_text(strip=True)] = dt.find_next_sibling('dd').get_text(strip=True)
+
+    return data
+
+parsers = {
+    'bs4': parse_bond_details_bs4,
+    'lxml': parse_bond_details,
+}
+
+# ## Pages
+
+def synthetic_page(BondId):
+    menu = ''.join('<li class="menu__item"><a href="/menu/{0}">Menu item {0}</a><ul>{1}</ul></li>'.format(
+        i, ''.join('<li><a href="/menu/{}/{}">Sub item {}</a></li>'.format(i, j, j) for j in range(12))) for i in range(40))
+    news = ''.join('<article class="card"><h3>News {0}</h3><p>{1}</p></article>'.format(i, 'Lorem ipsum dolor sit amet. ' * 30) for i in range(30))
+    fields = {
+        'Short Code': BondId, 'ISIN Code': 'IDA000{}'.format(BondId), 'Issuer': 'PT Contoh Tbk',
+        'Listing Date': '12 Jan 2021', 'Maturity Date': '12 Jan 2026', 'Interest Rate': '8,25 %',
+        'Current Amount': '-', 'Effective Date ISIN': '-', 'Day Count Basis': 'Actual/365',
+        'Interest Type': 'Fixed', 'Interest Frequency': '3 Bulanan', 'Rating': 'idAA',
+    }
+    deflist = ''.join('<dt>\n  {}\n</dt><dd>\n  {} <!-- value -->\n</dd>'.format(key, value) for key, value in fields.items())
+
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{0}</title>{1}</head><body>'
+            '<nav><ul>{2}</ul></nav><main><h1>{0}</h1><dl class="deflist deflist--with-colon">{3}</dl>{4}</main>'
+            '<footer>{2}</footer></body></html>').format(
+        BondId, '<script>var x = 1;</script>' * 20, menu, deflist, news).encode('utf-8')
+
+def load_pages():
+    paths = sorted(glob.glob(os.path.join(fixtures_dir, '*.html')))
+    if paths:
+        pages = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+        return pages, 'fixture'
+
+    return [synthetic_page('BOND{:02d}'.format(i)) for i in range(10)], 'synthetic'
+
+async def save_pages(bond_ids):
+    from bei_ksei.fetch_engine import FetchEngine
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    async with FetchEngine() as fetcher:
+        for BondId in bond_ids:
+            url = 'https://www.ksei.co.id/services/registered-securities/corporate-bonds/lc/' + BondId
+            content = await fetcher.get_bytes(url, endpoint='KSEIBondDetails')
+            with open(os.path.join(fixtures_dir, BondId + '.html'), 'wb') as f:
+                f.write(content)
+            print('Saved', BondId)
+
+# ## Benchmark
+
+def max_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_parser(name, rounds):
+    pages, source = load_pages()
+    parse = parsers[name]
+    baseline = max_rss_mb()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for content in pages:
+            parse(content)
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'parser': name,
+        'source': source,
+        'pages': rounds * len(pages),
+        'pages_per_sec': rounds * len(pages) / seconds,
+        'peak_mb': max_rss_mb() - baseline,
+    }))
+
+def check_same_output():
+    paths = sorted(glob.glob(os.path.join(fixtures_dir, '*.html')))
+    pages, source = load_pages()
+    names = [os.path.basename(path) for path in paths] if paths else ['synthetic page {}'.format(i) for i in range(len(pages))]
+    for name, content in zip(names, pages):
+        if parse_bond_details_bs4(content) != parse_bond_details(content):
+            raise SystemExit('Parsers disagree on {}'.format(name))
+    print('Same output on {} {} pages'.format(len(pages), source))
+
+def main(args):
+    check_same_output()
+
+    results = []
+    for name in parsers:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--parser', name, '--rounds', str(args.rounds)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output))
+
+    print('{} pages, {} each parser'.format(results[0]['source'], results[0]['pages']))
+    print('{:<8}{:>12}{:>16}'.format('Parser', 'Pages/sec', 'Peak MB (+)'))
+    for row in results:
+        print('{:<8}{:>12.1f}{:>16.1f}'.format(row['parser'], row['pages_per_sec'], row['peak_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--parser', choices=list(parsers))
+    parser.add_argument('--save', nargs='+', metavar='BOND_ID')
+    args = parser.parse_args()
+
+    if args.save:
+        asyncio.run(save_pages(args.save))
+    elif args.parser:
+        run_parser(args.parser, args.rounds)
+    else:
+        main(args)
@@ -0,0 +1,461 @@
+# # Mock IDX / KSEI Server
+#
+# Answers every endpoint the scripts use, locally, so the pipelines can be run and measured without the live
+# sites (point them at it with UPSTREAM_URL, see bei_ksei/upstream.py):
+# - www.idx.co.id: home page (browser handshake), GetStockSummary, GetCompanyProfilesDetail, GetTradingInfoSS,
+#   GetFinancialReport (and its attachments), GetIndexIC, GetConstituent, BondSukuk bond list
+# - www.ksei.co.id: registered securities bond pages
+#
+# Responses are recorded ones when there are any, synthetic otherwise:
+# - --recorded DIR: a response cache directory of a real run (RESPONSE_CACHE_DIR, bei_ksei/response_cache.py),
+#   every URL it has is answered with the recorded body
+# - benchmarks/fixtures/ksei/<BondId>.html: bond pages saved with benchmarks/bond_pages.py --save
+# - everything else is generated from a seeded market of --stocks stocks with --sessions sessions of history and
+#   --bonds bonds, the same for every run with the same seed
+#
+# Server behaviour:
+# - --latency / --jitter: every response waits latency + uniform(0, jitter) seconds
+# - --error-rate: share of requests answered with a 500, report attachments are cut off halfway instead
+# - report attachments (File_Path of the report listings) answer Range requests
+# - --rate-limit: requests/sec per site (token bucket, one second of burst), requests over it get a 429
+#
+# Usage: python benchmarks/mock_server.py --port 8765 --stocks 100 --latency 0.05 --error-rate 0.01
+# then UPSTREAM_URL=http://127.0.0.1:8765 python run_all.py
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+import pandas as pd
+from aiohttp import web
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, base_dir)
+
+from bei_ksei.response_cache import CacheMiss, ResponseCache
+
+fixtures_dir = os.path.join(base_dir, 'benchmarks', 'fixtures', 'ksei')
+
+PERIODS = ['TW1', 'TW2', 'TW3', 'Audit']
+SECTORS = ['IDXENERGY', 'IDXBASIC', 'IDXINDUST', 'IDXNONCYC', 'IDXCYCLIC', 'IDXHEALTH', 'IDXFINANCE', 'IDXPROPERT', 'IDXTECHNO', 'IDXINFRA', 'IDXTRANS']
+INDEXES = ['COMPOSITE', 'LQ45', 'IDX30', 'IDX80', 'KOMPAS100', 'JII', 'ISSI', 'SRI-KEHATI', 'INFOBANK15', 'MBX', 'DBX', 'IDXBUMN20']
+MONTHS_ID = ['Jan', 'Feb', 'Mar', 'Apr', 'Mei', 'Jun', 'Jul', 'Agu', 'Sep', 'Okt', 'Nop', 'Des']
+
+def stock_code(i):
+    return ''.join(chr(65 + (i // 26 ** power) % 26) for power in (3, 2, 1, 0))
+
+def iso(date):
+    return '{:%Y-%m-%dT00:00:00}'.format(date)
+
+def indonesian_date(date):
+    return '{} {} {}'.format(date.day, MONTHS_ID[date.month - 1], date.year)
+
+# ## Synthetic Market
+
+class MarketFixtures:
+    def __init__(self, stocks=100, sessions=260, bonds=60, seed=0, latest_session=None):
+        self.seed = seed
+        self.stocks = [stock_code(i) for i in range(stocks)]
+        self.stock_index = {stock: i for i, stock in enumerate(self.stocks)}
+        if latest_session is None:
+            latest_session = pd.offsets.BDay().rollback(pd.Timestamp.today().normalize())
+        self.sessions = pd.bdate_range(end=latest_session, periods=sessions)
+        # Every fourth bond is a government bond
+        self.bonds = ['{}{:02d}'.format(stock_code(i), 1 + i % 3) if i % 4 else 'FR{:04d}'.format(i) for i in range(bonds)]
+
+        self.trading_rows = {}
+        self.lock = threading.Lock()
+
+    def rng(self, *key):
+        return random.Random('{}:{}'.format(self.seed, ':'.join(str(part) for part in key)))
+
+    # ### Stocks
+
+    def trading_history(self, stock):
+        # Newest first, like GetTradingInfoSS
+        with self.lock:
+            if stock in self.trading_rows:
+                return self.trading_rows[stock]
+
+        rng = self.rng('trading', stock)
+        close = rng.choice([50, 120, 480, 1500, 4200, 9000])
+        listed_shares = rng.randint(1, 50) * 10 ** 9
+        rows = []
+        for date in self.sessions:
+            previous = close
+            close = max(50, int(previous * (1 + rng.gauss(0, 0.02))))
+            volume = rng.randint(0, 40) * 10 ** rng.randint(3, 6)
+            rows.append({
+                'Date': iso(date), 'StockCode': stock, 'StockName': 'PT {} Tbk.'.format(stock), 'Remarks': '--U-------------',
+                'Previous': previous, 'OpenPrice': previous, 'FirstTrade': previous,
+                'High': max(previous, close), 'Low': min(previous, close), 'Close': close, 'Change': close - previous,
+                'Volume': volume, 'Value': volume * close, 'Frequency': volume // 1000,
+                'IndexIndividual': round(close / 10, 3), 'Offer': close + 5, 'OfferVolume': rng.randint(0, 9) * 1000,
+                'Bid': close - 5, 'BidVolume': rng.randint(0, 9) * 1000,
+                'ListedShares': listed_shares, 'TradebleShares': listed_shares, 'WeightForIndex': listed_shares // 2,
+                'ForeignSell': volume // 4, 'ForeignBuy': volume // 3, 'DelistingDate': '',
+                'NonRegularVolume': 0, 'NonRegularValue': 0, 'NonRegularFrequency': 0,
+            })
+        rows.reverse()
+
+        with self.lock:
+            self.trading_rows[stock] = rows
+        return rows
+
+    def stock_summary(self, start, length):
+        rows = [dict(self.trading_history(stock)[0], No=i + 1) for i, stock in enumerate(self.stocks)]
+        return {'draw': 0, 'recordsTotal': len(rows), 'recordsFiltered': len(rows), 'data': rows[start:start + length]}
+
+    def trading_info(self, stock, start, length):
+        rows = self.trading_history(stock) if stock in self.stock_index else []
+        page = [dict(row, No=start + i + 1) for i, row in enumerate(rows[start:start + length])]
+        return {'replies': page, 'recordsTotal': len(rows)}
+
+    def company_profile(self, stock):
+        if stock not in self.stock_index:
+            return {'Profiles': []}
+        rng = self.rng('profile', stock)
+        sector = rng.randrange(len(SECTORS))
+        return {'Profiles': [{
+            'KodeEmiten': stock, 'NamaEmiten': 'PT {} Tbk.'.format(stock), 'Alamat': 'Jl. Contoh No. {}'.format(rng.randint(1, 99)),
+            'BAE': 'PT Datindo Entrycom', 'DataID': self.stock_index[stock], 'Divisi': '', 'EfekEmiten_EBA': False,
+            'EfekEmiten_ETF': False, 'EfekEmiten_Obligasi': False, 'EfekEmiten_SPEI': False, 'EfekEmiten_Saham': True,
+            'Email': 'corsec@{}.co.id'.format(stock.lower()), 'Fax': '', 'id': self.stock_index[stock], 'JenisEmiten': 'Saham',
+            'KegiatanUsahaUtama': 'Perdagangan', 'KodeDivisi': '', 'Logo': '/Portal1/StaticData/ListedCompanies/LogoEmiten/{}.jpg'.format(stock),
+            'NPKP': '', 'NPWP': '01.000.000.0-000.000', 'PapanPencatatan': rng.choice(['Utama', 'Pengembangan', 'Akselerasi']),
+            'Sektor': SECTORS[sector], 'SubSektor': '{} {}'.format(SECTORS[sector], rng.randint(1, 3)),
+            'Industri': 'Industri {}'.format(rng.randint(1, 20)), 'SubIndustri': 'Sub Industri {}'.format(rng.randint(1, 40)),
+            'Status': 0, 'TanggalPencatatan': iso(datetime(rng.randint(1990, 2022), rng.randint(1, 12), rng.randint(1, 28))),
+            'Telepon': '021-0000000', 'Website': 'www.{}.co.id'.format(stock.lower()),
+        }]}
+
+    def has_report(self, year, period):
+        # Reports of the current year only up to the last finished quarter
+        now = datetime.now()
+        return year < now.year or (year == now.year and PERIODS.index(period) < (now.month - 1) // 3)
+
+    def financial_report(self, stock, year, period):
+        attachments = []
+        for i, kind in enumerate(['FinancialStatement', 'LK', 'Lampiran']):
+            file_name = '{}-{}-{}-{}.pdf'.format(kind, year, period, stock)
+            attachments.append({
+                'Emiten_Code': stock, 'File_ID': '{}-{}-{}-{}'.format(stock, year, period, i),
+                'File_Modified': iso(datetime(year, 1 + (PERIODS.index(period) * 3 + 3) % 12, 28)),
+                'File_Name': file_name, 'File_Path': 'Portals/0/StaticData/ListedCompanies/{}/{}/{}/{}'.format(year, period, stock, file_name),
+                'File_Size': 10000 + self.rng('report', stock, year, period, i).randint(0, 10 ** 6), 'File_Type': '.pdf',
+                'NamaEmiten': 'PT {} Tbk.'.format(stock), 'Report_Period': period, 'Report_Year': str(year),
+            })
+        return {'KodeEmiten': stock, 'NamaEmiten': 'PT {} Tbk.'.format(stock), 'Report_Period': period, 'Report_Year': str(year), 'Attachments': attachments}
+
+    def financial_reports(self, year, period, stock, index_from, page_size):
+        # One emitter or the whole market, indexFrom is the 1-based page (0 is the first page too)
+        if not self.has_report(year, period):
+            results = []
+        elif stock:
+            results = [self.financial_report(stock, year, period)] if stock in self.stock_index else []
+        else:
+            results = [self.financial_report(stock, year, period) for stock in self.stocks]
+        offset = (max(index_from, 1) - 1) * page_size
+
+        return {'ResultCount': len(results), 'Results': results[offset:offset + page_size]}
+
+    def report_file(self, file_name):
+        # Attachment body, None for an unknown file. The Lampiran of a stock is the same document every period
+        # (an attachment uploaded again), so content-hash dedupe has something to find.
+        try:
+            kind, year, period, stock = file_name.rsplit('.', 1)[0].split('-')
+        except ValueError:
+            return None
+        if stock not in self.stock_index:
+            return None
+        rng = self.rng('report_file', stock) if kind == 'Lampiran' else self.rng('report_file', stock, year, period, kind)
+
+        return rng.randbytes(10000 + rng.randint(0, 10 ** 6))
+
+    # ### Sectoral and Index Summary
+
+    def index_row(self, code):
+        rng = self.rng('index', code, self.sessions[-1].date())
+        previous = round(rng.uniform(100, 7000), 3)
+        last = round(previous * (1 + rng.gauss(0, 0.01)), 3)
+        return {
+            'IndexCode': code, 'PrevVal': previous, 'HighVal': max(previous, last), 'LowVal': min(previous, last),
+            'LastVal': last, 'ChgVal': round(last - previous, 2), 'ChgPct': round((last - previous) / previous * 100, 2),
+        }
+
+    def sectoral_summary(self):
+        return {'data': [dict(self.index_row(code), IntRow=i + 1, DTCreate=iso(self.sessions[-1])) for i, code in enumerate(SECTORS)]}
+
+    def index_summary(self):
+        return {'Items': [dict(self.index_row(code), DtCreate=iso(self.sessions[-1]), Links=[]) for code in INDEXES]}
+
+    # ### Bonds
+
+    def bond_list(self, bond_type):
+        government = bond_type == 2
+        results = []
+        for BondId in self.bonds:
+            if BondId.startswith('FR') != government:
+                continue
+            rng = self.rng('bond', BondId)
+            results.append({
+                'Nomor': len(results) + 1, 'BondId': BondId, 'BondName': 'Obligasi {} Tahun {}'.format(BondId, rng.randint(2015, 2024)),
+                'IssuerCode': 'GOVT' if government else BondId[:4], 'MatureDate': iso(datetime(rng.randint(2025, 2040), rng.randint(1, 12), rng.randint(1, 28))),
+                'Rating': None if government else rng.choice(['idAAA', 'idAA', 'idA', 'idBBB']), 'Outstanding': rng.randint(1, 500) * 10 ** 9,
+            })
+        return {'ResultCount': len(results), 'Results': results}
+
+    def bond_page(self, BondId):
+        saved = os.path.join(fixtures_dir, BondId + '.html')
+        if os.path.exists(saved):
+            with open(saved, 'rb') as f:
+                return f.read()
+
+        rng = self.rng('bond', BondId)
+        listing = datetime(rng.randint(2015, 2024), rng.randint(1, 12), rng.randint(1, 28))
+        fields = {
+            'Short Code': BondId, 'ISIN Code': 'IDA000{}'.format(BondId), 'Issuer': 'PT {} Tbk'.format(BondId[:4]),
+            'Listing Date': indonesian_date(listing), 'Mature Date': indonesian_date(listing.replace(year=listing.year + rng.choice([3, 5, 10]))),
+            'Interest/Disc Rate': '{:.2f}%'.format(rng.uniform(5, 11)), 'Current Amount': '-', 'Effective Date ISIN': '-',
+            'Day Count Basis': 'Actual/365', 'Interest Type': 'Fixed', 'Interest Frequency': '3 Bulanan', 'Rating': rng.choice(['idAAA', 'idAA', '-']),
+        }
+        deflist = ''.join('<dt>\n  {}\n</dt><dd>\n  {}\n</dd>'.format(key, value) for key, value in fields.items())
+        menu = ''.join('<li class="menu__item"><a href="/menu/{0}">Menu item {0}</a></li>'.format(i) for i in range(200))
+
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{0}</title></head><body><nav><ul>{1}</ul></nav>'
+                '<main><h1>{0}</h1><dl class="deflist deflist--with-colon">{2}</dl></main><footer>{1}</footer></body></html>').format(BondId, menu, deflist).encode('utf-8')
+
+HOME_PAGE = b'<!DOCTYPE html><html><head><title>Bursa Efek Indonesia</title></head><body>Mock IDX</body></html>'
+
+# ## Server
+
+class SiteBucket:
+    # Token bucket with one second of burst, take() is False when the request is over the limit
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class MockServer:
+    def __init__(self, fixtures, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0.0, recorded=None, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.recorded = ResponseCache(directory=recorded, offline=True) if recorded else None
+        self.random = random.Random(seed)
+        self.buckets = {}
+
+        # (site, endpoint) -> status -> count
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.runner = None
+        self.port = None
+
+    def count(self, site, endpoint, status):
+        with self.stats_lock:
+            counts = self.stats.setdefault((site, endpoint), {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def reset_stats(self):
+        with self.stats_lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    # ### Routing
+
+    def synthetic(self, site, path, query):
+        # (body, content type), None for an unknown URL
+        fixtures = self.fixtures
+        if site == 'www.ksei.co.id' and '/lc/' in path:
+            return fixtures.bond_page(path.rsplit('/', 1)[1]), 'text/html'
+        if site != 'www.idx.co.id':
+            return None
+
+        if path in ('/', '/id'):
+            return HOME_PAGE, 'text/html'
+        if path.startswith('/Portals/'):
+            body = fixtures.report_file(path.rsplit('/', 1)[1])
+            return (body, 'application/pdf') if body is not None else None
+        if path == '/primary/TradingSummary/GetStockSummary':
+            content = fixtures.stock_summary(int(query.get('start', 0)), int(query.get('length', 9999)))
+        elif path == '/primary/ListedCompany/GetCompanyProfilesDetail':
+            content = fixtures.company_profile(query.get('KodeEmiten', ''))
+        elif path == '/primary/ListedCompany/GetTradingInfoSS':
+            content = fixtures.trading_info(query.get('code', ''), int(query.get('start', 0)), int(query.get('length', 10)))
+        elif path == '/primary/ListedCompany/GetFinancialReport':
+            content = fixtures.financial_reports(
+                int(query.get('year', 0)), query.get('periode', ''), query.get('kodeEmiten', ''),
+                int(query.get('indexFrom', 0)), int(query.get('pageSize', 1000)),
+            )
+        elif path == '/primary/StockData/GetIndexIC':
+            content = fixtures.sectoral_summary()
+        elif path == '/primary/StockData/GetConstituent':
+            content = fixtures.index_summary()
+        elif path == '/secondary/get/BondSukuk/bond':
+            content = fixtures.bond_list(int(query.get('bondType', 1)))
+        else:
+            return None
+
+        return json.dumps(content).encode('utf-8'), 'application/json'
+
+    def recorded_body(self, site, path, query):
+        if self.recorded is None:
+            return None
+        url = 'https://{}{}'.format(site, path) + ('?' + urlencode(list(query.items())) if query else '')
+        try:
+            cached = self.recorded.get(url, None)
+        except CacheMiss:
+            return None
+
+        return cached[0], 'text/html' if cached[0].lstrip().startswith(b'<') else 'application/json'
+
+    async def handle(self, request):
+        site = request.match_info['site']
+        path = '/' + request.match_info['path']
+        endpoint = '/lc/' if '/lc/' in path else '/Portals/' if path.startswith('/Portals/') else path
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.rate_limit:
+            bucket = self.buckets.setdefault(site, SiteBucket(self.rate_limit))
+            if not bucket.take():
+                self.count(site, endpoint, 429)
+                return web.json_response({'message': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        failed = self.error_rate and self.random.random() < self.error_rate
+        if failed and endpoint != '/Portals/':
+            self.count(site, endpoint, 500)
+            return web.json_response({'message': 'Mock error'}, status=500)
+
+        query = dict(request.query)
+        response = self.recorded_body(site, path, query) or self.synthetic(site, path, query)
+        if response is None:
+            self.count(site, endpoint, 404)
+            return web.json_response({'message': 'Not Found'}, status=404)
+
+        body, content_type = response
+        if endpoint == '/Portals/':
+            return await self.file_response(request, site, endpoint, body, content_type, failed)
+        self.count(site, endpoint, 200)
+        return web.Response(body=body, content_type=content_type)
+
+    async def file_response(self, request, site, endpoint, body, content_type, failed):
+        # Attachments answer Range requests, a failed download is cut off halfway through the body
+        status, headers, size = 200, {'Accept-Ranges': 'bytes'}, len(body)
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= size:
+                self.count(site, endpoint, 416)
+                return web.Response(status=416, headers={'Content-Range': 'bytes */{}'.format(size)})
+            status, body = 206, body[start:]
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, size - 1, size)
+
+        self.count(site, endpoint, 'cut' if failed else status)
+        response = web.StreamResponse(status=status, headers=dict(headers, **{'Content-Type': content_type, 'Content-Length': str(len(body))}))
+        await response.prepare(request)
+        if failed:
+            await response.write(body[:len(body) // 2])
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    # ### Lifecycle
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/{site}/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+        return 'http://{}:{}'.format(host, self.port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def start_thread(self, host='127.0.0.1', port=0):
+        # Runs the server on its own event loop thread, returns its URL (for the benchmark harness)
+        started = threading.Event()
+        result = {}
+
+        def run():
+            loop = asyncio.new_event_loop()
+            self.loop = loop
+            result['url'] = loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+        return result['url']
+
+    def stop_thread(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def add_server_arguments(parser):
+    parser.add_argument('--stocks', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=260)
+    parser.add_argument('--bonds', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests/sec per site, 0 is unlimited')
+    parser.add_argument('--recorded', help='response cache directory with recorded responses')
+
+def server_from_arguments(args):
+    fixtures = MarketFixtures(stocks=args.stocks, sessions=args.sessions, bonds=args.bonds, seed=args.seed)
+    return MockServer(
+        fixtures, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        rate_limit=args.rate_limit, recorded=args.recorded, seed=args.seed,
+    )
+
+async def serve(args):
+    server = server_from_arguments(args)
+    url = await server.start(port=args.port)
+    print('Mock IDX / KSEI server on', url)
+    print('Run the scripts with UPSTREAM_URL={}'.format(url))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for (site, endpoint), counts in sorted(server.stats.items()):
+            print(site, endpoint, counts)
+        await server.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    add_server_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,316 @@
+# # Pipeline Benchmark
+#
+# Runs the three scripts end to end against the local mock server (benchmarks/mock_server.py) and a local database,
+# so a change can be measured before it reaches production. Per pipeline run it reports:
+# - items/sec: stocks (01), index rows (02) or bonds (03) of the mock market over the wall time of main()
+# - requests and requests/sec answered by the mock server, with the 429 / 500 it gave back
+# - p50 / p99 fetch latency, request sent to body read (fetch engine and IDX session GETs, rate limit wait excluded)
+#   and p50 of the browser page loads
+# - peak RSS of the pipeline process (every pipeline runs in its own process)
+# - DB write time, summed over the upserts / to_sql calls, and its share of the wall time
+#
+# The database comes from POSTGRE_* like the scripts and has to be a local one, --fresh drops every table the
+# pipelines write before the first run. With --runs 2 the second run shows the incremental (steady state) run.
+# Chrome is needed like in production: the IDX handshake and the 02 / 03 lists go through the browser pool.
+#
+# Regressions: --save FILE keeps the results as JSON, --baseline FILE compares with saved results and exits with 1
+# when throughput dropped or latency, peak RSS or DB write time grew by more than --tolerance.
+#
+# Usage:
+# - python benchmarks/pipelines.py --fresh --runs 2 --stocks 200 --latency 0.05 --error-rate 0.01
+# - python benchmarks/pipelines.py --pipelines stocks --fresh --baseline benchmarks/baseline.json
+
+import argparse
+import contextvars
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, base_dir)
+
+PIPELINES = {
+    'stocks': {
+        'script': '01 - IDX Stocks.py',
+        'tables': ['IDXTradingInfo', 'IDXCompanyProfiles', 'IDXFinancialReportLinks'],
+    },
+    'sectoral_index': {
+        'script': '02 - IDX Stock Sectoral and Index.py',
+        'tables': ['BEISectoralSummary', 'BEIIndexSummary'],
+    },
+    'bonds': {
+        'script': '03 - KSEI Bonds.py',
+        'tables': ['BondDetails'],
+    },
+}
+SHARED_TABLES = ['ScrapeRuns', 'ScrapeRunLedger', 'ScrapeDeadLetters']
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+# Higher is worse, except for throughput
+COMPARED_METRICS = {'items_per_sec': -1, 'p99_ms': 1, 'peak_mb': 1, 'db_seconds': 1}
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+# ## Pipeline Process
+#
+# Fetches and DB writes are timed by wrapping the functions every request / write goes through
+
+class Instrumentation:
+    def __init__(self):
+        self.latencies = []
+        self.page_loads = []
+        self.db_seconds = 0.0
+        self.db_writes = 0
+        self.lock = threading.Lock()
+
+    def add(self, values, seconds):
+        with self.lock:
+            values.append(seconds)
+
+    def install(self):
+        import pandas as pd
+        from bei_ksei import browser_pool, fetch_engine, idx_session, sinks
+
+        instrumentation = self
+        rate_limit_wait = contextvars.ContextVar('rate_limit_wait', default=0.0)
+
+        acquire = fetch_engine.TokenBucket.acquire
+        async def timed_acquire(bucket):
+            start = time.perf_counter()
+            await acquire(bucket)
+            rate_limit_wait.set(rate_limit_wait.get() + time.perf_counter() - start)
+        fetch_engine.TokenBucket.acquire = timed_acquire
+
+        get = fetch_engine.FetchEngine.get
+        async def timed_get(engine, url):
+            rate_limit_wait.set(0.0)
+            start = time.perf_counter()
+            try:
+                return await get(engine, url)
+            finally:
+                instrumentation.add(instrumentation.latencies, time.perf_counter() - start - rate_limit_wait.get())
+        fetch_engine.FetchEngine.get = timed_get
+
+        def timed(function, values):
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    instrumentation.add(values, time.perf_counter() - start)
+            return wrapper
+        idx_session.IDXSession.get_json_once = timed(idx_session.IDXSession.get_json_once, self.latencies)
+        browser_pool.PooledBrowser.get = timed(browser_pool.PooledBrowser.get, self.page_loads)
+
+        def timed_write(function):
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    with instrumentation.lock:
+                        instrumentation.db_seconds += time.perf_counter() - start
+                        instrumentation.db_writes += 1
+            return wrapper
+        sinks.upsert = timed_write(sinks.upsert)
+        pd.DataFrame.to_sql = timed_write(pd.DataFrame.to_sql)
+
+    def summary(self):
+        return {
+            'fetches': len(self.latencies),
+            'p50_ms': (percentile(self.latencies, 0.5) or 0) * 1000,
+            'p99_ms': (percentile(self.latencies, 0.99) or 0) * 1000,
+            'page_loads': len(self.page_loads),
+            'page_load_p50_ms': (percentile(self.page_loads, 0.5) or 0) * 1000,
+            'db_seconds': self.db_seconds,
+            'db_writes': self.db_writes,
+        }
+
+def run_child(name, result_path):
+    instrumentation = Instrumentation()
+    instrumentation.install()
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(base_dir, PIPELINES[name]['script']))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    start = time.perf_counter()
+    module.main()
+    seconds = time.perf_counter() - start
+
+    with open(result_path, 'w') as f:
+        json.dump(dict(instrumentation.summary(), seconds=seconds), f)
+
+# ## Harness
+
+def check_local_db():
+    host = os.getenv('POSTGRE_HOST') or ''
+    if host not in LOCAL_HOSTS and not host.startswith('/'):
+        raise SystemExit('POSTGRE_HOST={} is not a local database, the benchmark writes (and with --fresh drops) its tables'.format(host))
+
+def drop_tables(tables):
+    from sqlalchemy import text
+    from bei_ksei.db_sink import get_engine, quote
+
+    with get_engine().begin() as conn:
+        for table in tables:
+            conn.execute(text('DROP TABLE IF EXISTS {}'.format(quote(table))))
+
+def pipeline_items(name, fixtures):
+    from mock_server import INDEXES, SECTORS
+
+    if name == 'stocks':
+        return len(fixtures.stocks)
+    if name == 'sectoral_index':
+        return len(SECTORS) + len(INDEXES)
+    return len(fixtures.bonds)
+
+def run_pipeline(name, env):
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        result_path = f.name
+
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name, '--result', result_path], env=env)
+    # wait4 gives the resources of this process only, ru_maxrss is in KB on Linux
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise SystemExit('{} pipeline exited with {}'.format(name, process.returncode))
+
+    with open(result_path) as f:
+        result = json.load(f)
+    os.remove(result_path)
+
+    return dict(result, peak_mb=usage.ru_maxrss / 1024)
+
+def server_totals(stats):
+    totals = {'requests': 0, 'throttled': 0, 'errors': 0}
+    for counts in stats.values():
+        for status, count in counts.items():
+            totals['requests'] += count
+            if status == 429:
+                totals['throttled'] += count
+            elif status == 'cut' or status >= 500:
+                # 'cut': a file transfer the mock broke off mid-body, an injected error like a 500
+                totals['errors'] += count
+
+    return totals
+
+def print_results(results):
+    header = '{:<16}{:>4}{:>7}{:>9}{:>10}{:>9}{:>8}{:>9}{:>8}{:>8}{:>9}{:>9}{:>7}'
+    row = '{:<16}{:>4}{:>7}{:>9.1f}{:>10.2f}{:>9}{:>8.1f}{:>9}{:>8.1f}{:>8.1f}{:>9.1f}{:>9.2f}{:>6.0f}%'
+    print(header.format('Pipeline', 'Run', 'Items', 'Seconds', 'Items/s', 'Requests', 'Req/s', '429/500', 'p50 ms', 'p99 ms', 'Peak MB', 'DB s', 'DB'))
+    for result in results:
+        print(row.format(
+            result['pipeline'], result['run'], result['items'], result['seconds'], result['items_per_sec'],
+            result['requests'], result['requests_per_sec'], '{}/{}'.format(result['throttled'], result['errors']),
+            result['p50_ms'], result['p99_ms'], result['peak_mb'], result['db_seconds'],
+            100 * result['db_seconds'] / result['seconds'] if result['seconds'] else 0,
+        ))
+
+def compare(results, baseline, tolerance):
+    # Regression messages for runs that are in the baseline too
+    previous = {(result['pipeline'], result['run']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['pipeline'], result['run']))
+        if before is None:
+            continue
+        for metric, direction in COMPARED_METRICS.items():
+            if not before.get(metric):
+                continue
+            change = (result[metric] - before[metric]) / before[metric]
+            if change * direction > tolerance:
+                regressions.append('{} run {}: {} {:.2f} -> {:.2f} ({:+.0%})'.format(
+                    result['pipeline'], result['run'], metric, before[metric], result[metric], change))
+
+    return regressions
+
+def main(args):
+    from mock_server import server_from_arguments
+
+    check_local_db()
+    names = args.pipelines or list(PIPELINES)
+    if args.fresh:
+        drop_tables([table for name in names for table in PIPELINES[name]['tables']] + SHARED_TABLES)
+
+    server = server_from_arguments(args)
+    upstream = server.start_thread()
+    print('Mock server on {}: {} stocks, {} sessions, {} bonds, latency {}s + {}s jitter, {:.0%} errors, rate limit {}'.format(
+        upstream, args.stocks, args.sessions, args.bonds, args.latency, args.jitter, args.error_rate, args.rate_limit or 'off'))
+
+    work_dir = tempfile.mkdtemp(prefix='bei-ksei-benchmark-')
+    env = dict(
+        os.environ,
+        UPSTREAM_URL=upstream,
+        RESPONSE_CACHE_DIR=os.path.join(work_dir, 'responses'),
+        PARQUET_ROOT=os.path.join(work_dir, 'parquet'),
+        SINKS=args.sinks,
+        PYTHONPATH=os.pathsep.join([base_dir, os.environ.get('PYTHONPATH', '')]),
+    )
+    if args.idx_rate is not None:
+        env['IDX_RATE'] = str(args.idx_rate)
+    if args.ksei_rate is not None:
+        env['KSEI_RATE'] = str(args.ksei_rate)
+
+    results = []
+    try:
+        for run in range(1, args.runs + 1):
+            for name in names:
+                server.reset_stats()
+                result = run_pipeline(name, env)
+                totals = server_totals(server.reset_stats())
+                items = pipeline_items(name, server.fixtures)
+                results.append(dict(
+                    result, **totals, pipeline=name, run=run, items=items,
+                    items_per_sec=items / result['seconds'], requests_per_sec=totals['requests'] / result['seconds'],
+                ))
+    finally:
+        server.stop_thread()
+
+    print()
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            raise SystemExit(1)
+        print('No regressions against', args.baseline)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from mock_server import add_server_arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pipelines', nargs='+', choices=list(PIPELINES))
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--fresh', action='store_true', help='drop the pipeline tables before the first run')
+    parser.add_argument('--sinks', default='postgres')
+    parser.add_argument('--idx-rate', type=float, help='client IDX_RATE, production default when not given')
+    parser.add_argument('--ksei-rate', type=float, help='client KSEI_RATE, production default when not given')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--child', choices=list(PIPELINES), help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.result)
+    else:
+        main(args)
@@ -0,0 +1,61 @@
+# # Rate Limit Benchmark
+#
+# Starts a local mock server and drives the fetch engine against it, to show the achieved requests/sec per host
+# against the configured limit. 127.0.0.1 and localhost point to the same server but are limited separately,
+# the same way www.idx.co.id and www.ksei.co.id are in production.
+#
+# Usage: python benchmarks/rate_limit.py --idx-rate 10 --ksei-rate 4 --requests 50 --concurrency 8
+
+import argparse
+import asyncio
+import os
+import sys
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bei_ksei.fetch_engine import FetchEngine
+
+async def handle_json(request):
+    await asyncio.sleep(float(request.app['latency']))
+    return web.json_response({'data': []})
+
+async def start_mock_server(latency):
+    app = web.Application()
+    app['latency'] = latency
+    app.router.add_get('/{tail:.*}', handle_json)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    return runner, port
+
+async def main(args):
+    runner, port = await start_mock_server(args.latency)
+    host_rates = {'127.0.0.1': args.idx_rate, 'localhost': args.ksei_rate}
+
+    try:
+        async with FetchEngine(host_rates=host_rates, max_concurrency=args.concurrency) as fetcher:
+            tasks = []
+            for i in range(args.requests):
+                tasks.append(fetcher.get_json('http://127.0.0.1:{}/idx/{}'.format(port, i)))
+                tasks.append(fetcher.get_json('http://localhost:{}/ksei/{}'.format(port, i)))
+            await asyncio.gather(*tasks)
+
+            for host, rate in fetcher.rates().items():
+                print('{:<10} configured {:>6.2f} req/s, achieved {:>6.2f} req/s'.format(host, host_rates[host], rate))
+    finally:
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--idx-rate', type=float, default=10)
+    parser.add_argument('--ksei-rate', type=float, default=4)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,164 @@
+# # Run All Scrapers
+#
+# One entry point for the nightly run instead of chaining the three scripts in schedule.sh.
+# Jobs are a dependency graph, a job starts as soon as everything it depends on is done:
+# - stock_summary -> stock_details
+# - sectoral_index (independent)
+# - bonds (independent)
+# - stock_details -> report_files: downloads the attachments of new financial report links
+# - compact_parquet: after every job that writes Parquet, merges the daily part files (no-op without the parquet sink)
+#
+# All jobs run in this process and share the browser pool, the DB engine and the per-host rate limits.
+#
+# Usage:
+# - python run_all.py                       every job
+# - python run_all.py --jobs bonds          only bonds
+# - python run_all.py --jobs stock_details  stock_details and what it depends on (stock_summary)
+# - python run_all.py --resume              stock_details continues its last unfinished run
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from bei_ksei.browser_pool import close_browser_pool
+from bei_ksei.db_sink import migrate_natural_keys
+from bei_ksei.idx_session import IDXSession
+from bei_ksei.metrics import write_run_report
+from bei_ksei.response_cache import get_response_cache
+from bei_ksei.sinks import compact_parquet
+
+# ## Scripts
+#
+# The script file names have spaces, so they are loaded by path
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+def load_script(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(base_dir, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+idx_stocks = load_script('idx_stocks', '01 - IDX Stocks.py')
+idx_sectoral_index = load_script('idx_sectoral_index', '02 - IDX Stock Sectoral and Index.py')
+ksei_bonds = load_script('ksei_bonds', '03 - KSEI Bonds.py')
+idx_report_files = load_script('idx_report_files', '04 - IDX Financial Report Files.py')
+
+# ## Jobs
+#
+# Every job gets the shared run context and the results of the jobs it depends on
+
+def run_stock_summary(context, results):
+    return idx_stocks.scrape_stock_summary(context['idx_session'])
+
+def run_stock_details(context, results):
+    idx_stocks.scrape_stock_details(context['idx_session'], results['stock_summary'], resume=context['resume'])
+
+def run_sectoral_index(context, results):
+    idx_sectoral_index.scrape_sectoral_and_index(context['idx_session'])
+
+def run_bonds(context, results):
+    ksei_bonds.scrape_bonds(context['idx_session'])
+
+def run_report_files(context, results):
+    idx_report_files.download_report_files(context['idx_session'])
+
+def run_compact_parquet(context, results):
+    print(f"Parquet: {compact_parquet()} partitions compacted")
+
+jobs = {
+    'stock_summary': {'run': run_stock_summary, 'depends_on': []},
+    'stock_details': {'run': run_stock_details, 'depends_on': ['stock_summary']},
+    'sectoral_index': {'run': run_sectoral_index, 'depends_on': []},
+    'bonds': {'run': run_bonds, 'depends_on': []},
+    'report_files': {'run': run_report_files, 'depends_on': ['stock_details']},
+    'compact_parquet': {'run': run_compact_parquet, 'depends_on': ['stock_details', 'sectoral_index', 'bonds']},
+}
+
+def select_jobs(names):
+    selected = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(jobs[name]['depends_on'])
+
+    return selected
+
+# ## Scheduler
+
+def run_graph(selected, context):
+    results = {}
+    report = {}
+    started_at = time.monotonic()
+
+    def run_job(name):
+        start = time.monotonic()
+        try:
+            results[name] = jobs[name]['run'](context, results)
+            status = 'done'
+        except Exception:
+            traceback.print_exc()
+            status = 'failed'
+        report[name] = {'status': status, 'start': start - started_at, 'duration': time.monotonic() - start}
+
+    with ThreadPoolExecutor(max_workers=len(selected)) as executor:
+        running = {}
+        waiting = set(selected)
+        while waiting or running:
+            for name in sorted(waiting):
+                depends_on = jobs[name]['depends_on']
+                if any(report.get(dep, {}).get('status') in ('failed', 'skipped') for dep in depends_on):
+                    # A job never runs on top of a failed dependency, independent jobs keep going
+                    report[name] = {'status': 'skipped', 'start': None, 'duration': 0}
+                    waiting.remove(name)
+                elif all(report.get(dep, {}).get('status') == 'done' for dep in depends_on):
+                    print(f"[{datetime.now():%H:%M:%S}] START {name}")
+                    running[executor.submit(run_job, name)] = name
+                    waiting.remove(name)
+
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    print(f"[{datetime.now():%H:%M:%S}] END {name}: {report[name]['status']}")
+
+    return report
+
+def print_report(report):
+    print("Job Timing Report")
+    print(f"{'Job':<16}{'Status':<10}{'Start (s)':>10}{'Duration (s)':>14}")
+    for name, row in sorted(report.items(), key=lambda item: item[1]['start'] if item[1]['start'] is not None else float('inf')):
+        start = '-' if row['start'] is None else f"{row['start']:.1f}"
+        print(f"{name:<16}{row['status']:<10}{start:>10}{row['duration']:>14.1f}")
+
+# # Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', nargs='+', choices=list(jobs), default=list(jobs))
+    parser.add_argument('--resume', action='store_true')
+    args = parser.parse_args()
+
+    selected = select_jobs(args.jobs)
+    # Old to_sql tables get their natural key index (duplicates removed) once, before any job writes
+    migrate_natural_keys()
+    context = {'resume': args.resume, 'idx_session': IDXSession(pool_size=6, response_cache=get_response_cache())}
+
+    try:
+        report = run_graph(selected, context)
+    finally:
+        context['idx_session'].close()
+        close_browser_pool()
+
+    print_report(report)
+    # Per endpoint requests, latency, retries, bytes, browser / JSON / DB time of every job, see bei_ksei/metrics.py
+    write_run_report('run_all', jobs=report)
+    sys.exit(0 if all(row['status'] == 'done' for row in report.values()) else 1)
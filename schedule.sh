@@ -1,13 +1,10 @@
 #!/bin/sh
 cd /home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI
+PYTHON=/home/michaelliem99/anaconda3/envs/web_scraping/bin/python
 now=$(date)
-echo "Start Time: $now" &&
-echo "START 01- IDX STOCKS" &&
-/home/michaelliem99/anaconda3/envs/web_scraping/bin/python "/home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI/01 - IDX Stocks.py" &&
-echo "START 02 - IDX STOCK SECTORAL AND INDEX" &&
-/home/michaelliem99/anaconda3/envs/web_scraping/bin/python "/home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI/02 - IDX Stock Sectoral and Index.py" &&
-echo "START 03 - IDX KSEI BONDS" &&
-/home/michaelliem99/anaconda3/envs/web_scraping/bin/python "/home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI/03 - KSEI Bonds.py" &&
+echo "Start Time: $now"
+# All jobs run in one process (run_all.py), independent jobs overlap. A failed run is resumed once from the run ledger
+$PYTHON "/home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI/run_all.py" ||
+$PYTHON "/home/michaelliem99/Desktop/Portfolio/Web-Scraping-BEI-KSEI/run_all.py" --resume
 now=$(date)
-echo "End Time: $now" && 
-rm -r /tmp/.com.google.Chrome*
+echo "End Time: $now"